@@ -0,0 +1,144 @@
+"""复权因子
+
+Notes:
+    1. 网易日线`前收盘`为交易所公布的除权参考价，已包含分红、送转、配股等全部权益变动，
+       与上一交易日`收盘价`之比即为当日除权比例
+    2. 后复权因子为除权比例的累积乘积，上市首日为1；只在除权除息日记录新因子，
+       保存在`adjustment.h5`(股票代码、日期、复权因子)
+    3. 各代码已处理的最后日期、收盘价及因子保存在状态文件，刷新时只计算此后的日线，
+       新的权益变动追加为新行
+    4. 读取时按(代码, 日期)对齐到最近的除权除息日，一次向量化乘法得到复权价格
+       后复权价 = 价格 × 因子；前复权价 = 价格 × 因子 / 最新因子
+"""
+import numpy as np
+import pandas as pd
+
+from .utils import data_root
+
+# 复权方式
+ADJUST_TYPES = ('qfq', 'hfq')
+# 复权价格列
+PRICE_COLUMNS = ['开盘价', '最高价', '最低价', '收盘价', '前收盘', '涨跌额']
+FACTOR_COLUMNS = ['股票代码', '日期', '复权因子']
+STATE_COLUMNS = ['last_date', 'last_close', 'factor']
+
+# 价格精确到分，前收盘与上一收盘价相差超过半分才视为除权
+TOLERANCE = 0.005
+
+
+def adjustment_path():
+    """复权因子数据路径"""
+    return data_root('adjustment.h5')
+
+
+def _empty_state():
+    return pd.DataFrame(columns=STATE_COLUMNS,
+                        index=pd.Index([], name='股票代码'))
+
+
+def compute_factors(df, state=None):
+    """由日线计算复权因子
+
+    Arguments:
+        df {DataFrame} -- 日线数据，含股票代码、日期、收盘价、前收盘
+
+    Keyword Arguments:
+        state {DataFrame} -- 以代码为索引的上次状态(last_date, last_close, factor)，
+            只计算此后的日线 (default: {None})
+
+    Returns:
+        tuple -- (新增因子, 新状态)
+    """
+    if state is None:
+        state = _empty_state()
+    df = df[['股票代码', '日期', '收盘价', '前收盘']]
+    df = df.sort_values(['股票代码', '日期'], kind='mergesort')
+    if len(state):
+        last = df['股票代码'].map(state['last_date'])
+        df = df[last.isnull().values | (df['日期'] > last).values]
+    df = df.reset_index(drop=True)
+    if df.empty:
+        return pd.DataFrame(columns=FACTOR_COLUMNS), state
+    codes = df['股票代码'].values
+    first = np.ones(len(df), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    base = state.reindex(codes[first])
+    # 停牌等无效收盘价沿用此前收盘价
+    close = df['收盘价'].astype('float64')
+    close = close.where(close > 0).groupby(codes).ffill().values
+    prev = np.empty_like(close)
+    prev[1:] = close[:-1]
+    prev[first] = base['last_close'].values.astype('float64')
+    pre_close = df['前收盘'].values.astype('float64')
+    valid = (prev > 0) & (pre_close > 0) & (np.abs(prev - pre_close) >
+                                            TOLERANCE)
+    ratio = np.ones(len(df))
+    ratio[valid] = prev[valid] / pre_close[valid]
+    sizes = np.diff(np.append(np.flatnonzero(first), len(df)))
+    start = np.repeat(base['factor'].fillna(1.0).values.astype('float64'),
+                      sizes)
+    factor = pd.Series(ratio).groupby(codes).cumprod().values * start
+    # 新代码首日
+    is_new = np.zeros(len(df), dtype=bool)
+    is_new[first] = base['factor'].isnull().values
+    events = pd.DataFrame({
+        '股票代码': codes,
+        '日期': df['日期'].values,
+        '复权因子': factor,
+    })[valid | is_new]
+    last = np.append(first[1:], True)
+    latest = pd.DataFrame(
+        {
+            'last_date': df['日期'].values[last],
+            'last_close': close[last],
+            'factor': factor[last],
+        },
+        index=pd.Index(codes[last], name='股票代码'))
+    # 收盘价全部无效时保留此前收盘价
+    latest['last_close'] = latest['last_close'].fillna(
+        state['last_close'].reindex(latest.index))
+    state = pd.concat([state[~state.index.isin(latest.index)], latest])
+    return events.reset_index(drop=True), state.sort_index()
+
+
+def _aligned_factors(df, factors, date_col):
+    """各行所属除权期间的复权因子"""
+    n = len(df)
+    left = pd.DataFrame({
+        '股票代码': df['股票代码'].values,
+        '日期': pd.to_datetime(df[date_col].values),
+        '_pos': np.arange(n),
+    }).sort_values('日期', kind='mergesort')
+    right = factors[FACTOR_COLUMNS].sort_values('日期', kind='mergesort')
+    merged = pd.merge_asof(left, right, on='日期', by='股票代码')
+    res = np.ones(n)
+    res[merged['_pos'].values] = merged['复权因子'].fillna(1.0).values
+    return res
+
+
+def adjust_prices(df, factors, how='qfq', date_col='日期'):
+    """复权价格
+
+    Arguments:
+        df {DataFrame} -- 日线数据，含股票代码及日期
+        factors {DataFrame} -- 复权因子(股票代码、日期、复权因子)
+
+    Keyword Arguments:
+        how {str} -- `qfq`前复权，`hfq`后复权 (default: {'qfq'})
+        date_col {str} -- 日期列名称 (default: {'日期'})
+
+    Returns:
+        DataFrame -- 价格列复权后的数据(副本)
+    """
+    assert how in ADJUST_TYPES, f'复权方式只支持{ADJUST_TYPES}'
+    df = df.copy()
+    columns = [c for c in PRICE_COLUMNS if c in df]
+    if df.empty or not columns:
+        return df
+    factor = _aligned_factors(df, factors, date_col)
+    if how == 'qfq':
+        latest = factors.sort_values('日期', kind='mergesort').groupby(
+            '股票代码')['复权因子'].last()
+        factor /= df['股票代码'].map(latest).fillna(1.0).values
+    df[columns] = df[columns].astype('float64').values * factor[:, None]
+    return df
@@ -0,0 +1,278 @@
+"""由行情快照生成分钟K线
+
+Notes:
+    1. 快照中的成交量、成交额为当日累计值，按(代码, 日期)向量化差分得到区间增量
+    2. K线按交易时段划分(上午09:30-11:30，下午13:00-15:00)，以区间结束时间标记，
+       如60分钟K线为10:30、11:30、14:00、15:00
+    3. 开盘、收盘为区间首个及最后快照价格；当日最高、最低在区间内更新时，
+       以更新值修正区间最高、最低
+    4. `BarBuilder`增量处理陆续到达的快照，只输出已完成的K线，
+       未完成部分及累计值保存在状态文件，写入`bars/{数据源}/{n}min.h5`
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from .data import HDFData, default_status
+from .utils import data_root
+
+# 支持的K线周期(分钟)
+BAR_FREQS = (1, 5, 15, 30, 60)
+
+# 快照数据源列名称
+SOURCES = {
+    # 腾讯分钟快照(`scripts.tct_minutely`)
+    'tct': {
+        'code': '代码',
+        'time': '时间',
+        'price': '最新价',
+        'high': '最高',
+        'low': '最低',
+        'volume': '成交量',
+        'amount': '成交额',
+    },
+    # 新浪实时报价(`scripts.quote`)
+    'live': {
+        'code': '股票代码',
+        'time': '时间',
+        'price': '现价',
+        'high': '最高',
+        'low': '最低',
+        'volume': '成交量',
+        'amount': '成交额',
+    },
+}
+
+BAR_COLUMNS = ['股票代码', '时间', '开盘', '最高', '最低', '收盘', '成交量', '成交额']
+
+_MORNING = 9 * 60 + 30
+_AFTERNOON = 13 * 60
+_SESSION = 120
+
+
+def bars_path(n, source='tct'):
+    """K线数据路径"""
+    return data_root(f'bars/{source}/{n}min.h5')
+
+
+def _canonical(df, source):
+    """快照统一列名称，按(代码, 时间)排序"""
+    cols = SOURCES[source]
+    df = df[list(cols.values())].rename(columns={v: k for k, v in cols.items()})
+    return _sorted(df)
+
+
+def _sorted(df):
+    df = df.drop_duplicates(['code', 'time'], keep='last')
+    df = df.sort_values(['code', 'time'], kind='mergesort')
+    return df.reset_index(drop=True)
+
+
+def bar_labels(times, n):
+    """快照所属K线的结束时间
+
+    Arguments:
+        times {Series} -- 快照时间
+        n {int} -- K线周期(分钟)
+
+    Returns:
+        Series -- K线时间
+    """
+    times = pd.Series(times)
+    minutes = (times.dt.hour * 60 + times.dt.minute +
+               times.dt.second / 60).values
+    # 交易时段内的分钟序号(0-240)，集合竞价及收盘后归入首末K线
+    m = np.where(minutes < _AFTERNOON,
+                 np.clip(minutes - _MORNING, 0, _SESSION),
+                 np.clip(minutes - _AFTERNOON + _SESSION, _SESSION,
+                         2 * _SESSION))
+    k = np.maximum(np.ceil(m / n), 1) * n
+    offset = np.where(k <= _SESSION, _MORNING + k, _AFTERNOON + k - _SESSION)
+    return times.dt.normalize() + pd.to_timedelta(offset, unit='min')
+
+
+def _increments(df, base):
+    """累计值差分，各(代码, 日期)首行相对`base`中的上次累计值"""
+    codes = df['code'].values
+    dates = df['time'].dt.normalize().values
+    first = np.ones(len(df), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (dates[1:] != dates[:-1])
+    res = {}
+    for col in ('volume', 'amount', 'high', 'low'):
+        values = df[col].values.astype('float64')
+        prev = np.empty_like(values)
+        prev[1:] = values[:-1]
+        prev[first] = np.nan
+        if base is not None and len(base):
+            # 同一日期的上次累计值
+            b = base.reindex(codes[first])
+            same_day = (b['date'].values == dates[first])
+            prev[first] = np.where(same_day, b[col].values, np.nan)
+        res[col] = values, prev
+    volume, prev_volume = res['volume']
+    amount, prev_amount = res['amount']
+    high, prev_high = res['high']
+    low, prev_low = res['low']
+    return pd.DataFrame({
+        # 数据异常导致累计值减少时视为无成交
+        'volume': np.clip(volume - np.nan_to_num(prev_volume), 0, None),
+        'amount': np.clip(amount - np.nan_to_num(prev_amount), 0, None),
+        # 当日最高、最低在区间内更新的值
+        'high': np.where(np.isnan(prev_high) | (high > prev_high), high,
+                         np.nan),
+        'low': np.where(np.isnan(prev_low) | (low < prev_low), low, np.nan),
+    })
+
+
+def _aggregate(df, labels, base):
+    inc = _increments(df, base)
+    price = df['price'].values
+    # 价格无效(如停牌为0)时不参与计算
+    price = np.where(price > 0, price, np.nan)
+    frame = pd.DataFrame({
+        '股票代码': df['code'].values,
+        '时间': labels.values,
+        'open': price,
+        'high': np.fmax(price, inc['high'].values),
+        'low': np.fmin(price, inc['low'].values),
+        'close': price,
+        '成交量': inc['volume'].values,
+        '成交额': inc['amount'].values,
+    })
+    grouped = frame.groupby(['股票代码', '时间'], sort=False)
+    bars = grouped.agg({
+        'open': 'first',
+        'high': 'max',
+        'low': 'min',
+        'close': 'last',
+        '成交量': 'sum',
+        '成交额': 'sum',
+    })
+    bars.columns = ['开盘', '最高', '最低', '收盘', '成交量', '成交额']
+    bars.reset_index(inplace=True)
+    return bars[BAR_COLUMNS]
+
+
+def _last_state(df):
+    """各代码最后快照的累计值"""
+    last = df.drop_duplicates('code', keep='last').set_index('code')
+    state = last[['volume', 'amount', 'high', 'low']].astype('float64')
+    state['date'] = last['time'].dt.normalize()
+    return state
+
+
+def build_bars(df, n=1, source='tct'):
+    """由快照生成K线
+
+    Arguments:
+        df {DataFrame} -- 快照数据
+
+    Keyword Arguments:
+        n {int} -- K线周期(分钟) (default: {1})
+        source {str} -- 数据源，参阅`SOURCES` (default: {'tct'})
+
+    Returns:
+        DataFrame -- K线数据
+    """
+    assert n in BAR_FREQS, f'K线周期只支持{BAR_FREQS}分钟'
+    df = _canonical(df, source)
+    if df.empty:
+        return pd.DataFrame(columns=BAR_COLUMNS)
+    return _aggregate(df, bar_labels(df['time'], n), None)
+
+
+class BarBuilder(object):
+    """增量生成K线
+
+    用法
+    >>> builder = BarBuilder(5)
+    >>> bars = builder.update(snapshot)
+    """
+    def __init__(self, n=1, source='tct', fp=None):
+        """初始化
+
+        Keyword Arguments:
+            n {int} -- K线周期(分钟) (default: {1})
+            source {str} -- 数据源，参阅`SOURCES` (default: {'tct'})
+            fp {Path} -- K线数据路径，默认为`bars_path(n, source)` (default: {None})
+        """
+        assert n in BAR_FREQS, f'K线周期只支持{BAR_FREQS}分钟'
+        self.n = n
+        self.source = source
+        self.file_path = bars_path(n, source) if fp is None else fp
+        self._state_fp = self.file_path.with_name(
+            f"{self.file_path.name}.state")
+        self._pending, self._base = self._load_state()
+
+    def _load_state(self):
+        try:
+            state = pd.read_pickle(self._state_fp)
+            return state['pending'], state['base']
+        except (FileNotFoundError, KeyError):
+            return None, None
+
+    def _save_state(self):
+        tmp = self._state_fp.with_name(
+            f".{self._state_fp.name}.{os.getpid()}")
+        pd.to_pickle({'pending': self._pending, 'base': self._base}, tmp)
+        os.replace(tmp, self._state_fp)
+
+    def _write(self, bars):
+        hdf = HDFData(self.file_path, 'a')
+        record = default_status.copy()
+        record['completed'] = True
+        record['index_col'] = '时间'
+        record['completed_time'] = pd.Timestamp.now()
+        kwargs = {
+            'data_columns': ['股票代码', '时间'],
+            'subset': ['股票代码', '时间'],
+        }
+        hdf.add(bars, record, kwargs)
+
+    def update(self, df, final=False):
+        """处理新到达的快照
+
+        Arguments:
+            df {DataFrame} -- 快照数据
+
+        Keyword Arguments:
+            final {bool} -- 是否输出全部K线(如收盘后) (default: {False})
+
+        Returns:
+            DataFrame -- 新完成的K线
+        """
+        df = _canonical(df, self.source)
+        if self._pending is not None and len(self._pending):
+            df = _sorted(pd.concat([self._pending, df], ignore_index=True))
+        if df.empty:
+            return pd.DataFrame(columns=BAR_COLUMNS)
+        labels = bar_labels(df['time'], self.n)
+        # 所有代码同时快照，最新快照时间之前结束的K线已完成
+        done = (labels <= df['time'].max()).values | final
+        bars = _aggregate(df[done], labels[done], self._base)
+        if done.any():
+            state = _last_state(df[done])
+            if self._base is not None:
+                state = pd.concat([self._base[~self._base.index.isin(
+                    state.index)], state])
+            self._base = state
+        self._pending = df[~done].reset_index(drop=True)
+        if len(bars):
+            self._write(bars)
+        self._save_state()
+        return bars
+
+
+def refresh_bars(df, source='tct', freqs=BAR_FREQS):
+    """以新快照增量更新各周期K线
+
+    Arguments:
+        df {DataFrame} -- 快照数据
+
+    Keyword Arguments:
+        source {str} -- 数据源 (default: {'tct'})
+        freqs {tuple} -- K线周期 (default: {BAR_FREQS})
+    """
+    for n in freqs:
+        BarBuilder(n, source).update(df)
@@ -0,0 +1,182 @@
+"""添加数据缓冲
+
+Notes:
+    1. 逐个代码或逐日添加的小块数据先缓存在内存，按文件合并后一次写入，
+       避免表中产生大量细小的数据块
+    2. 单个文件缓存行数或缓存时长达到阈值时写入，退出缓冲区时写入全部
+    3. 刷新记录随数据延迟写入，确保记录不超前于数据
+    4. 缓冲期间`HDFData`读取时合并尚未写入的数据
+
+用法
+>>> with buffered_writes():
+>>>     for code in codes:
+>>>         hdf.insert_by(df, record, kwargs, '股票代码', code)
+"""
+import copy
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# 单个文件缓存行数上限
+MAX_ROWS = 50000
+# 单个文件缓存时长上限(秒)
+MAX_SECONDS = 60
+
+_lock = threading.RLock()
+_current = None
+
+
+def _dtypes_of(df):
+    return tuple(zip(df.columns, df.dtypes.astype(str)))
+
+
+class _Pending(object):
+    """单个文件尚未写入的数据及记录"""
+    def __init__(self, writer, kwargs):
+        self.writer = writer
+        self.kwargs = kwargs
+        self.frames = []
+        self.rows = 0
+        self.record = None
+        self.since = time.time()
+
+    @property
+    def data(self):
+        """合并后的数据，无数据时为`None`"""
+        if not self.frames:
+            return None
+        if len(self.frames) == 1:
+            return self.frames[0]
+        return pd.concat(self.frames, sort=False)
+
+    def batches(self):
+        """按列类型一致的连续数据块合并，避免合并改变列类型导致写入失败"""
+        batch = []
+        for df in self.frames:
+            if batch and _dtypes_of(df) != _dtypes_of(batch[0]):
+                yield pd.concat(batch, sort=False)
+                batch = []
+            batch.append(df)
+        if batch:
+            yield pd.concat(batch, sort=False) if len(batch) > 1 else batch[0]
+
+
+class WriteBuffer(object):
+    """按文件合并添加数据的缓冲区"""
+    def __init__(self, max_rows=MAX_ROWS, max_seconds=MAX_SECONDS):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self._pending = {}
+        self._closed = False
+
+    def _get(self, writer, kwargs):
+        key = str(writer.file_path)
+        p = self._pending.get(key)
+        if p is None:
+            p = _Pending(writer, kwargs)
+            self._pending[key] = p
+        elif p.kwargs is None:
+            p.kwargs = kwargs
+        return p
+
+    def put(self, writer, data, kwargs):
+        """缓存添加数据
+
+        Arguments:
+            writer {HDFData} -- 数据对象
+            data {DataFrame} -- 添加的数据
+            kwargs {dict} -- 写入参数
+
+        Returns:
+            bool -- 是否已缓存(缓冲区关闭后为False，由调用方直接写入)
+        """
+        with _lock:
+            if self._closed:
+                return False
+            p = self._get(writer, kwargs)
+            p.frames.append(data)
+            p.rows += len(data)
+            full = p.rows >= self.max_rows
+            expired = time.time() - p.since >= self.max_seconds
+            if full or expired:
+                self.flush(writer.file_path)
+            return True
+
+    def set_record(self, writer, record):
+        """缓存刷新记录
+
+        Returns:
+            bool -- 是否已缓存
+        """
+        with _lock:
+            if self._closed:
+                return False
+            p = self._get(writer, None)
+            p.record = copy.deepcopy(dict(record))
+            return True
+
+    def pending(self, fp):
+        """文件尚未写入部分，不存在时为`None`"""
+        with _lock:
+            return self._pending.get(str(fp))
+
+    def flush(self, fp=None):
+        """写入缓存数据及记录
+
+        Keyword Arguments:
+            fp {Path} -- 文件路径，`None`代表全部 (default: {None})
+        """
+        error = None
+        with _lock:
+            keys = list(self._pending) if fp is None else [str(fp)]
+            for key in keys:
+                p = self._pending.pop(key, None)
+                if p is None:
+                    continue
+                try:
+                    for data in p.batches():
+                        p.writer._write_append(data, p.kwargs.copy())
+                except Exception as e:
+                    # 数据写入失败时不写入记录，下次刷新时重新提取
+                    error = error or e
+                    continue
+                if p.record is not None:
+                    p.writer._write_record(p.record)
+        if error is not None:
+            raise error
+
+    def close(self):
+        """写入全部缓存并关闭"""
+        with _lock:
+            self._closed = True
+            self.flush()
+
+
+def current_buffer():
+    """当前有效的缓冲区，未启用时为`None`"""
+    return _current
+
+
+@contextmanager
+def buffered_writes(max_rows=MAX_ROWS, max_seconds=MAX_SECONDS):
+    """启用添加数据缓冲(嵌套时沿用外层缓冲区)
+
+    Keyword Arguments:
+        max_rows {int} -- 单个文件缓存行数上限 (default: {MAX_ROWS})
+        max_seconds {int} -- 单个文件缓存时长上限(秒) (default: {MAX_SECONDS})
+    """
+    global _current
+    with _lock:
+        outer = _current is None
+        if outer:
+            _current = WriteBuffer(max_rows, max_seconds)
+        buf = _current
+    try:
+        yield buf
+    finally:
+        if outer:
+            with _lock:
+                _current = None
+                buf.close()
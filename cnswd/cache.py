@@ -0,0 +1,179 @@
+"""查询结果缓存
+
+Notes:
+    1. 以(文件路径, 查询条件)为键缓存查询结果，同时记录文件存储状态
+    2. 文件刷新后存储状态改变，对应缓存自动失效
+    3. 内存占用超出上限时淘汰最久未使用的结果；启用磁盘溢出时，
+       淘汰的结果写入`cache`目录，之后命中时重新载入内存
+    4. 返回结果的副本，调用方修改不影响缓存
+    5. 查询异常时返回的空表不缓存
+"""
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from .setting.config import DEFAULT_CONFIG
+from .storage import get_engine
+from .utils import data_root
+
+MB = 1024 * 1024
+
+
+def _nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class QueryCache(object):
+    """查询结果缓存"""
+    def __init__(self, max_bytes=None, spill_bytes=None, spill_dir=None):
+        """初始化
+
+        Keyword Arguments:
+            max_bytes {int} -- 内存上限(字节)，默认按配置`cache_memory` (default: {None})
+            spill_bytes {int} -- 磁盘溢出上限(字节)，0代表不溢出，默认按配置`cache_disk` (default: {None})
+            spill_dir {Path} -- 磁盘溢出目录 (default: {None})
+        """
+        if max_bytes is None:
+            max_bytes = DEFAULT_CONFIG.get('cache_memory', 256) * MB
+        if spill_bytes is None:
+            spill_bytes = DEFAULT_CONFIG.get('cache_disk', 0) * MB
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self._spill_dir = spill_dir
+        # {键: (存储状态, 数据框, 字节数)}
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        """内存占用(字节)"""
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def spill_dir(self):
+        if self._spill_dir is None:
+            self._spill_dir = data_root('cache')
+        return self._spill_dir
+
+    def _spill_path(self, key):
+        name = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return self.spill_dir / f'{name}.pkl'
+
+    def _spill(self, key, stamp, df):
+        """淘汰的结果写入磁盘"""
+        if not self.spill_bytes:
+            return
+        fp = self._spill_path(key)
+        tmp = fp.with_name(f".{fp.name}.{os.getpid()}")
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((key, stamp, df), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, fp)
+        except Exception:
+            if tmp.exists():
+                tmp.unlink()
+            return
+        self._trim_spill()
+
+    def _trim_spill(self):
+        """磁盘占用超出上限时删除最早写入的文件"""
+        files = sorted(self.spill_dir.glob('*.pkl'),
+                       key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        for p in files:
+            if total <= self.spill_bytes:
+                break
+            total -= p.stat().st_size
+            p.unlink()
+
+    def _load_spilled(self, key, stamp):
+        if not self.spill_bytes:
+            return None
+        fp = self._spill_path(key)
+        try:
+            with open(fp, 'rb') as f:
+                cached_key, cached_stamp, df = pickle.load(f)
+        except Exception:
+            return None
+        if cached_key != key or cached_stamp != stamp:
+            fp.unlink()
+            return None
+        return df
+
+    def _put(self, key, stamp, df):
+        nbytes = _nbytes(df)
+        if nbytes > self.max_bytes:
+            # 超出上限的单个结果不缓存在内存
+            self._spill(key, stamp, df)
+            return
+        self._entries[key] = (stamp, df, nbytes)
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            old_key, (old_stamp, old_df, old_nbytes) = self._entries.popitem(
+                last=False)
+            self._nbytes -= old_nbytes
+            self._spill(old_key, old_stamp, old_df)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[2]
+        return entry
+
+    def get_or_load(self, fp, key, loader):
+        """读取缓存结果，不存在或失效时调用`loader`
+
+        Arguments:
+            fp {Path or list} -- 数据路径(扩展名.h5)，整合多个文件时为路径列表
+            key {tuple} -- 查询条件，须可哈希
+            loader {callable} -- 无参数的查询函数
+
+        Returns:
+            DataFrame -- 查询结果(副本)
+        """
+        fps = fp if isinstance(fp, (list, tuple)) else [fp]
+        stamp = tuple(get_engine(p).stamp(p) for p in fps)
+        if None in stamp or not self.max_bytes:
+            return loader()
+        key = (tuple(str(p) for p in fps), key)
+        with self._lock:
+            entry = self._pop(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries[key] = entry
+                self._nbytes += entry[2]
+                self.hits += 1
+                return entry[1].copy()
+            df = self._load_spilled(key, stamp)
+            if df is not None:
+                self._put(key, stamp, df)
+                self.hits += 1
+                return df.copy()
+        self.misses += 1
+        df = loader()
+        # 查询异常返回的空表不缓存(参阅`query_utils.query`)
+        if isinstance(df, pd.DataFrame) and not df.attrs.get('query_error'):
+            with self._lock:
+                self._put(key, stamp, df.copy())
+        return df
+
+    def clear(self):
+        """清除内存及磁盘缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            if self._spill_dir is not None or self.spill_bytes:
+                for p in self.spill_dir.glob('*.pkl'):
+                    p.unlink()
+
+
+query_cache = QueryCache()
@@ -21,6 +21,7 @@ from selenium.webdriver.support.ui import Select, WebDriverWait
 
 from .._exceptions import MaybeChanged, RetryException
 from .._selenium import make_headless_browser
+from ..ratelimit import rate_limit
 from ..setting.config import POLL_FREQUENCY, TIMEOUT
 from ..utils.log_utils import make_logger
 from ..utils.pd_utils import _concat
@@ -96,6 +97,7 @@ class SZXPage(object):
         # 如果重复加载同一网址，耗时约为1ms
         self.logger.info(self.api_name)
         url = HOME_URL_FMT.format(self.api_e_name)
+        rate_limit(url)
         self.driver.get(url)
         msg = f"首次加载{self.api_name}超时"
         # 特定元素可见，完成首次页面加载
@@ -217,6 +219,8 @@ class SZXPage(object):
         input_elem = self.driver.find_element_by_css_selector(input_css)
         input_elem.clear()
         input_elem.send_keys(input_text)
+        # 每次查询均请求数据，按主机限速
+        rate_limit(self.driver.current_url)
         self.driver.find_element_by_css_selector(query_bnt_css).click()
 
     def _no_data(self):
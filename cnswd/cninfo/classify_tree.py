@@ -7,6 +7,7 @@ import pandas as pd
 from selenium.webdriver.support.ui import Select, WebDriverWait
 
 from .._seleniumwire import make_headless_browser
+from ..ratelimit import rate_limit
 from ..setting.config import POLL_FREQUENCY, TIMEOUT
 from ..utils.log_utils import make_logger
 from ..utils.pd_utils import _concat
@@ -118,6 +119,7 @@ class ClassifyTree(object):
         self.wait = WebDriverWait(self.driver, TIMEOUT, POLL_FREQUENCY)
         name = f"{self.api_name}{str(os.getpid()).zfill(6)}"
         self.logger = make_logger(name, self.log_to_file)
+        rate_limit(url)
         self.driver.get(url)
         # 确保加载完成
         msg = f"首次加载{self.api_name}超时"
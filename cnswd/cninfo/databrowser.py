@@ -10,6 +10,7 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select, WebDriverWait
 
 from .._seleniumwire import make_headless_browser
+from ..ratelimit import rate_limit
 from ..setting.config import DB_CONFIG, POLL_FREQUENCY, TIMEOUT
 from ..utils import ensure_list, make_logger, sanitize_dates
 from ..utils.loop_utils import loop_codes, loop_period_by
@@ -40,6 +41,7 @@ class DataBrowser(object):
         self.wait = WebDriverWait(self.driver, TIMEOUT, POLL_FREQUENCY)
         name = f"{self.api_name}{str(os.getpid()).zfill(6)}"
         self.logger = make_logger(name, self.log_to_file)
+        rate_limit(url)
         self.driver.get(url)
         # 确保加载完成
         msg = f"首次加载{self.api_name}超时"
@@ -191,6 +193,8 @@ class DataBrowser(object):
         self.set_t2_value(t2)
         # 点击预览按钮
         btn = '.stock-search'
+        # 每次预览均请求数据，按主机限速
+        rate_limit(self.driver.current_url)
         self.driver.find_element_by_css_selector(btn).click()
         self._before_read()
         return self._read_json_data()
@@ -24,6 +24,7 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select, WebDriverWait
 
 from .._seleniumwire import make_headless_browser
+from ..ratelimit import rate_limit
 from ..setting.config import POLL_FREQUENCY, TIMEOUT, TS_CONFIG
 from ..utils import make_logger
 from ..utils.loop_utils import loop_codes, loop_period_by
@@ -65,6 +66,7 @@ class ThematicStatistics(object):
         self.wait = WebDriverWait(self.driver, TIMEOUT, POLL_FREQUENCY)
         name = f"{self.api_name}{str(os.getpid()).zfill(6)}"
         self.logger = make_logger(name, log_to_file)
+        rate_limit(url)
         self.driver.get(url)
         # 首次加载耗时
         self.driver.implicitly_wait(1)
@@ -152,6 +154,8 @@ class ThematicStatistics(object):
             # self.driver.save_screenshot('t2.png')
 
     def _before_read(self):
+        # 每次预览均请求数据，按主机限速
+        rate_limit(self.driver.current_url)
         # 预览数据
         # 专题统计中，部分项目无命令按钮
         if any(self.config[self.current_level]['css']):
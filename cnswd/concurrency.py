@@ -0,0 +1,188 @@
+"""自适应并发
+
+Notes:
+    1. 按数据来源(主机后缀)分别控制并发数，同一进程内共享
+    2. 加性增：请求成功且耗时正常时，每完成约一轮(当前并发数个)请求，并发数加1
+    3. 乘性减：连接被重置、超时或HTTP 403/429/503时，并发数乘以`backoff`；
+       同一批并发请求的连续失败只减一次(减少之前已开始的请求失败时不再减少)
+    4. 成功但耗时超过平均耗时`slow_factor`倍时维持并发数不变
+    5. 协程使用`slot`；动态任务调度(`scheduler.run_tasks`)以`capacity`限制同时执行的任务数
+    6. 初始及最大并发数按来源配置，工作进程与协程分别配置、分别控制
+       (参阅`CONCURRENCY_LIMITS`、`ASYNC_CONCURRENCY_LIMITS`)
+
+用法
+>>> limiter = get_limiter('http://www.cninfo.com.cn')
+>>> async with limiter.slot():
+>>>     await session.post(url)
+"""
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+
+from .setting.config import ASYNC_CONCURRENCY_LIMITS, CONCURRENCY_LIMITS
+from .utils import make_logger
+from .utils.tools import get_server_name, match_host
+
+logger = make_logger('自适应并发')
+
+# 代表来源过载的异常
+OVERLOAD_ERRORS = (ConnectionResetError, ConnectionAbortedError, TimeoutError,
+                   asyncio.TimeoutError)
+# 代表来源过载的HTTP状态
+OVERLOAD_STATUS = (403, 429, 503)
+# 跨进程传递的异常为文本
+_OVERLOAD_PATTERN = re.compile(r'ConnectionResetError|ConnectionAbortedError|'
+                               r'TimeoutError|ServerDisconnectedError|'
+                               r'Connection aborted|远程主机强迫关闭|'
+                               r'\b(403|429|503)\b')
+
+# 未配置来源的(初始并发数, 最大并发数)
+DEFAULT_LIMITS = (4, 16)
+
+# 进程内并发控制 {(来源, 是否协程): AdaptiveLimiter}
+_limiters = {}
+
+
+def is_overload(error):
+    """异常是否代表来源过载
+
+    Arguments:
+        error {Exception or str} -- 异常或异常文本
+
+    Returns:
+        bool -- 连接重置、超时或HTTP 403/429/503时为真
+    """
+    if isinstance(error, str):
+        return bool(_OVERLOAD_PATTERN.search(error))
+    if isinstance(error, OVERLOAD_ERRORS):
+        return True
+    if getattr(error, 'status', None) in OVERLOAD_STATUS:
+        return True
+    return bool(_OVERLOAD_PATTERN.search(f'{error!r}'))
+
+
+class AdaptiveLimiter(object):
+    """AIMD并发控制
+
+    Arguments:
+        name {str} -- 来源名称
+
+    Keyword Arguments:
+        initial {int} -- 初始并发数 (default: {4})
+        maximum {int} -- 最大并发数 (default: {16})
+        minimum {int} -- 最小并发数 (default: {1})
+        backoff {float} -- 过载时并发数乘数 (default: {0.5})
+        slow_factor {float} -- 耗时超过平均耗时的倍数时不增加 (default: {3.})
+    """
+    def __init__(self,
+                 name,
+                 initial=4,
+                 maximum=16,
+                 minimum=1,
+                 backoff=0.5,
+                 slow_factor=3.):
+        assert 1 <= minimum <= initial <= maximum, '必须满足 1 <= 最小 <= 初始 <= 最大'
+        self.name = name
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.backoff = backoff
+        self.slow_factor = slow_factor
+        self.active = 0
+        self._latency = None
+        self._last_decrease = 0.
+        self._cond = None
+        self._loop = None
+
+    def __repr__(self):
+        return f'{self.name} 并发数{self.capacity}(上限{self.maximum})'
+
+    @property
+    def capacity(self):
+        """当前允许的并发数"""
+        return max(self.minimum, int(self.limit))
+
+    def on_success(self, latency):
+        """请求成功
+
+        Arguments:
+            latency {float} -- 请求耗时(秒)
+        """
+        avg = self._latency
+        self._latency = latency if avg is None else 0.9 * avg + 0.1 * latency
+        if avg is not None and latency > avg * self.slow_factor:
+            return
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_error(self, error, started):
+        """请求失败
+
+        Arguments:
+            error {Exception or str} -- 异常或异常文本
+            started {float} -- 请求开始时间(`time.time()`)
+
+        Returns:
+            bool -- 是否为过载错误
+        """
+        if not is_overload(error):
+            return False
+        # 减少之前已开始的请求属于同一批，不再重复减少
+        if started >= self._last_decrease:
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self._last_decrease = time.time()
+            logger.info(f'{self!r} {error!r}')
+        return True
+
+    def _condition(self):
+        # 条件变量绑定事件循环，每次`asyncio.run`均为新的事件循环
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._cond = asyncio.Condition()
+            self._loop = loop
+            self.active = 0
+        return self._cond
+
+    @asynccontextmanager
+    async def slot(self):
+        """协程并发槽位，按结果调整并发数"""
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.active < self.capacity)
+            self.active += 1
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.on_error(e, started)
+            raise
+        else:
+            self.on_success(time.time() - started)
+        finally:
+            async with cond:
+                self.active -= 1
+                cond.notify_all()
+
+
+def get_limiter(source, coroutine=False):
+    """来源的并发控制
+
+    Arguments:
+        source {str} -- 网址或主机名称
+
+    Keyword Arguments:
+        coroutine {bool} -- 是否用于协程，协程的并发数远高于工作进程 (default: {False})
+
+    Returns:
+        AdaptiveLimiter -- 同一来源在进程内共享
+    """
+    limits = ASYNC_CONCURRENCY_LIMITS if coroutine else CONCURRENCY_LIMITS
+    key = match_host(source, limits)
+    if key is None:
+        key = get_server_name(source) if '://' in source else source
+    limiter = _limiters.get((key, coroutine))
+    if limiter is None:
+        initial, maximum = limits.get(key, DEFAULT_LIMITS)
+        limiter = AdaptiveLimiter(key, initial, maximum)
+        _limiters[(key, coroutine)] = limiter
+    return limiter
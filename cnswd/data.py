@@ -8,17 +8,29 @@ Notes:
     4. 记录保持在'record'
     5. `last_date`专门用于计算start
     6. `next_time`指示下一次可更新时间
+    7. 记录、行数、列名称及索引列最值缓存在元数据(参阅`meta.py`)
+    8. 通过存储引擎读写，支持`hdf`与`parquet`(参阅`storage.py`)
+    9. 无索引列的添加模式使用唯一性键集合去重，只添加新增行，不再重写
+    10. 启用`buffered_writes`时添加数据按文件合并后写入(参阅`buffer.py`)
+    11. 启用写入服务的进程，写入转发至单一写入进程执行(参阅`writer.py`)
+    12. 写入后为数据列创建完整排序索引(CSI)，此后添加数据时自动更新
 
 pd.HDFStore(fp, 'w') 会重写已经存在的数据！！！
 """
 
+import copy
 import warnings
 
 import pandas as pd
 
+from .buffer import current_buffer
+from .meta import HDFMeta, KeyIndex
+from .setting.config import DEFAULT_CONFIG
 from .setting.constants import MARKET_START
+from .storage import SCAN_CHUNKSIZE, codec_kwargs, get_engine, store_pool
 from .utils import make_logger
-from .query_utils import Ops, query, query_stmt
+from .query_utils import Ops, filter_frame, query, query_stmt
+from .writer import current_writer, submit
 
 default_status = {
     'completed': False,  # 网络提取状态，如途中发生异常为False
@@ -37,21 +49,25 @@ default_status = {
 to_hdf_kwargs = {
     'append': True,
     'format': 'table',
-    'complevel': 9,
-    'complib': 'blosc:blosclz',
+    # 默认压缩方式，数据集可另行指定(参阅`DATASET_CODECS`)
+    **codec_kwargs(DEFAULT_CONFIG.get('codec', 'blosclz')),
     'ignore_index': True,
 }
 
 
 class HDFData(object):
     """h5格式存储的数据及刷新记录"""
-    def __init__(self, fp, mode):
+    def __init__(self, fp, mode, engine=None, partition=None):
         """初始数据对象
         
         Arguments:
             object {Path} -- 数据存放路径（带扩展名.h5）
             fp {Path} -- 数据存放路径（带扩展名.h5）
             mode {str} -- 数据对象写入方式。只支持添加模式`a`和`w`覆盖模式。
+
+        Keyword Arguments:
+            engine {str} -- 存储引擎名称，默认按配置及现有文件确定 (default: {None})
+            partition {tuple} -- (索引列, 分区频率)，新建数据时按期间分区存储 (default: {None})
         """
         assert fp.name.endswith('.h5'), '扩展名必须为`.h5`'
         self._fp = fp
@@ -59,6 +75,9 @@ class HDFData(object):
         self._mode = mode
         self.logger = make_logger('HDFData')
         self._codes = None
+        self._spec = (fp, mode, engine, partition)
+        self._engine = get_engine(fp, engine, partition)
+        self._meta = HDFMeta(fp, self._engine)
 
     @property
     def file_path(self):
@@ -70,31 +89,85 @@ class HDFData(object):
         """读写模式"""
         return self._mode
 
+    @property
+    def engine(self):
+        """存储引擎"""
+        return self._engine
+
+    def _pending(self):
+        """缓冲区中尚未写入的部分，不存在时为`None`"""
+        buf = current_buffer()
+        if buf is None:
+            return None
+        return buf.pending(self._fp)
+
+    def _pending_data(self):
+        p = self._pending()
+        return None if p is None else p.data
+
     @property
     def data(self):
         """数据框对象"""
-        return pd.read_hdf(self._fp, 'data')
+        pending = self._pending_data()
+        if pending is None:
+            return self._engine.select(self._fp)
+        try:
+            df = self._engine.select(self._fp)
+        except (FileNotFoundError, KeyError):
+            return pending
+        return pd.concat([df, pending], sort=False)
+
+    def iter_data(self, stmt=[], columns=None, chunksize=SCAN_CHUNKSIZE):
+        """分块读取数据，缓冲区中尚未写入的部分作为最后一块
+
+        Keyword Arguments:
+            stmt {list} -- `query_stmt`生成的查询表达式 (default: {[]})
+            columns {list} -- 列名称，`None`代表全部 (default: {None})
+            chunksize {int} -- 每块行数 (default: {SCAN_CHUNKSIZE})
+
+        Returns:
+            generator -- 数据块
+        """
+        pending = self._pending_data()
+        if self._engine.exists(self._fp):
+            try:
+                yield from self._engine.iter_select(self._fp, stmt, columns,
+                                                    chunksize)
+            except KeyError:
+                pass
+        if pending is not None:
+            pending = filter_frame(pending, stmt)
+            if columns is not None:
+                pending = pending[columns]
+            if len(pending):
+                yield pending
 
     @property
     def record(self):
         """刷新记录"""
-        try:
-            self._record = pd.read_hdf(self._fp, 'record').to_dict()
-        except Exception:
+        p = self._pending()
+        if p is not None and p.record is not None:
+            self._record = copy.deepcopy(p.record)
+        else:
+            self._record = self._meta.record
+        if self._record is None:
             self._record = default_status.copy()
         return self._record
 
     @property
     def nrows(self):
         """数据行数"""
-        try:
-            with pd.HDFStore(self._fp, 'r') as store:
-                try:
-                    return store.get_storer('data').nrows
-                except Exception:
-                    return 0
-        except Exception:
-            return 0
+        p = self._pending()
+        return self._meta.nrows + (0 if p is None else p.rows)
+
+    @property
+    def columns(self):
+        """数据列名称"""
+        columns = self._meta.columns
+        pending = self._pending_data()
+        if not columns and pending is not None:
+            columns = pending.columns.tolist()
+        return columns
 
     def get_codes(self, code_col='股票代码', force=False):
         """股票代码
@@ -108,7 +181,12 @@ class HDFData(object):
         """
         if self._codes is None or force:
             try:
-                self._codes = self.data[code_col].unique().tolist()
+                # 元数据维护的代码集合，首次查询时分块扫描单列
+                codes = self._meta.get_distinct(code_col, force)
+                pending = self._pending_data()
+                if pending is not None:
+                    codes |= set(pending[code_col].dropna())
+                self._codes = sorted(codes)
             except Exception:
                 self._codes = []
         return self._codes
@@ -129,12 +207,33 @@ class HDFData(object):
         else:
             return self.record['next_time']
 
+    def _get_bounds(self, index_col):
+        """索引列最小值与最大值(含缓冲区尚未写入部分)"""
+        lower, upper = None, None
+        if self._meta.nrows:
+            lower, upper = self._meta.get_bounds(index_col)
+        pending = self._pending_data()
+        if pending is not None:
+            s = pending[index_col].dropna()
+            if not s.empty:
+                lower = s.min() if lower is None else min(lower, s.min())
+                upper = s.max() if upper is None else max(upper, s.max())
+        return lower, upper
+
     def get_max_index(self, index_col):
         """当前索引最大值"""
         if self._mode == 'w':
             return None
         if self.has_data:
-            return max(self.data[index_col])
+            return self._get_bounds(index_col)[1]
+        return None
+
+    def get_min_index(self, index_col):
+        """当前索引最小值"""
+        if self._mode == 'w':
+            return None
+        if self.has_data:
+            return self._get_bounds(index_col)[0]
         return None
 
     def _ensure_pop_index(self, df):
@@ -160,7 +259,14 @@ class HDFData(object):
         ]
         stmt = query_stmt(*args)
         fp = self.file_path
-        return query(fp, stmt)
+        pending = self._pending_data()
+        if pending is None:
+            return query(fp, stmt)
+        try:
+            old = query(fp, stmt)
+        except (FileNotFoundError, ValueError):
+            old = pd.DataFrame()
+        return pd.concat([old, filter_frame(pending, stmt)], sort=False)
 
     def _check_valid(self, record):
         if self.appendable:
@@ -169,34 +275,40 @@ class HDFData(object):
 
     def _set_record(self, record):
         """设置刷新记录(仅当存在数据对象时有效)"""
-        s = pd.Series(record)
+        buf = current_buffer()
+        if buf is not None and buf.set_record(self, record):
+            return
+        self._write_record(record)
+
+    def _write_record(self, record):
+        prev = self._meta.load()
         # 刷新方式写入记录
-        s.to_hdf(self._fp, 'record', append=False)
+        self._engine.write_record(self._fp, record)
+        self._meta.after_record(prev, record)
+        KeyIndex.after_record(self._fp, prev['stamp'], self._engine)
+
+    def flush(self):
+        """写入缓冲区中本文件尚未写入的数据及记录"""
+        buf = current_buffer()
+        if buf is not None:
+            buf.flush(self._fp)
 
     def _rewrite(self, df, record, kwargs):
         """重写"""
-        data_columns = kwargs.get('data_columns', True)
+        self.flush()
         if not df.empty:
-            df.to_hdf(
-                self._fp,
-                'data',
-                mode='w',  # 删除现有文件
-                append=False,
-                # ignore_index=True,
-                data_columns=data_columns,
-                format='table')
+            # 删除现有数据及记录
+            self._engine.rewrite(self._fp, df, kwargs)
+            self._ensure_index(kwargs)
+            self._meta.after_rewrite(df)
+            KeyIndex.invalidate(self._fp)
             self.logger.info(f"写入{len(df)}行 -> {self._fp}")
         self._set_record(record)
 
     def _to_hdf(self, data, kwargs, action):
         if data.empty:
             return
-        if action == 'rewrite':
-            if self._fp.exists():
-                self._fp.unlink()
-        elif action == 'append':
-            pass
-        else:
+        if action not in ('rewrite', 'append'):
             raise ValueError(f'写入hdf不支持{action}')
         data = self._ensure_pop_index(data)
         kwargs['append'] = True
@@ -204,32 +316,67 @@ class HDFData(object):
             kwargs.pop('subset')
         if 'ignore_index' in kwargs.keys():
             kwargs.pop('ignore_index')
-        data.to_hdf(self._fp, 'data', **kwargs)
+        if action == 'append':
+            buf = current_buffer()
+            if buf is not None and buf.put(self, data, kwargs.copy()):
+                return
+            self._write_append(data, kwargs)
+        else:
+            self.flush()
+            self._engine.remove(self._fp)
+            self._engine.append(self._fp, data, kwargs)
+            self._meta.after_rewrite(data)
+            KeyIndex.invalidate(self._fp)
+
+    def _ensure_index(self, kwargs):
+        """为写入参数中的数据列维护完整排序索引"""
+        data_columns = kwargs.get('data_columns')
+        if not data_columns:
+            return
+        if data_columns is True:
+            data_columns = None
+        try:
+            self._engine.ensure_index(self._fp, data_columns)
+        except Exception as e:
+            # 索引只影响查询速度，不影响写入
+            self.logger.warning(f"创建索引失败 {self._fp} {e!r}")
+
+    def _write_append(self, data, kwargs):
+        prev = self._meta.load()
+        self._engine.append(self._fp, data, kwargs)
+        self._ensure_index(kwargs)
+        self._meta.after_append(prev, data)
+        KeyIndex.after_append(self._fp, prev['stamp'], data, self._engine)
 
     def _get_to_add(self, df, record, subset):
         """截取添加数据"""
-        if self.has_data:
-            index_col = record['index_col']
-            if index_col is None:
-                old = self.data
-                keep = 'first'
-            else:
-                keep = False
-                old_max_index = self.get_max_index(index_col)
-                # 如近期公布的财务报告，原记录最大值 2019-4季度
-                max_index = max(old_max_index, min(df[index_col]))
-                old = self.get_data_after(index_col, max_index)
-                cond = df[index_col] < max_index
-                nrows = len(df[cond])
-                if nrows:
-                    msg = f'要插入的数据中包含{nrows}行历史数据，{index_col} < {max_index}， 这会导致插入重复值'
-                    warnings.warn(msg, UserWarning)
-            merged = pd.concat([old, df], sort=False)
-            # 不保留重复部分
-            to_add = merged.drop_duplicates(subset, keep=keep)
-            return to_add, 'rewrite' if keep == 'first' else 'append'
-        else:
+        if not self.has_data:
             return df, 'append'
+        index_col = record['index_col']
+        if index_col is None:
+            # 以唯一性键集合去重，无需读取及重写原数据
+            keys = KeyIndex(self._fp, subset, self._engine)
+            to_add = keys.get_new(df)
+            pending = self._pending_data()
+            if pending is not None and not to_add.empty:
+                # 排除缓冲区中尚未写入的键
+                old = set(KeyIndex.keys_of(pending, keys.subset))
+                new = KeyIndex.keys_of(to_add, keys.subset)
+                to_add = to_add[[k not in old for k in new]]
+            return to_add, 'append'
+        old_max_index = self.get_max_index(index_col)
+        # 如近期公布的财务报告，原记录最大值 2019-4季度
+        max_index = max(old_max_index, min(df[index_col]))
+        old = self.get_data_after(index_col, max_index)
+        cond = df[index_col] < max_index
+        nrows = len(df[cond])
+        if nrows:
+            msg = f'要插入的数据中包含{nrows}行历史数据，{index_col} < {max_index}， 这会导致插入重复值'
+            warnings.warn(msg, UserWarning)
+        merged = pd.concat([old, df], sort=False)
+        # 不保留重复部分
+        to_add = merged.drop_duplicates(subset, keep=False)
+        return to_add, 'append'
 
     def _get_to_add_by(self, df, record, by, value):
         """截取添加数据"""
@@ -270,10 +417,21 @@ class HDFData(object):
             record['max_index'] = max_index
         self._set_record(record)
 
+    def _forward(self, method, *args):
+        """启用写入服务时转发至写入进程"""
+        if current_writer() is None:
+            return False
+        # 本进程不得持有该文件的句柄，否则写入进程无法打开文件
+        store_pool.release(self._fp)
+        submit(self._spec, method, args)
+        return True
+
     def add(self, df, record, kwargs={}):
         """添加或重写数据及记录"""
         if not record['completed']:
             return
+        if self._forward('add', df, record, kwargs):
+            return
         default = to_hdf_kwargs.copy()
         default.update(kwargs)
         if self.appendable:
@@ -285,6 +443,8 @@ class HDFData(object):
         """插入数据及记录"""
         if not record['completed']:
             return
+        if self._forward('insert', df, record, kwargs):
+            return
         default = to_hdf_kwargs.copy()
         default.update(kwargs)
         index_col = record['index_col']
@@ -305,6 +465,8 @@ class HDFData(object):
         self._set_record(record)
 
     def insert_by(self, df, record, kwargs, by, value):
+        if self._forward('insert_by', df, record, kwargs, by, value):
+            return
         default = to_hdf_kwargs.copy()
         default.update(kwargs)
         kwargs['append'] = True
@@ -326,13 +488,51 @@ class HDFData(object):
             self.logger.info(f"添加{rows}行 -> {self._fp}")
         self._set_record(record)
 
+    def compact(self, sort_by=None, codec=None):
+        """整理存储碎片
+
+        按列排序后以合适的块大小重写并重建索引，数据内容及记录不变
+
+        Keyword Arguments:
+            sort_by {list} -- 排序列，默认为(`股票代码`, 索引列)中存在的列 (default: {None})
+            codec {str} -- 压缩方式，`None`代表保持原压缩方式 (default: {None})
+        """
+        self.flush()
+        if not self.has_data:
+            return
+        if sort_by is None:
+            sort_by = ['股票代码', self.record['index_col']]
+        sort_by = [c for c in sort_by if c in self.columns]
+        prev = self._meta.load()
+        kwargs = {} if codec is None else codec_kwargs(codec)
+        self._engine.compact(self._fp, sort_by, kwargs)
+        self._meta.touch(prev)
+        KeyIndex.invalidate(self._fp)
+
     def create_table_index(self, data_columns):
         """创建索引"""
         if data_columns is None:
             return
-        store = pd.HDFStore(self._fp)
-        store.create_table_index('data',
-                                 columns=data_columns,
-                                 optlevel=9,
-                                 kind='full')
-        store.close()
+        prev = self._meta.load()
+        self._engine.create_index(self._fp, data_columns)
+        self._meta.touch(prev)
+        KeyIndex.after_record(self._fp, prev['stamp'], self._engine)
+
+    def ensure_index(self, data_columns=None):
+        """为缺少完整排序索引(CSI)的数据列创建索引
+
+        Keyword Arguments:
+            data_columns {list} -- 数据列，`None`代表全部 (default: {None})
+
+        Returns:
+            list -- 新建索引的列
+        """
+        self.flush()
+        if not self.has_data:
+            return []
+        prev = self._meta.load()
+        created = self._engine.ensure_index(self._fp, data_columns)
+        if created:
+            self._meta.touch(prev)
+            KeyIndex.after_record(self._fp, prev['stamp'], self._engine)
+        return created
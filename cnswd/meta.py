@@ -0,0 +1,426 @@
+"""h5文件元数据
+
+Notes:
+    1. 元数据包括：刷新记录、数据行数、列名称、列最小值与最大值、列唯一值集合
+    2. 元数据保存在进程内存及同目录下的附属文件`{文件名}.meta`
+    3. 以存储状态(如h5文件修改时间及大小)判断元数据是否有效，失效时重新读取
+    4. 写入数据或记录后更新元数据，添加判断无需再次打开h5文件
+    5. 无索引列的添加模式以唯一性键集合去重，保存在附属文件`{文件名}.keys`，
+       以追加方式记录每次添加的键，写入成本与新增数据量成正比
+    6. 写入刷新记录、创建索引等不改变数据的操作同样追加存储状态，键集合无需重建
+"""
+import copy
+import os
+import pickle
+
+import pandas as pd
+
+from .storage import get_engine
+from .utils import ensure_list
+
+
+def _empty_meta():
+    return {
+        'stamp': None,  # 存储状态(参阅`StorageEngine.stamp`)
+        'record': None,  # 刷新记录
+        'nrows': 0,  # 数据行数
+        'columns': [],  # 列名称
+        'bounds': {},  # {列名称: (最小值, 最大值)}
+        'distinct': {},  # {列名称: 唯一值集合}
+    }
+
+
+def _bounds_of(s):
+    """列的最小值与最大值"""
+    s = s.dropna()
+    if s.empty:
+        return (None, None)
+    return (s.min(), s.max())
+
+
+def _distinct_of(s):
+    """列的唯一值集合"""
+    return set(s.dropna().unique().tolist())
+
+
+def _merge_bounds(old, new):
+    """合并最小值与最大值"""
+    mins = [x[0] for x in (old, new) if x[0] is not None]
+    maxs = [x[1] for x in (old, new) if x[1] is not None]
+    return (min(mins) if mins else None, max(maxs) if maxs else None)
+
+
+class HDFMeta(object):
+    """h5文件元数据缓存"""
+    # 进程内缓存 {文件路径: 元数据}
+    _cache = {}
+
+    def __init__(self, fp, engine=None):
+        self._fp = fp
+        self._meta_fp = fp.with_name(f"{fp.name}.meta")
+        self._key = str(fp)
+        self._engine = engine or get_engine(fp)
+
+    @property
+    def file_path(self):
+        """附属文件路径"""
+        return self._meta_fp
+
+    def _stamp(self):
+        return self._engine.stamp(self._fp)
+
+    def _read_sidecar(self):
+        try:
+            with open(self._meta_fp, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _write_sidecar(self, meta):
+        tmp = self._meta_fp.with_name(f"{self._meta_fp.name}.{os.getpid()}")
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(meta, f)
+            os.replace(tmp, self._meta_fp)
+        except Exception:
+            # 附属文件仅为缓存，写入失败不影响数据
+            if tmp.exists():
+                tmp.unlink()
+
+    def _build(self, stamp):
+        """读取h5文件生成元数据"""
+        meta = _empty_meta()
+        meta['stamp'] = stamp
+        if stamp is None:
+            return meta
+        meta.update(self._engine.describe(self._fp))
+        return meta
+
+    def _save(self, meta):
+        self._cache[self._key] = meta
+        if meta['stamp'] is not None:
+            self._write_sidecar(meta)
+
+    def load(self):
+        """有效元数据"""
+        stamp = self._stamp()
+        meta = self._cache.get(self._key)
+        if meta is not None and meta['stamp'] == stamp:
+            return meta
+        meta = self._read_sidecar()
+        if meta is None or meta['stamp'] != stamp:
+            meta = self._build(stamp)
+            self._save(meta)
+        else:
+            self._cache[self._key] = meta
+        return meta
+
+    @property
+    def record(self):
+        """刷新记录(副本)，不存在时返回`None`"""
+        return copy.deepcopy(self.load()['record'])
+
+    @property
+    def nrows(self):
+        """数据行数"""
+        return self.load()['nrows']
+
+    @property
+    def columns(self):
+        """数据列名称"""
+        return list(self.load()['columns'])
+
+    def get_bounds(self, col):
+        """列的最小值与最大值
+
+        Arguments:
+            col {str} -- 列名称
+
+        Returns:
+            tuple -- (最小值, 最大值)，无数据时为(None, None)
+        """
+        meta = self.load()
+        if col in meta['bounds']:
+            return meta['bounds'][col]
+        bounds = (None, None)
+        if meta['nrows']:
+            bounds = _bounds_of(self._engine.select_column(self._fp, col))
+        meta = copy.copy(meta)
+        meta['bounds'] = {**meta['bounds'], col: bounds}
+        self._save(meta)
+        return bounds
+
+    def get_distinct(self, col, force=False):
+        """列的唯一值集合
+
+        Arguments:
+            col {str} -- 列名称
+
+        Keyword Arguments:
+            force {bool} -- 是否强制重新扫描 (default: {False})
+
+        Returns:
+            set -- 唯一值集合
+        """
+        meta = self.load()
+        if col in meta['distinct'] and not force:
+            return set(meta['distinct'][col])
+        values = set()
+        if meta['nrows']:
+            # 分块扫描单列
+            for chunk in self._engine.iter_column(self._fp, col):
+                values.update(_distinct_of(chunk))
+        meta = copy.copy(meta)
+        meta['distinct'] = {**meta['distinct'], col: values}
+        self._save(meta)
+        return set(values)
+
+    def after_append(self, prev, data):
+        """添加数据后更新元数据
+
+        Arguments:
+            prev {dict} -- 写入前的有效元数据
+            data {DataFrame} -- 添加的数据
+        """
+        meta = copy.copy(prev)
+        meta['stamp'] = self._stamp()
+        meta['nrows'] = prev['nrows'] + len(data)
+        if not prev['columns']:
+            meta['columns'] = data.columns.tolist()
+        bounds = {}
+        for col, v in prev['bounds'].items():
+            if col in data.columns:
+                v = _merge_bounds(v, _bounds_of(data[col]))
+            bounds[col] = v
+        meta['bounds'] = bounds
+        distinct = {}
+        for col, v in prev['distinct'].items():
+            if col in data.columns:
+                v = v | _distinct_of(data[col])
+            distinct[col] = v
+        meta['distinct'] = distinct
+        self._save(meta)
+
+    def after_rewrite(self, data):
+        """重写数据后更新元数据(刷新记录随之删除)
+
+        Arguments:
+            data {DataFrame} -- 写入的全部数据
+        """
+        prev = self._cache.get(self._key, _empty_meta())
+        meta = _empty_meta()
+        meta['stamp'] = self._stamp()
+        meta['nrows'] = len(data)
+        meta['columns'] = data.columns.tolist()
+        meta['bounds'] = {
+            col: _bounds_of(data[col])
+            for col in prev['bounds'] if col in data.columns
+        }
+        meta['distinct'] = {
+            col: _distinct_of(data[col])
+            for col in prev['distinct'] if col in data.columns
+        }
+        self._save(meta)
+
+    def after_record(self, prev, record):
+        """写入刷新记录后更新元数据
+
+        Arguments:
+            prev {dict} -- 写入前的有效元数据
+            record {dict} -- 刷新记录
+        """
+        meta = copy.copy(prev)
+        meta['stamp'] = self._stamp()
+        meta['record'] = copy.deepcopy(dict(record))
+        self._save(meta)
+
+    def touch(self, prev):
+        """数据内容不变(如创建索引)，仅更新文件状态"""
+        meta = copy.copy(prev)
+        meta['stamp'] = self._stamp()
+        self._save(meta)
+
+    def invalidate(self):
+        """删除元数据"""
+        self._cache.pop(self._key, None)
+        if self._meta_fp.exists():
+            self._meta_fp.unlink()
+
+
+class KeyIndex(object):
+    """数据唯一性键集合
+
+    附属文件由若干pickle帧组成：
+        首帧 {'subset': 键列, 'stamp': 存储状态, 'keys': 键列表}
+        后续 {'prev': 添加前存储状态, 'stamp': 添加后存储状态, 'keys': 新增键}
+    写入刷新记录等不改变数据的操作追加新增键为空的帧。
+    帧链中断或与存储状态不一致时，重新读取h5文件的键列生成。
+    """
+    # 进程内缓存 {文件路径: {'subset':..., 'stamp':..., 'keys': set}}
+    _cache = {}
+
+    def __init__(self, fp, subset, engine=None):
+        self._fp = fp
+        self._keys_fp = fp.with_name(f"{fp.name}.keys")
+        self._key = str(fp)
+        self._subset = ensure_list(subset)
+        self._engine = engine or get_engine(fp)
+
+    @property
+    def file_path(self):
+        """附属文件路径"""
+        return self._keys_fp
+
+    @property
+    def subset(self):
+        """键列"""
+        return self._subset
+
+    def _stamp(self):
+        return self._engine.stamp(self._fp)
+
+    @staticmethod
+    def keys_of(df, subset):
+        """数据框的键列表(单列为值，多列为元组)"""
+        part = df[subset].astype(object)
+        part = part.where(part.notna(), None)
+        if len(subset) == 1:
+            return part[subset[0]].tolist()
+        return list(part.itertuples(index=False, name=None))
+
+    def _read_sidecar(self):
+        """读取附属文件，无效时返回`None`"""
+        try:
+            with open(self._keys_fp, 'rb') as f:
+                head = pickle.load(f)
+                if head.get('subset') != self._subset:
+                    return None
+                keys = set(head['keys'])
+                stamp = head['stamp']
+                while True:
+                    try:
+                        frame = pickle.load(f)
+                    except EOFError:
+                        break
+                    if frame['prev'] != stamp:
+                        return None
+                    keys.update(frame['keys'])
+                    stamp = frame['stamp']
+        except Exception:
+            return None
+        return {'subset': self._subset, 'stamp': stamp, 'keys': keys}
+
+    def _build(self, stamp):
+        """读取h5文件键列生成"""
+        keys = []
+        if stamp is not None and self._engine.describe(self._fp)['nrows']:
+            # 只读取键列
+            df = pd.DataFrame({
+                col: self._engine.select_column(self._fp, col).values
+                for col in self._subset
+            })
+            keys = self.keys_of(df, self._subset)
+        entry = {'subset': self._subset, 'stamp': stamp, 'keys': set(keys)}
+        if stamp is not None:
+            with open(self._keys_fp, 'wb') as f:
+                pickle.dump(
+                    {
+                        'subset': self._subset,
+                        'stamp': stamp,
+                        'keys': list(entry['keys'])
+                    }, f)
+        return entry
+
+    def load(self):
+        """与h5文件一致的键集合"""
+        stamp = self._stamp()
+        entry = self._cache.get(self._key)
+        if entry is None or entry['subset'] != self._subset or entry[
+                'stamp'] != stamp:
+            entry = self._read_sidecar()
+            if entry is None or entry['stamp'] != stamp:
+                entry = self._build(stamp)
+            self._cache[self._key] = entry
+        return entry['keys']
+
+    def get_new(self, df):
+        """截取键值不在h5文件中的新增行(新增部分重复时保留首行)"""
+        df = df.drop_duplicates(self._subset, keep='first')
+        keys = self.load()
+        isin = [k in keys for k in self.keys_of(df, self._subset)]
+        return df[~pd.Series(isin, index=df.index, dtype=bool)]
+
+    @classmethod
+    def after_append(cls, fp, prev_stamp, data, engine=None):
+        """添加数据后追加记录新增键
+
+        Arguments:
+            fp {Path} -- h5文件路径
+            prev_stamp {tuple} -- 添加前存储状态
+            data {DataFrame} -- 添加的数据
+
+        Keyword Arguments:
+            engine {StorageEngine} -- 存储引擎 (default: {None})
+        """
+        keys_fp = fp.with_name(f"{fp.name}.keys")
+        if not keys_fp.exists():
+            cls._cache.pop(str(fp), None)
+            return
+        try:
+            with open(keys_fp, 'rb') as f:
+                subset = pickle.load(f)['subset']
+        except Exception:
+            subset = None
+        if subset is None or not set(subset).issubset(data.columns):
+            cls.invalidate(fp)
+            return
+        stamp = (engine or get_engine(fp)).stamp(fp)
+        new_keys = cls.keys_of(data, subset)
+        with open(keys_fp, 'ab') as f:
+            pickle.dump({
+                'prev': prev_stamp,
+                'stamp': stamp,
+                'keys': new_keys
+            }, f)
+        entry = cls._cache.get(str(fp))
+        if entry is not None:
+            if entry['stamp'] == prev_stamp and entry['subset'] == subset:
+                entry['keys'].update(new_keys)
+                entry['stamp'] = stamp
+            else:
+                cls._cache.pop(str(fp))
+
+    @classmethod
+    def after_record(cls, fp, prev_stamp, engine=None):
+        """数据内容不变(如写入刷新记录、创建索引)，仅追加记录存储状态
+
+        Arguments:
+            fp {Path} -- h5文件路径
+            prev_stamp {tuple} -- 写入前存储状态
+
+        Keyword Arguments:
+            engine {StorageEngine} -- 存储引擎 (default: {None})
+        """
+        keys_fp = fp.with_name(f"{fp.name}.keys")
+        if not keys_fp.exists():
+            cls._cache.pop(str(fp), None)
+            return
+        stamp = (engine or get_engine(fp)).stamp(fp)
+        if stamp == prev_stamp:
+            return
+        with open(keys_fp, 'ab') as f:
+            pickle.dump({'prev': prev_stamp, 'stamp': stamp, 'keys': []}, f)
+        entry = cls._cache.get(str(fp))
+        if entry is not None:
+            if entry['stamp'] == prev_stamp:
+                entry['stamp'] = stamp
+            else:
+                cls._cache.pop(str(fp))
+
+    @classmethod
+    def invalidate(cls, fp):
+        """删除键集合"""
+        cls._cache.pop(str(fp), None)
+        keys_fp = fp.with_name(f"{fp.name}.keys")
+        if keys_fp.exists():
+            keys_fp.unlink()
@@ -0,0 +1,285 @@
+"""日线面板(日期 × 代码)
+
+Notes:
+    1. 选定字段保存为二维内存映射数组`panel/{字段}.{版本}.bin`，行为日期、列为代码，
+       全部字段共享日期轴及代码轴(`panel/meta.pkl`)
+    2. 代码轴预留容量，新增代码占用空余列；超出容量时按新容量重建(版本加1)
+    3. 新交易日只在文件尾部追加行，已写入部分不变；元数据最后以替换方式写入，
+       读取进程只会看到完整的日期及代码
+    4. 读取时映射文件，返回视图而不复制数据；进程内以元数据状态判断映射是否有效
+    5. 浮点字段缺失值为`nan`，整数字段为0
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from .reader import bulk_daily_history
+from .scripts.refresh import WYSRefresher
+from .storage import _atomic_write, _dump_pickle, file_stamp
+from .utils import data_root, make_logger
+
+logger = make_logger('日线面板')
+
+# 默认字段及数据类型
+PANEL_FIELDS = {
+    '收盘价': 'float32',
+    '成交量': 'int64',
+    # 成交金额可达百亿，float32精度不足
+    '成交金额': 'float64',
+}
+# 代码轴容量步长
+CAPACITY_STEP = 512
+DATE_COL = '日期'
+
+# 进程内缓存 {名称: (元数据状态, 对象)}
+_cache = {}
+
+
+def panel_dir():
+    """面板数据目录"""
+    return data_root('panel')
+
+
+def _meta_path():
+    return panel_dir() / 'meta.pkl'
+
+
+def _field_path(field, version):
+    return panel_dir() / f'{field}.{version}.bin'
+
+
+def _fill_value(dtype):
+    return np.nan if np.dtype(dtype).kind == 'f' else 0
+
+
+def _capacity(n):
+    return (n // CAPACITY_STEP + 1) * CAPACITY_STEP
+
+
+def _load_meta():
+    fp = _meta_path()
+    stamp = file_stamp(fp)
+    if stamp is None:
+        raise FileNotFoundError('首先生成日线面板，运行：\n stock panel')
+    cached = _cache.get(None)
+    if cached is not None and cached[0] == stamp:
+        return stamp, cached[1]
+    with open(fp, 'rb') as f:
+        meta = pickle.load(f)
+    meta['code_index'] = pd.Index(meta['codes'])
+    _cache.clear()
+    _cache[None] = (stamp, meta)
+    return stamp, meta
+
+
+def _save_meta(meta):
+    meta = {k: v for k, v in meta.items() if k != 'code_index'}
+    _dump_pickle(_meta_path(), meta)
+    _cache.clear()
+
+
+def _remove_versions(fields, keep):
+    """删除其他版本的字段文件(已映射的进程仍可读取原文件)"""
+    for field in fields:
+        for p in panel_dir().glob(f'{field}.*.bin'):
+            if p != _field_path(field, keep):
+                p.unlink()
+
+
+def _values(df, field, dtype):
+    s = df[field]
+    if np.dtype(dtype).kind != 'f':
+        s = s.fillna(0)
+    return s.values.astype(dtype)
+
+
+def _local_codes():
+    root = WYSRefresher().get_data_path('000001').parent
+    return sorted(fp.stem for fp in root.glob('*.h5'))
+
+
+def _read(codes, start, fields):
+    """长格式日线数据"""
+    if not codes:
+        return pd.DataFrame()
+    return bulk_daily_history(codes, start, None, columns=[DATE_COL, *fields])
+
+
+def build_panel(fields=None, codes=None):
+    """由日线数据生成面板
+
+    Keyword Arguments:
+        fields {dict} -- {字段: 数据类型}，默认为`PANEL_FIELDS` (default: {None})
+        codes {list} -- 股票代码列表，`None`代表本地全部股票 (default: {None})
+    """
+    fields = dict(PANEL_FIELDS if fields is None else fields)
+    try:
+        version = _load_meta()[1]['version'] + 1
+    except FileNotFoundError:
+        version = 0
+    df = bulk_daily_history(codes, columns=[DATE_COL, *fields])
+    if df.empty:
+        return
+    dates = np.unique(df[DATE_COL].values.astype('datetime64[ns]'))
+    code_axis = np.array(sorted(df['股票代码'].unique()), dtype='U6')
+    capacity = _capacity(len(code_axis))
+    rows = np.searchsorted(dates, df[DATE_COL].values)
+    cols = np.searchsorted(code_axis, df['股票代码'].values)
+    shape = (len(dates), capacity)
+    for field, dtype in fields.items():
+
+        def write(tmp):
+            arr = np.memmap(tmp, dtype, 'w+', shape=shape)
+            arr[:] = _fill_value(dtype)
+            arr[rows, cols] = _values(df, field, dtype)
+            arr.flush()
+            del arr
+
+        _atomic_write(_field_path(field, version), write)
+    _save_meta({
+        'version': version,
+        'fields': fields,
+        'capacity': capacity,
+        'dates': dates,
+        'codes': code_axis,
+    })
+    _remove_versions(fields, version)
+    logger.info(f'生成面板 {shape[0]}日 × {len(code_axis)}只股票')
+
+
+def append_panel(build=True):
+    """追加新交易日及新增代码
+
+    Notes:
+    ------
+        网易股票日线刷新后执行；新增代码读取全部历史，超出代码轴容量时重建
+
+    Keyword Arguments:
+        build {bool} -- 尚未生成面板时是否生成 (default: {True})
+    """
+    try:
+        meta = _load_meta()[1]
+    except FileNotFoundError:
+        if build:
+            build_panel()
+        return
+    fields, capacity = meta['fields'], meta['capacity']
+    dates, code_axis = meta['dates'], meta['codes']
+    new_codes = sorted(set(_local_codes()) - set(code_axis))
+    if len(code_axis) + len(new_codes) > capacity:
+        return build_panel(fields)
+    # 已有代码只读取新交易日，新增代码读取全部
+    start = pd.Timestamp(dates[-1]) + pd.Timedelta(days=1)
+    dfs = [
+        _read(list(code_axis), start, fields),
+        _read(new_codes, None, fields)
+    ]
+    dfs = [df for df in dfs if not df.empty]
+    if not dfs:
+        return
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    code_axis = np.append(code_axis, np.array(new_codes, dtype='U6'))
+    df_dates = df[DATE_COL].values.astype('datetime64[ns]')
+    new_dates = np.unique(df_dates[df_dates > dates[-1]])
+    all_dates = np.append(dates, new_dates)
+    rows = np.searchsorted(all_dates, df_dates)
+    rows = np.minimum(rows, len(all_dates) - 1)
+    # 不在日期轴的历史日期(如面板生成后补充的停牌日)忽略
+    found = all_dates[rows] == df_dates
+    df, rows = df[found], rows[found]
+    cols = pd.Index(code_axis).get_indexer(df['股票代码'].values)
+    old = rows < len(dates)
+    for field, dtype in fields.items():
+        fp = _field_path(field, meta['version'])
+        values = _values(df, field, dtype)
+        itemsize = np.dtype(dtype).itemsize
+        # 去除此前中断时追加的不完整行
+        os.truncate(fp, len(dates) * capacity * itemsize)
+        if old.any():
+            arr = np.memmap(fp, dtype, 'r+', shape=(len(dates), capacity))
+            arr[rows[old], cols[old]] = values[old]
+            arr.flush()
+            del arr
+        block = np.full((len(new_dates), capacity), _fill_value(dtype), dtype)
+        block[rows[~old] - len(dates), cols[~old]] = values[~old]
+        with open(fp, 'ab') as f:
+            f.write(block.tobytes())
+    meta.update(dates=all_dates, codes=code_axis)
+    _save_meta(meta)
+    logger.info(f'追加{len(new_dates)}日，新增{len(new_codes)}只股票')
+
+
+def panel_axes():
+    """面板日期轴及代码轴
+
+    Returns:
+        tuple -- (DatetimeIndex, Index)
+    """
+    meta = _load_meta()[1]
+    return pd.DatetimeIndex(meta['dates']), meta['code_index']
+
+
+def panel_array(field):
+    """字段二维数组(只读视图，不复制数据)
+
+    Arguments:
+        field {str} -- 字段名称
+
+    Returns:
+        ndarray -- 形状为(日期数, 代码数)
+    """
+    stamp, meta = _load_meta()
+    cached = _cache.get(field)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    if field not in meta['fields']:
+        raise ValueError(f"面板不含字段{field}，可用字段{list(meta['fields'])}")
+    shape = (len(meta['dates']), meta['capacity'])
+    arr = np.memmap(_field_path(field, meta['version']),
+                    meta['fields'][field],
+                    'r',
+                    shape=shape)
+    arr = arr.view(np.ndarray)[:, :len(meta['codes'])]
+    _cache[field] = (stamp, arr)
+    return arr
+
+
+def read_panel(field, start=None, end=None, codes=None):
+    """读取面板
+
+    Notes:
+    ------
+        日期期间为视图；指定代码列表时按列选取，复制所选部分
+
+    Arguments:
+        field {str} -- 字段名称
+
+    Keyword Arguments:
+        start {date_like} -- 开始日期 (default: {None})
+        end {date_like} -- 结束日期 (default: {None})
+        codes {list} -- 股票代码列表，`None`代表全部 (default: {None})
+
+    Returns:
+        DataFrame -- 以日期为索引、代码为列
+
+    Usage:
+    >>> close = read_panel('收盘价', '2020-01-01')
+    """
+    arr = panel_array(field)
+    dates, code_index = panel_axes()
+    i = 0 if start is None else dates.searchsorted(pd.Timestamp(start))
+    j = len(dates) if end is None else dates.searchsorted(pd.Timestamp(end),
+                                                          side='right')
+    values = arr[i:j]
+    if codes is not None:
+        loc = code_index.get_indexer(list(codes))
+        if (loc == -1).any():
+            raise KeyError(f'面板不含代码{np.asarray(codes)[loc == -1].tolist()}')
+        values = values[:, loc]
+        code_index = code_index[loc]
+    return pd.DataFrame(values,
+                        index=dates[i:j].rename(DATE_COL),
+                        columns=code_index.rename('股票代码'),
+                        copy=False)
@@ -1,8 +1,16 @@
+import operator
 from enum import Enum, unique
+from functools import reduce
+
+import numpy as np
 import pandas as pd
 from cnswd.utils import ensure_dt_localize
+from .storage import SCAN_CHUNKSIZE, get_engine
 import warnings
 
+# `HDFStore.select`列表条件直接交由numexpr计算的最大项数，超出时读取后筛选
+MAX_SELECTORS = 31
+
 
 @unique
 class Ops(Enum):
@@ -11,6 +19,9 @@ class Ops(Enum):
     lse = 3  # <=
     gt = 4  # >
     ls = 5  # <
+    isin = 6  # in
+    notin = 7  # not in
+    between = 8  # >= & <=
 
 
 def _to_op_symbol(e):
@@ -24,9 +35,27 @@ def _to_op_symbol(e):
         return '>'
     elif e == Ops.ls:
         return '<'
+    elif e == Ops.isin:
+        return 'in'
+    elif e == Ops.notin:
+        return 'not in'
+    elif e == Ops.between:
+        return 'between'
     raise ValueError(f'不支持比较操作符号{e}')
 
 
+_OPERATORS = {
+    Ops.eq: operator.eq,
+    Ops.gte: operator.ge,
+    Ops.lse: operator.le,
+    Ops.gt: operator.gt,
+    Ops.ls: operator.lt,
+    Ops.isin: lambda s, v: s.isin(v),
+    Ops.notin: lambda s, v: ~s.isin(v),
+    Ops.between: lambda s, v: s.between(*v),
+}
+
+
 def force_freq_to_none(v):
     # 查询时间不得带tz,freq信息
     if isinstance(v, pd.Timestamp):
@@ -36,36 +65,333 @@ def force_freq_to_none(v):
     return v
 
 
+def _scalar(v):
+    """numpy标量转换为python对象，使查询表达式可解析"""
+    if isinstance(v, np.datetime64):
+        v = pd.Timestamp(v)
+    elif isinstance(v, np.generic):
+        v = v.item()
+    return force_freq_to_none(v)
+
+
+def _is_list_like(value):
+    return isinstance(value,
+                      (list, tuple, set, np.ndarray, pd.Index, pd.Series))
+
+
+def _where(key, e, value):
+    """`HDFStore.select`查询字符串"""
+    if e == Ops.isin:
+        return f"{key} == {value!r}"
+    elif e == Ops.notin:
+        if len(value) > MAX_SELECTORS:
+            return f"{key} != {value!r}"
+        # 少量列表值`!=`条件以或连接，须逐项以且连接
+        return '(' + ' & '.join(f"{key} != {v!r}" for v in value) + ')'
+    elif e == Ops.between:
+        return f"({key} >= {value[0]!r} & {key} <= {value[1]!r})"
+    return f"{key} {_to_op_symbol(e)} {value!r}"
+
+
+class Term(str):
+    """子查询表达式
+
+    Notes:
+    ------
+        字符串形式用于`HDFStore.select`，同时保留列名称、比较符及限定值，
+        供其他存储引擎下推查询条件
+        `isin`及`notin`的限定值为列表，`between`的限定值为(下限, 上限)
+    """
+    def __new__(cls, key, e, value):
+        symbol = _to_op_symbol(e)
+        obj = super().__new__(cls, _where(key, e, value))
+        obj.key = key
+        obj.op = e
+        obj.symbol = symbol
+        obj.value = value
+        return obj
+
+    def __getnewargs__(self):
+        return (self.key, self.op, self.value)
+
+
+class AnyTerm(str):
+    """或条件组，满足其中任一子查询即可
+
+    Notes:
+    ------
+        由`any_of`生成，作为`query_stmt`的参数与其他条件以且连接
+    """
+    def __new__(cls, *terms):
+        obj = super().__new__(cls, '(' + ' | '.join(terms) + ')')
+        obj.key = None
+        obj.op = None
+        obj.terms = terms
+        return obj
+
+    def __getnewargs__(self):
+        return self.terms
+
+
+def _to_term(key, e, value):
+    """生成子查询，限定值为`None`时返回`None`"""
+    if _is_list_like(value):
+        values = [_scalar(v) for v in value]
+        if e == Ops.eq:
+            # 列表值视同`isin`
+            e = Ops.isin
+        if e in (Ops.isin, Ops.notin):
+            if not values:
+                raise ValueError(f'{key}限定值列表不得为空')
+            return Term(key, e, values)
+        if e == Ops.between:
+            assert len(values) == 2, '`between`限定值必须是（下限、上限）二元组'
+            lower, upper = [None if pd.isnull(v) else v for v in values]
+            if lower is None and upper is None:
+                return None
+            elif lower is None:
+                return Term(key, Ops.lse, upper)
+            elif upper is None:
+                return Term(key, Ops.gte, lower)
+            return Term(key, e, (lower, upper))
+        raise ValueError(f'比较符{e}不支持列表值')
+    value = _scalar(value)
+    if value is None or pd.isnull(value):
+        return None
+    if e in (Ops.isin, Ops.notin):
+        return Term(key, e, [value])
+    assert e != Ops.between, '`between`限定值必须是（下限、上限）二元组'
+    return Term(key, e, value)
+
+
+def any_of(*args):
+    """生成或条件组
+
+    Notes:
+    ------
+        参数与`query_stmt`相同，限定值为`None`的子查询忽略
+        `HDFStore.select`不支持或条件中的长列表，`isin`列表不得超过`MAX_SELECTORS`项
+
+    Returns:
+        AnyTerm -- 或条件组，全部子查询忽略时为`None`
+
+    Usage:
+    >>> stmt = query_stmt(
+    >>>     ('股票代码', Ops.isin, ['000001', '600000']),
+    >>>     any_of(('收盘价', Ops.gt, 10), ('成交量', Ops.ls, 1000)))
+    """
+    terms = []
+    for arg in args:
+        assert len(arg) == 3, '子查询必须是（列名称、比较符、限定值）三元组'
+        term = _to_term(*arg)
+        if term is None:
+            continue
+        if term.op in (Ops.isin, Ops.notin) and len(term.value) > MAX_SELECTORS:
+            raise ValueError(f'或条件中{term.key}列表值不得超过{MAX_SELECTORS}项')
+        terms.append(term)
+    if not terms:
+        return None
+    return AnyTerm(*terms)
+
+
 def query_stmt(*args):
     """生成查询表达式
     
     Notes:
     ------
         如值表为`None`代表全部
+        `Ops.eq`的限定值为列表时视同`Ops.isin`
+        或条件组使用`any_of`生成
+
+    Usage:
+    >>> query_stmt(
+    >>>     ('股票代码', Ops.eq, ['000001', '600000']),
+    >>>     ('交易日期', Ops.between, ('2020-01-01', '2020-03-31')))
     """
     stmt = []
     for arg in args:
+        if arg is None:
+            # 全部子查询忽略的或条件组
+            continue
+        if isinstance(arg, AnyTerm):
+            stmt.append(arg)
+            continue
         assert len(arg) == 3, '子查询必须是（列名称、比较符、限定值）三元组'
         key, e, value = arg
-        value = force_freq_to_none(value)
-        if key is None or value is None or pd.isnull(value):
+        if key is None:
             continue
-        stmt.append(f"{key} {_to_op_symbol(e)} {value!r}")
+        term = _to_term(key, e, value)
+        if term is not None:
+            stmt.append(term)
     return stmt
 
 
-def query(fp, stmt):
-    if not fp.exists():
+def query(fp, stmt, columns=None):
+    """查询数据
+
+    Notes:
+    ------
+        在`store_pool.pooled()`范围内，h5文件使用进程内只读句柄池(参阅`storage.StorePool`)
+        读取异常时警告并返回空表，空表标记`attrs['query_error']`，不会被缓存
+
+    Arguments:
+        fp {Path} -- 数据路径（扩展名.h5）
+        stmt {list} -- 查询表达式
+
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+
+    Returns:
+        DataFrame -- 查询结果
+    """
+    engine = get_engine(fp)
+    if not engine.exists(fp):
         raise FileNotFoundError(f"找不到文件：{fp}")
     try:
-        store = pd.HDFStore(fp, mode='r')
-        df = store.select('data', stmt, auto_close=True)
+        df = engine.select(fp, stmt, columns=columns)
     except KeyError:
         # 当h5文件不存在data节点时触发
         raise ValueError('数据内容为空，请刷新项目数据。')
     except Exception as e:
         warnings.warn(f"{e!r}")
         df = pd.DataFrame()
-    finally:
-        store.close()
-    return df
\ No newline at end of file
+        df.attrs['query_error'] = f"{e!r}"
+    return df
+
+
+def iter_query(fp, stmt, columns=None, chunksize=SCAN_CHUNKSIZE):
+    """分块查询数据，每次只读取`chunksize`行
+
+    Notes:
+    ------
+        用于结果无法一次载入内存的大型表，如全部公司公告
+        迭代期间文件被其他进程写入时触发`RuntimeError`
+
+    Arguments:
+        fp {Path} -- 数据路径（扩展名.h5）
+        stmt {list} -- 查询表达式
+
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+        chunksize {int} -- 每块行数 (default: {SCAN_CHUNKSIZE})
+
+    Returns:
+        generator -- 满足条件的数据块
+
+    Usage:
+    >>> for df in iter_query(fp, query_stmt(('股票代码', Ops.eq, '000001'))):
+    >>>     print(len(df))
+    """
+    engine = get_engine(fp)
+    if not engine.exists(fp):
+        raise FileNotFoundError(f"找不到文件：{fp}")
+    try:
+        yield from engine.iter_select(fp, stmt, columns, chunksize)
+    except KeyError:
+        # 当h5文件不存在data节点时触发
+        raise ValueError('数据内容为空，请刷新项目数据。')
+
+
+def count_by(fp, by='股票代码', stmt=[], chunksize=SCAN_CHUNKSIZE):
+    """分块计数
+
+    Keyword Arguments:
+        by {str} -- 分组列名称 (default: {'股票代码'})
+        stmt {list} -- 查询表达式 (default: {[]})
+        chunksize {int} -- 每块行数 (default: {SCAN_CHUNKSIZE})
+
+    Returns:
+        Series -- 各组行数
+    """
+    res = pd.Series(dtype='int64', name=by)
+    for df in iter_query(fp, stmt, [by], chunksize):
+        res = res.add(df[by].value_counts(), fill_value=0)
+    return res.astype('int64').sort_index()
+
+
+def latest_by(fp,
+              index_col,
+              by='股票代码',
+              stmt=[],
+              columns=None,
+              chunksize=SCAN_CHUNKSIZE):
+    """分块提取各组索引列最大的行
+
+    Arguments:
+        fp {Path} -- 数据路径（扩展名.h5）
+        index_col {str} -- 索引列名称，如日期
+
+    Keyword Arguments:
+        by {str} -- 分组列名称 (default: {'股票代码'})
+        stmt {list} -- 查询表达式 (default: {[]})
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+        chunksize {int} -- 每块行数 (default: {SCAN_CHUNKSIZE})
+
+    Returns:
+        DataFrame -- 每组一行，索引列相同时保留后读取的行
+    """
+    if columns is not None:
+        columns = list(columns) + [c for c in (by, index_col)
+                                   if c not in columns]
+    res = None
+    for df in iter_query(fp, stmt, columns, chunksize):
+        if res is not None:
+            df = pd.concat([res, df], sort=False)
+        df = df.sort_values(index_col, kind='mergesort')
+        res = df.drop_duplicates(by, keep='last')
+    if res is None:
+        return pd.DataFrame()
+    return res.sort_values(by, kind='mergesort')
+
+
+def filter_concat(fp, func, stmt=[], columns=None, chunksize=SCAN_CHUNKSIZE):
+    """分块筛选后合并
+
+    Arguments:
+        fp {Path} -- 数据路径（扩展名.h5）
+        func {callable} -- 接收数据块，返回筛选后的数据框或布尔序列
+
+    Keyword Arguments:
+        stmt {list} -- 查询表达式，先于`func`在读取时筛选 (default: {[]})
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+        chunksize {int} -- 每块行数 (default: {SCAN_CHUNKSIZE})
+
+    Returns:
+        DataFrame -- 合并结果
+
+    Usage:
+    >>> func = lambda df: df['公告标题'].str.contains('回购')
+    >>> df = filter_concat(fp, func, columns=['股票代码', '公告标题'])
+    """
+    dfs = []
+    for df in iter_query(fp, stmt, columns, chunksize):
+        res = func(df)
+        if isinstance(res, pd.Series):
+            res = df[res.values]
+        if len(res):
+            dfs.append(res)
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, sort=False)
+
+
+def _term_mask(df, term):
+    if isinstance(term, AnyTerm):
+        return reduce(operator.or_, (_term_mask(df, t) for t in term.terms))
+    return _OPERATORS[term.op](df[term.key], term.value)
+
+
+def filter_frame(df, stmt):
+    """内存数据框按查询表达式筛选
+
+    Arguments:
+        df {DataFrame} -- 数据框
+        stmt {list} -- `query_stmt`生成的查询表达式
+
+    Returns:
+        DataFrame -- 满足全部条件的行
+    """
+    cond = pd.Series(True, index=df.index)
+    for term in stmt:
+        cond &= _term_mask(df, term)
+    return df[cond.values]
@@ -0,0 +1,166 @@
+"""网站请求限速
+
+Notes:
+    1. 按主机令牌桶限速，所有进程共享同一令牌桶，多进程合计速率不超过设定值
+    2. 令牌桶状态保存在`ratelimit/{主机}.bucket`，以文件锁互斥读写
+    3. 每次请求预约一个令牌，令牌不足时休眠至预约时点，无需等待时不休眠
+    4. 速率按主机后缀配置(参阅`RATE_LIMITS`)，未配置的主机不限速
+    5. 同步请求使用`rate_limit`，协程使用`async_rate_limit`
+
+用法
+>>> rate_limit('http://quotes.money.163.com/service/chddata.html')
+>>> await async_rate_limit(url)
+"""
+import asyncio
+import os
+import struct
+import time
+
+from .setting.config import RATE_LIMITS
+from .utils import data_root
+from .utils.tools import match_host
+
+try:
+    import fcntl
+
+    def _lock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+except ImportError:  # Windows
+    import msvcrt
+
+    def _lock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# 状态 (剩余令牌, 更新时间)
+_STATE = struct.Struct('dd')
+
+# 进程内令牌桶 {名称: TokenBucket}
+_buckets = {}
+
+
+class TokenBucket(object):
+    """跨进程令牌桶
+
+    Arguments:
+        name {str} -- 名称，同名令牌桶共享状态
+        rate {float} -- 每秒令牌数
+        burst {int} -- 令牌桶容量，即允许的突发请求数
+    """
+    def __init__(self, name, rate, burst=1):
+        assert rate > 0, '速率必须大于0'
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.path = data_root('ratelimit') / f'{name}.bucket'
+        self._file = None
+        self._pid = None
+
+    def _open(self):
+        # 子进程不得沿用父进程打开的文件，否则文件锁不互斥
+        if self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            self._file = os.fdopen(fd, 'r+b')
+            self._pid = os.getpid()
+        return self._file
+
+    def reserve(self):
+        """预约一个令牌
+
+        Returns:
+            float -- 需要等待的秒数
+        """
+        f = self._open()
+        _lock(f)
+        try:
+            f.seek(0)
+            data = f.read(_STATE.size)
+            now = time.time()
+            if len(data) == _STATE.size:
+                tokens, last = _STATE.unpack(data)
+                tokens = min(self.burst,
+                             tokens + max(0., now - last) * self.rate)
+            else:
+                tokens = self.burst
+            tokens -= 1
+            f.seek(0)
+            f.write(_STATE.pack(tokens, now))
+            f.flush()
+        finally:
+            _unlock(f)
+        return max(0., -tokens / self.rate)
+
+    def acquire(self):
+        """取得令牌，必要时休眠"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        """取得令牌，必要时以协程休眠"""
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def _host_key(url):
+    """网址对应的配置主机后缀，未配置时返回`None`"""
+    return match_host(url, RATE_LIMITS)
+
+
+def get_bucket(url):
+    """网址所在主机的令牌桶
+
+    Arguments:
+        url {str} -- 网址或主机名称
+
+    Returns:
+        TokenBucket -- 未配置限速时返回`None`
+    """
+    key = _host_key(url)
+    if key is None:
+        return None
+    bucket = _buckets.get(key)
+    if bucket is None:
+        rate, burst = RATE_LIMITS[key]
+        if not rate:
+            return None
+        bucket = _buckets[key] = TokenBucket(key, rate, burst)
+    return bucket
+
+
+def rate_limit(url):
+    """请求前调用，按主机限速
+
+    Arguments:
+        url {str} -- 网址或主机名称
+
+    Returns:
+        float -- 休眠秒数
+    """
+    bucket = get_bucket(url)
+    return 0. if bucket is None else bucket.acquire()
+
+
+async def async_rate_limit(url):
+    """协程请求前调用，按主机限速
+
+    Arguments:
+        url {str} -- 网址或主机名称
+
+    Returns:
+        float -- 休眠秒数
+    """
+    bucket = get_bucket(url)
+    return 0. if bucket is None else await bucket.acquire_async()
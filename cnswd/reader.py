@@ -1,35 +1,65 @@
+from contextlib import nullcontext
+from multiprocessing import Pool
+
 import pandas as pd
 
+from .adjustment import adjust_prices, adjustment_path
+from .bars import bars_path
+from .cache import query_cache
 from .cninfo.classify_tree import PLATE_LEVELS, PLATE_MAPS
 from .data import HDFData
-from .query_utils import Ops, query, query_stmt
+from .query_utils import Ops, filter_frame, query, query_stmt
+from .refdata import trading_dates
 from .scripts.fs import refresh_batch as fs_batch_refresh
 from .scripts.refresh import (ASRefresher, ClassifyBomRefresher,
                               ClassifyTreeRefresher, DisclosureRefresher,
                               FSRefresher, MarginDataRefresher,
                               SinaNewsRefresher, TreasuryRefresher,
                               WYIRefresher, WYSRefresher)
+from .scripts.tct_minutely import minutely_path, read_snapshots
 from .setting.config import DB_CONFIG
+from .setting.constants import MAX_WORKER
+from .storage import get_engine, store_pool
 from .utils import data_root, sanitize_dates
+from .writer import current_writer
 
 
-def _minutely_history(fp):
-    df = pd.read_pickle(fp)
-    dt = fp.name.split('.')[0]
-    dt = pd.Timestamp(int(dt), unit='s')
-    df['时间'] = dt
-    df.reset_index(inplace=True)
-    return df
+def _query(fp, stmt, columns=None):
+    """缓存查询结果，文件刷新后自动失效；只读查询复用文件句柄"""
+    if columns is not None:
+        columns = list(columns)
+    key = (tuple(str(term) for term in stmt),
+           None if columns is None else tuple(columns))
+    # 转发写入的进程不保留句柄，以免写入进程无法打开文件
+    pooled = store_pool.pooled() if current_writer() is None else nullcontext()
+    with pooled:
+        return query_cache.get_or_load(fp, key,
+                                       lambda: query(fp, stmt, columns))
+
+
+def _codes(code):
+    """单个代码或代码列表"""
+    if code is None or isinstance(code, str):
+        return code
+    return list(code)
+
+
+def clear_cache():
+    """清除查询结果缓存"""
+    query_cache.clear()
 
 
 # region 交易数据
-def minutely_history(code=None, start=None, end=None):
+def minutely_history(code=None, start=None, end=None, columns=None):
     """分钟级别成交数据
     
     Arguments:
-        code {str} -- 股票代码。默认`None`代表全部股票
+        code {str or list} -- 股票代码或代码列表。默认`None`代表全部股票
         start {datetime_like}} -- 开始时间
         end {datetime_like} -- 结束时间
+
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
     
     Returns:
         DataFrame -- 成交数据
@@ -52,43 +82,123 @@ def minutely_history(code=None, start=None, end=None):
     if start == end:
         # 如果查询一天的数据，需要将日期更改为
         end = end.normalize() + pd.Timedelta(days=1) - pd.Timedelta(minutes=1)
-    dates = pd.date_range(start, end)
+    stmt = query_stmt(
+        ('代码', Ops.eq, _codes(code)),
+        ('时间', Ops.gte, start),
+        ('时间', Ops.lse, end),
+    )
     dfs = []
-    for d in dates:
-        dp_dir = data_root(f"TCT/{d.strftime(r'%Y%m%d')}")
-        fps = dp_dir.glob('*.pkl')
-        for fp in fps:
-            dt = fp.name.split('.')[0]
-            dt = pd.Timestamp(int(dt), unit='s')
-            if start <= dt <= end:
-                df = _minutely_history(fp)
-                dfs.append(df)
-    ret = pd.concat(dfs)
-    cond = (ret['时间'] >= start) & (ret['时间'] <= end)
-    ret = ret[cond].drop_duplicates(['代码', '时间'], keep='last')
-    ret['代码'] = ret['代码'].map(lambda x: x[2:])
-    if code:
-        return ret[ret['代码'] == code]
-    else:
-        return ret
+    for d in pd.date_range(start.normalize(), end):
+        fp = minutely_path(d)
+        if get_engine(fp).exists(fp):
+            # 已合并日期只读取所需代码及时段
+            df = _query(fp, stmt, columns)
+        else:
+            df = read_snapshots(d, start, end)
+            if df.empty:
+                continue
+            df = filter_frame(df, stmt)
+            if columns is not None:
+                df = df[columns]
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True, sort=False)
+
+
+def bars(code=None, start=None, end=None, n=5, source='tct', columns=None):
+    """分钟K线(由快照生成，参阅`bars.BarBuilder`)
+
+    Keyword Arguments:
+        code {str or list} -- 股票代码或代码列表，`None`代表全部 (default: {None})
+        start {datetime_like} -- 开始时间 (default: {None})
+        end {datetime_like} -- 结束时间 (default: {None})
+        n {int} -- K线周期(分钟)，参阅`BAR_FREQS` (default: {5})
+        source {str} -- 快照数据源`tct`或`live` (default: {'tct'})
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+
+    Returns:
+        DataFrame -- K线数据
+    """
+    fp = bars_path(n, source)
+    stmt = query_stmt(
+        ('股票代码', Ops.eq, _codes(code)),
+        ('时间', Ops.gte, None if start is None else pd.Timestamp(start)),
+        ('时间', Ops.lse, None if end is None else pd.Timestamp(end)),
+    )
+    return _query(fp, stmt, columns)
 
 
-def daily_history(code, start, end, is_index=False):
+def adjustment_factors(code=None):
+    """股票复权因子
+
+    Arguments:
+        code {str or list} -- 股票代码或代码列表，`None`代表全部 (default: {None})
+
+    Returns:
+        DataFrame -- 除权除息日的后复权因子(股票代码、日期、复权因子)
+    """
+    fp = adjustment_path()
+    if not fp.exists():
+        msg = '首先刷新复权因子，运行：\n stock adjustment'
+        raise FileNotFoundError(msg)
+    stmt = query_stmt(('股票代码', Ops.eq, _codes(code)))
+    return _query(fp, stmt)
+
+
+def _adjusted(df, code, adjust, date_col, columns):
+    """复权价格，去除为对齐因子而读取的列"""
+    factors = adjustment_factors(code)
+    df = adjust_prices(df, factors, adjust, date_col)
+    if columns is not None:
+        df = df[[c for c in df.columns if c in columns]]
+    return df
+
+
+def _with_adjust_columns(columns, date_col):
+    """复权需要股票代码及日期列"""
+    if columns is None:
+        return None
+    return list(columns) + [
+        c for c in ('股票代码', date_col) if c not in columns
+    ]
+
+
+def daily_history(code,
+                  start,
+                  end,
+                  is_index=False,
+                  columns=None,
+                  adjust=None):
     """网易日线行情（股票/指数）
     
     Arguments:
-        code {str} -- 代码 
+        code {str or list} -- 代码或代码列表
         start {date_like} -- 开始时间
         end {date_like} -- 结束时间
         is_index {bool} -- 是否为指数，默认为股票。
+
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+        adjust {str} -- 股票复权方式，`qfq`前复权、`hfq`后复权，`None`代表不复权 (default: {None})
+
     Returns:
         DataFrame -- 日线数据框
     """
+    code = _codes(code)
+    r = _daily_refresher(is_index)
+    if isinstance(code, list):
+        missing = [c for c in code if not r.get_data_path(c).exists()]
+        if missing:
+            r.refresh_batch(missing)
+        return bulk_daily_history(code,
+                                  start,
+                                  end,
+                                  is_index,
+                                  columns,
+                                  adjust=adjust)
+    assert not (is_index and adjust), '指数不需要复权'
     start, end = sanitize_dates(start, end)
-    if not is_index:
-        r = WYSRefresher()
-    else:
-        r = WYIRefresher()
     fp = r.get_data_path(code)
     if not fp.exists():
         # 使用当前交易股票刷新时，如股票长期停牌，历史数据没有保存在本地
@@ -103,26 +213,141 @@ def daily_history(code, start, end, is_index=False):
     ]
     stmt = query_stmt(*args)
     try:
-        df = query(fp, stmt)
-        # 原始代码表达为 "'600710" -> "600710"
-        df['股票代码'] = df['股票代码'].map(lambda x: x[1:])
+        if adjust:
+            df = _query(fp, stmt, _with_adjust_columns(columns, date_col))
+        else:
+            df = _query(fp, stmt, columns)
+        if '股票代码' in df:
+            # 原始代码表达为 "'600710" -> "600710"
+            df['股票代码'] = df['股票代码'].str[1:]
+        if adjust:
+            df = _adjusted(df, code, adjust, date_col, columns)
         return df
     except KeyError:
         # 新股尚未有历史成交数据
         return pd.DataFrame()
 
 
-def margin(code, start, end):
-    """深证信期间融资融券数据"""
+def _daily_refresher(is_index):
+    return WYIRefresher() if is_index else WYSRefresher()
+
+
+def _read_daily_batch(args):
+    """读取一批代码的日线数据，返回合并后的数据框"""
+    fps, codes, stmt, columns = args
+    dfs = []
+    for fp, code in zip(fps, codes):
+        try:
+            df = query(fp, stmt, columns)
+        except (FileNotFoundError, ValueError):
+            continue
+        if df.empty:
+            continue
+        # 单个文件只含一个代码，直接赋值替代逐行去除前缀`'`
+        df['股票代码'] = code
+        dfs.append(df)
+    if not dfs:
+        return None
+    return pd.concat(dfs, ignore_index=True, sort=False)
+
+
+def bulk_daily_history(codes=None,
+                       start=None,
+                       end=None,
+                       is_index=False,
+                       columns=None,
+                       field=None,
+                       processes=MAX_WORKER,
+                       adjust=None):
+    """多个代码日线行情（股票/指数）
+
+    Notes:
+    ------
+        各代码分别存储，使用进程池分批并行读取
+        本地尚无数据的代码忽略，不会提取网络数据
+
+    Keyword Arguments:
+        codes {list} -- 代码列表，`None`代表本地全部代码 (default: {None})
+        start {date_like} -- 开始时间 (default: {None})
+        end {date_like} -- 结束时间 (default: {None})
+        is_index {bool} -- 是否为指数，默认为股票 (default: {False})
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+        field {str} -- 指定列名称时返回(日期 × 代码)面板 (default: {None})
+        processes {int} -- 进程数，1代表在本进程读取 (default: {MAX_WORKER})
+        adjust {str} -- 股票复权方式，`qfq`前复权、`hfq`后复权，`None`代表不复权 (default: {None})
+
+    Returns:
+        DataFrame -- 长格式日线数据框，或以日期为索引、代码为列的面板
+
+    Usage:
+    >>> close = bulk_daily_history(start='2020-01-01', field='收盘价')
+    """
+    assert not (is_index and adjust), '指数不需要复权'
+    start, end = sanitize_dates(start, end)
+    r = _daily_refresher(is_index)
+    if codes is None:
+        root = r.get_data_path('000001').parent
+        codes = sorted(fp.stem for fp in root.glob('*.h5'))
+    else:
+        codes = [codes] if isinstance(codes, str) else list(codes)
+    date_col = r.get_index_col(None)
+    if field is not None:
+        columns = [date_col, field]
+    elif columns is not None:
+        columns = list(columns)
+    read_columns = columns
+    if adjust:
+        read_columns = _with_adjust_columns(columns, date_col)
+    stmt = query_stmt(
+        (date_col, Ops.gte, start),
+        (date_col, Ops.lse, end),
+    )
+    fps = [r.get_data_path(code) for code in codes]
+    # 每个进程分多批，避免个别大文件拖慢整体进度
+    n = max(1, min(processes, len(codes) // 8))
+    size = max(1, -(-len(codes) // (n * 4)))
+    batches = [(fps[i:i + size], codes[i:i + size], stmt, read_columns)
+               for i in range(0, len(codes), size)]
+    if n == 1:
+        dfs = [_read_daily_batch(batch) for batch in batches]
+    else:
+        with Pool(n) as pool:
+            dfs = pool.map(_read_daily_batch, batches)
+    dfs = [df for df in dfs if df is not None]
+    if not dfs:
+        return pd.DataFrame()
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    if adjust:
+        keep = None if columns is None else columns + ['股票代码']
+        df = _adjusted(df, codes, adjust, date_col, keep)
+    if field is not None:
+        return df.pivot(index=date_col, columns='股票代码', values=field)
+    return df
+
+
+def margin(code, start, end, columns=None):
+    """深证信期间融资融券数据
+
+    Arguments:
+        code {str or list} -- 股票代码或代码列表，`None`代表全部
+        start {date_like} -- 开始时间
+        end {date_like} -- 结束时间
+
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
+
+    Returns:
+        DataFrame -- 融资融券数据
+    """
     start, end = sanitize_dates(start, end)
     r = MarginDataRefresher()
     fp = r.get_data_path(None)
     stmt = query_stmt(*[
-        ('股票代码', Ops.eq, code),
+        ('股票代码', Ops.eq, _codes(code)),
         ('交易日期', Ops.gte, start),
         ('交易日期', Ops.lse, end),
     ])
-    return query(fp, stmt)
+    return _query(fp, stmt, columns)
 
 
 def quotes(date):
@@ -160,13 +385,16 @@ def cjmx(code, date):
 
 
 # region 信息
-def news(cate, start, end):
+def news(cate, start, end, columns=None):
     """期间新浪财经消息
     
     Arguments:
-        cate {str} -- 类别，如None代表全部
+        cate {str or list} -- 类别或类别列表，如None代表全部
         start {date_like} -- 开始时间
         end {date_like} -- 结束时间
+
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
     
     Returns:
         DataFrame -- 消息数据
@@ -174,29 +402,41 @@ def news(cate, start, end):
     start = pd.Timestamp(start)
     end = pd.Timestamp(end)
     args = [
-        ('分类', Ops.eq, cate),
+        ('分类', Ops.eq, _codes(cate)),
         ('时间', Ops.gte, start),
         ('时间', Ops.lse, end),
     ]
     stmt = query_stmt(*args)
     r = SinaNewsRefresher()
     fp = r.get_data_path(None)
-    return query(fp, stmt)
+    return _query(fp, stmt, columns)
+
+
+def disclosure(code, start, end, columns=None):
+    """公司公告
+
+    Arguments:
+        code {str or list} -- 股票代码或代码列表，`None`代表全部
+        start {date_like} -- 开始时间
+        end {date_like} -- 结束时间
 
+    Keyword Arguments:
+        columns {list} -- 列名称，`None`代表全部 (default: {None})
 
-def disclosure(code, start, end):
-    """公司公告"""
+    Returns:
+        DataFrame -- 公告数据
+    """
     start = pd.Timestamp(start)
     end = pd.Timestamp(end)
     r = DisclosureRefresher()
     fp = r.get_data_path(None)
     args = [
-        ('股票代码', Ops.eq, code),
+        ('股票代码', Ops.eq, _codes(code)),
         ('公告时间', Ops.gte, start),
         ('公告时间', Ops.lse, end),
     ]
     stmt = query_stmt(*args)
-    return query(fp, stmt)
+    return _query(fp, stmt, columns)
 
 
 def ths_gn():
@@ -224,11 +464,19 @@ def classify_bom():
 
 
 def classify_tree(plate=None, code=None):
-    """股票分类树或股票行业映射"""
+    """股票分类树或股票行业映射
+
+    Keyword Arguments:
+        plate {str} -- 分类，`None`代表整个分类树 (default: {None})
+        code {str or list} -- 股票代码或代码列表，`None`代表全部 (default: {None})
+
+    Returns:
+        DataFrame or dict -- 分类树或{股票代码: 分类名称}
+    """
     r = ClassifyTreeRefresher()
     if plate is None:
-        df = r.get_table_data()
-        return df
+        fps = [r.get_data_path(one) for one in r.iterables]
+        return query_cache.get_or_load(fps, (), r.get_table_data)
     # 申万、国证、证监会、地区分类
     valid_plate = [
         v[:3] if k == '137002' else v[:2] for k, v in PLATE_MAPS.items()
@@ -239,11 +487,11 @@ def classify_tree(plate=None, code=None):
     fp = r.get_data_path(one)
     args = [
         ('平台类别', Ops.eq, plate_code),
-        ('股票代码', Ops.eq, code),
+        ('股票代码', Ops.eq, _codes(code)),
     ]
     stmt = query_stmt(*args)
-    df = query(fp, stmt)
-    if code:
+    df = _query(fp, stmt, ['股票代码', '分类名称'])
+    if isinstance(code, str):
         return {code: df['分类名称'].values[0]}
     else:
         part = df[['股票代码', '分类名称']]
@@ -263,9 +511,7 @@ def calendar():
     Returns:
         array -- 交易日历 datetime64[ns]
     """
-    fp = data_root('trading_calendar.h5')
-    h = HDFData(fp, 'a')
-    return h.data['trading_date'].values
+    return trading_dates()
 
 
 def treasury(start, end):
@@ -282,16 +528,17 @@ def treasury(start, end):
 
 
 # region 深证信高级搜索
-def asr_data(level, code=None, start=None, end=None):
+def asr_data(level, code=None, start=None, end=None, columns=None):
     """深证信高级搜索项目数据
     
     Arguments:
         level {str} -- 项目层级
-        code {str} -- 股票代码
+        code {str or list} -- 股票代码或代码列表
     
     Keyword Arguments:
         start {date-like} -- 开始日期 (default: {None})
         end {date-like} -- 结束日期 (default: {None})
+        columns {list} -- 列名称，`None`代表全部，宽表只读取所需列 (default: {None})
     
     Returns:
         DataFrame -- 项目数据
@@ -304,13 +551,13 @@ def asr_data(level, code=None, start=None, end=None):
     code_str = '股票代码'
     date_str = DB_CONFIG[level]['date_field'][0]
     args = [
-        (code_str, Ops.eq, code),
+        (code_str, Ops.eq, _codes(code)),
         (date_str, Ops.gte, start),
         (date_str, Ops.lse, end),
     ]
     stmt = query_stmt(*args)
-    df = query(fp, stmt)
-    if not df.empty:
+    df = _query(fp, stmt, columns)
+    if not df.empty and code_str in df:
         # 少数项目股票名称解析错误，在此修正
         df[code_str] = df[code_str].map(lambda x: str(int(x)).zfill(6))
     return df
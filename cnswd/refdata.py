@@ -0,0 +1,343 @@
+"""参考数据内存映射
+
+Notes:
+    1. 交易日历及最新股票代码列表刷新时导出为`.npy`文件(`refdata`目录)
+    2. 读取时以内存映射方式加载，不复制数据，多个进程共享页面缓存
+    3. 进程内缓存映射数组，以文件状态判断是否有效，文件更新后重新映射
+    4. `.npy`文件不存在时由`trading_calendar.h5`导出(兼容此前刷新的数据)
+    5. `TradingCalendar`以二分查找完成交易日判断及推算，日历覆盖期间之后
+       (未来)的日期尚不能确定，视周一至周五为交易日
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import BDay
+
+from .data import HDFData
+from .setting.constants import TZ
+from .storage import file_stamp
+from .utils import data_root
+
+CALENDAR_NAME = 'trading_dates'
+CALENDAR_END_NAME = 'calendar_end'
+CODES_NAME = 'stock_codes'
+
+# 交易时段(含首尾)
+SESSION_TIMES = (('09:30:00', '11:30:00'), ('13:00:00', '15:00:00'))
+
+_ONE_DAY = np.timedelta64(1, 'D')
+_EMPTY = np.array([], dtype='datetime64[ns]')
+
+# 进程内缓存 {名称: (文件状态, 数组)}
+_cache = {}
+
+
+def ref_path(name):
+    """参考数据文件路径"""
+    return data_root(f'refdata/{name}.npy')
+
+
+def _save(name, arr):
+    """以替换方式写入，避免读取进程映射到写入中途的文件"""
+    fp = ref_path(name)
+    tmp = fp.with_name(f".{fp.name}.{os.getpid()}")
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, arr, allow_pickle=False)
+        os.replace(tmp, fp)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    _cache.pop(name, None)
+
+
+def export_calendar(dates, end=None):
+    """导出交易日历
+
+    Arguments:
+        dates {iterable} -- 交易日期
+
+    Keyword Arguments:
+        end {date_like} -- 日历覆盖的最后日期，默认为最后交易日 (default: {None})
+    """
+    arr = pd.DatetimeIndex(dates).sort_values().values.astype('datetime64[ns]')
+    ends = list(arr[-1:])
+    if end is not None:
+        ends.append(_to_date(end))
+    _save(CALENDAR_NAME, arr)
+    _save(CALENDAR_END_NAME,
+          np.array([max(ends)] if ends else [], dtype='datetime64[ns]'))
+
+
+def export_codes(codes):
+    """导出股票代码列表
+
+    Arguments:
+        codes {list} -- 股票代码
+    """
+    arr = np.array(sorted(codes), dtype='U6')
+    _save(CODES_NAME, arr)
+
+
+def export_from_hdf():
+    """由`trading_calendar.h5`导出全部参考数据"""
+    h = HDFData(data_root('trading_calendar.h5'), 'w')
+    export_calendar(h.data['trading_date'], h.record.get('last_date'))
+    export_codes(h.record.get('codes', []))
+
+
+def _load(name):
+    fp = ref_path(name)
+    stamp = file_stamp(fp)
+    cached = _cache.get(name)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    if stamp is None:
+        export_from_hdf()
+        stamp = file_stamp(fp)
+    arr = np.load(fp, mmap_mode='r', allow_pickle=False)
+    # 以普通数组视图使用，仍然共享映射内存
+    arr = arr.view(np.ndarray)
+    _cache[name] = (stamp, arr)
+    return arr
+
+
+def trading_dates():
+    """交易日历(只读) datetime64[ns]"""
+    return _load(CALENDAR_NAME)
+
+
+def calendar_end():
+    """交易日历覆盖的最后日期 datetime64[ns]，日历为空时为`None`"""
+    arr = _load(CALENDAR_END_NAME)
+    return arr[0] if len(arr) else None
+
+
+def stock_codes():
+    """最新股票代码列表(只读)"""
+    return _load(CODES_NAME)
+
+
+def is_trading_date(dt):
+    """是否为交易日(二分查找)
+
+    Arguments:
+        dt {datetime64} -- 不带时区信息的日期
+
+    Returns:
+        bool -- 是否为交易日
+    """
+    dates = trading_dates()
+    dt = np.datetime64(dt, 'ns')
+    loc = np.searchsorted(dates, dt)
+    return bool(loc < len(dates) and dates[loc] == dt)
+
+
+def _to_date(dt):
+    """不带时区信息的日期 datetime64[ns]"""
+    dt = pd.Timestamp(dt)
+    if dt.tz is not None:
+        dt = dt.tz_convert(TZ).tz_localize(None)
+    return dt.normalize().to_datetime64()
+
+
+def _is_weekday(d):
+    return pd.Timestamp(d).weekday() < 5
+
+
+class TradingCalendar(object):
+    """交易日历
+
+    用法
+    >>> calendar = get_calendar()
+    >>> calendar.next_session('2020-01-23')
+    Timestamp('2020-02-03 00:00:00')
+    """
+    def __init__(self, sessions=None, end=None):
+        """初始化
+
+        Keyword Arguments:
+            sessions {iterable} -- 交易日，默认使用刷新导出的交易日历 (default: {None})
+            end {date_like} -- 日历覆盖的最后日期，默认为最后交易日 (default: {None})
+        """
+        if sessions is None:
+            self._sessions = None
+            self._end = None
+        else:
+            self._sessions = pd.DatetimeIndex(
+                sessions).sort_values().values.astype('datetime64[ns]')
+            ends = list(self._sessions[-1:])
+            if end is not None:
+                ends.append(_to_date(end))
+            self._end = max(ends) if ends else None
+
+    def _data(self):
+        """(交易日数组, 日历覆盖的最后日期)"""
+        if self._sessions is not None:
+            return self._sessions, self._end
+        try:
+            return trading_dates(), calendar_end()
+        except FileNotFoundError:
+            # 尚未刷新交易日历，全部视为未来日期
+            return _EMPTY, None
+
+    @property
+    def sessions(self):
+        """全部交易日"""
+        return pd.DatetimeIndex(self._data()[0])
+
+    @property
+    def end_date(self):
+        """日历覆盖的最后日期，此后日期视周一至周五为交易日"""
+        end = self._data()[1]
+        return None if end is None else pd.Timestamp(end)
+
+    def is_session(self, dt):
+        """是否为交易日
+
+        Arguments:
+            dt {date_like} -- 日期，带时区信息时以北京时间计算
+
+        Returns:
+            bool -- 是否为交易日
+        """
+        d = _to_date(dt)
+        sessions, end = self._data()
+        if end is None or d > end:
+            return _is_weekday(d)
+        loc = np.searchsorted(sessions, d)
+        return bool(loc < len(sessions) and sessions[loc] == d)
+
+    def next_session(self, dt):
+        """此后首个交易日(不含当日)
+
+        Arguments:
+            dt {date_like} -- 日期
+
+        Returns:
+            Timestamp -- 交易日
+        """
+        d = _to_date(dt)
+        sessions, end = self._data()
+        loc = np.searchsorted(sessions, d, side='right')
+        if loc < len(sessions):
+            return pd.Timestamp(sessions[loc])
+        if end is not None and end > d:
+            d = end
+        return pd.Timestamp(d) + BDay()
+
+    def previous_session(self, dt):
+        """此前最后一个交易日(不含当日)
+
+        Arguments:
+            dt {date_like} -- 日期
+
+        Raises:
+            ValueError: 早于最初交易日
+
+        Returns:
+            Timestamp -- 交易日
+        """
+        d = _to_date(dt)
+        sessions, end = self._data()
+        if end is None or d > end:
+            prev = pd.Timestamp(d) - BDay()
+            if end is None or prev.to_datetime64() > end:
+                return prev
+        loc = np.searchsorted(sessions, d)
+        if loc == 0:
+            raise ValueError(f'{pd.Timestamp(d).date()}之前没有交易日')
+        return pd.Timestamp(sessions[loc - 1])
+
+    def sessions_in_range(self, start, end):
+        """期间交易日(含首尾)
+
+        Arguments:
+            start {date_like} -- 开始日期
+            end {date_like} -- 结束日期
+
+        Returns:
+            DatetimeIndex -- 交易日
+        """
+        start, stop = _to_date(start), _to_date(end)
+        sessions, last = self._data()
+        i = np.searchsorted(sessions, start)
+        j = np.searchsorted(sessions, stop, side='right')
+        res = pd.DatetimeIndex(sessions[i:j])
+        if last is None or stop > last:
+            if last is not None and start <= last:
+                start = last + _ONE_DAY
+            res = res.append(pd.bdate_range(start, stop))
+        return res
+
+    def sessions_window(self, dt, count):
+        """截至指定日期(含)的最近`count`个交易日
+
+        Arguments:
+            dt {date_like} -- 日期
+            count {int} -- 交易日数量
+
+        Returns:
+            DatetimeIndex -- 交易日
+        """
+        d = _to_date(dt)
+        sessions, end = self._data()
+        j = np.searchsorted(sessions, d, side='right')
+        res = pd.DatetimeIndex(sessions[max(j - count, 0):j])
+        if end is None or d > end:
+            if end is None:
+                future = pd.bdate_range(end=d, periods=count)
+            else:
+                future = pd.bdate_range(end + _ONE_DAY, d)
+            res = res.append(future)
+        return res[-count:]
+
+    def minutes_for_session(self, dt):
+        """交易日各分钟(与分钟K线一致，以分钟结束时间标记)
+
+        Arguments:
+            dt {date_like} -- 交易日
+
+        Raises:
+            ValueError: 非交易日
+
+        Returns:
+            DatetimeIndex -- 09:31-11:30及13:01-15:00共240分钟
+        """
+        if not self.is_session(dt):
+            raise ValueError(f'{pd.Timestamp(dt).date()}不是交易日')
+        d = pd.Timestamp(_to_date(dt))
+        minutes = [
+            pd.date_range(d + pd.Timedelta(start) + pd.Timedelta(minutes=1),
+                          d + pd.Timedelta(end),
+                          freq='min') for start, end in SESSION_TIMES
+        ]
+        return minutes[0].append(minutes[1:])
+
+    def is_open_on_minute(self, dt):
+        """是否为交易时段
+
+        Arguments:
+            dt {Timestamp} -- 时间，带时区信息时以北京时间计算
+
+        Returns:
+            bool -- 是否为交易时段
+        """
+        dt = pd.Timestamp(dt)
+        if dt.tz is not None:
+            dt = dt.tz_convert(TZ).tz_localize(None)
+        if not self.is_session(dt):
+            return False
+        t = dt - dt.normalize()
+        return any(
+            pd.Timedelta(start) <= t <= pd.Timedelta(end)
+            for start, end in SESSION_TIMES)
+
+
+_calendar = TradingCalendar()
+
+
+def get_calendar():
+    """进程内共享的交易日历(交易日历刷新后自动重新映射)"""
+    return _calendar
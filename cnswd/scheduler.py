@@ -0,0 +1,236 @@
+"""动态任务调度
+
+Notes:
+    1. 每个项目为单独任务，由调度进程分派给空闲的工作进程，先完成的进程随即领取下一任务，
+       个别耗时长的项目不会拖住其他项目，总耗时取决于总工作量
+    2. 任务超时时终止执行该任务的工作进程并启动新进程，其他进程不受影响
+    3. 任务异常只影响该任务；失败任务进入重试队列，在全部首次任务分派后重新执行
+    4. 超过重试次数的任务记入失败列表，不影响整体完成
+    5. 工作进程可指定初始化及结束函数，如每个进程只打开一次浏览器
+    6. 启用写入服务时，各工作进程的写入转发至单一写入进程(参阅`writer.py`)，
+       写入失败的项目在全部任务结束后记入失败列表(不再重试)
+    7. 指定自适应并发控制时，同时执行的任务数随来源状况增减，工作进程按需启动
+       (参阅`concurrency.py`)
+
+用法
+>>> report = run_tasks(refresh_one, codes, timeout=300)
+>>> report.failed
+{'000001': "TimeoutError('超过300秒')"}
+"""
+import time
+from collections import deque
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+
+from .setting.config import DEFAULT_CONFIG
+from .setting.constants import MAX_WORKER
+from .utils import make_logger
+from .writer import set_task, use_writer, writer_service
+
+logger = make_logger('scheduler')
+
+
+def _work(conn, func, initializer, initargs, finalizer, queue):
+    """工作进程主循环"""
+    if queue is not None:
+        use_writer(queue)
+    if initializer is not None:
+        initializer(*initargs)
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            if queue is not None:
+                set_task(task[0])
+            try:
+                res = (True, func(task[0]))
+            except Exception as e:
+                res = (False, f'{e!r}')
+            try:
+                conn.send(res)
+            except Exception as e:
+                # 返回值无法序列化
+                conn.send((False, f'{e!r}'))
+    finally:
+        if finalizer is not None:
+            finalizer()
+
+
+class _Worker(object):
+    """工作进程及当前任务"""
+    def __init__(self, args):
+        self.conn, child = Pipe()
+        self.process = Process(target=_work, args=(child, *args))
+        self.process.start()
+        child.close()
+        self.task = None
+        self.started = None
+
+    @property
+    def idle(self):
+        return self.task is None
+
+    def assign(self, task):
+        self.task = task
+        self.started = time.time()
+        self.conn.send((task[0], ))
+
+    def done(self):
+        task, self.task = self.task, None
+        return task
+
+    def stop(self, force=False):
+        if force:
+            self.process.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class TaskReport(object):
+    """任务执行结果"""
+    def __init__(self):
+        # {项目: 返回值}
+        self.results = {}
+        # {项目: 最后一次错误}
+        self.failed = {}
+        # 重试次数
+        self.retried = 0
+        self.elapsed = 0.
+
+    def __repr__(self):
+        return (f'完成{len(self.results)}项，失败{len(self.failed)}项，'
+                f'重试{self.retried}次，用时{self.elapsed:.1f}秒')
+
+
+def run_tasks(func,
+              items,
+              processes=None,
+              timeout=None,
+              retries=None,
+              initializer=None,
+              initargs=(),
+              finalizer=None,
+              writer=False,
+              limiter=None):
+    """以工作进程动态执行项目任务
+
+    Arguments:
+        func {callable} -- 单个项目的任务函数
+        items {iterable} -- 项目列表
+
+    Keyword Arguments:
+        processes {int} -- 工作进程数上限，默认为`MAX_WORKER`，指定并发控制时为其最大并发数 (default: {None})
+        timeout {float} -- 单个任务超时秒数，默认按配置`task_timeout`，0代表不限 (default: {None})
+        retries {int} -- 失败任务重试次数，默认按配置`task_retries` (default: {None})
+        initializer {callable} -- 工作进程初始化函数 (default: {None})
+        initargs {tuple} -- 初始化函数参数 (default: {()})
+        finalizer {callable} -- 工作进程结束函数 (default: {None})
+        writer {bool} -- 是否启用单一写入进程 (default: {False})
+        limiter {AdaptiveLimiter} -- 自适应并发控制 (default: {None})
+
+    Returns:
+        TaskReport -- 各项目返回值及失败项目
+    """
+    if timeout is None:
+        timeout = DEFAULT_CONFIG.get('task_timeout', 0)
+    if retries is None:
+        retries = DEFAULT_CONFIG.get('task_retries', 0)
+    if processes is None:
+        processes = MAX_WORKER if limiter is None else limiter.maximum
+    # (项目, 已执行次数)
+    pending = deque((item, 0) for item in items)
+    if writer:
+        failed = {}
+        with writer_service(failed=failed) as queue:
+            report = _run(func, pending, processes, timeout, retries, limiter,
+                          (func, initializer, initargs, finalizer, queue))
+        for item, error in failed.items():
+            report.results.pop(item, None)
+            report.failed[item] = error
+            logger.error(f'{item} 写入失败 {error}')
+        return report
+    return _run(func, pending, processes, timeout, retries, limiter,
+                (func, initializer, initargs, finalizer, None))
+
+
+def _run(func, pending, processes, timeout, retries, limiter, args):
+    report = TaskReport()
+    start = time.time()
+    retry = deque()
+
+    def failed(task, error, started):
+        if limiter is not None:
+            limiter.on_error(error, started)
+        item, attempts = task
+        if attempts < retries:
+            report.retried += 1
+            retry.append((item, attempts + 1))
+            logger.warning(f'{item} 第{attempts + 1}次执行失败 {error}')
+        else:
+            report.failed[item] = error
+            logger.error(f'{item} 执行失败 {error}')
+
+    n = max(1, min(processes, len(pending)))
+    workers = []
+    try:
+        while True:
+            capacity = n if limiter is None else min(n, limiter.capacity)
+            busy_num = sum(not w.idle for w in workers)
+            while busy_num < capacity and (pending or retry):
+                w = next((w for w in workers if w.idle), None)
+                if w is None:
+                    # 按需启动工作进程
+                    w = _Worker(args)
+                    workers.append(w)
+                w.assign(pending.popleft() if pending else retry.popleft())
+                busy_num += 1
+            busy = [w for w in workers if not w.idle]
+            if not busy:
+                break
+            wait_seconds = None
+            if timeout:
+                now = time.time()
+                wait_seconds = max(
+                    0, min(w.started + timeout - now for w in busy))
+            ready = wait([w.conn for w in busy], wait_seconds)
+            for i, w in enumerate(workers):
+                if w.idle:
+                    continue
+                if w.conn in ready:
+                    try:
+                        ok, res = w.conn.recv()
+                    except (EOFError, OSError):
+                        # 工作进程异常退出
+                        w.stop(True)
+                        ok, res = False, f'工作进程退出 exitcode={w.process.exitcode}'
+                        workers[i] = _Worker(args)
+                    started, task = w.started, w.done()
+                    if ok:
+                        report.results[task[0]] = res
+                        if limiter is not None:
+                            limiter.on_success(time.time() - started)
+                    else:
+                        failed(task, res, started)
+                elif timeout and time.time() - w.started >= timeout:
+                    started, task = w.started, w.done()
+                    w.stop(True)
+                    workers[i] = _Worker(args)
+                    failed(task, f"TimeoutError('超过{timeout}秒')", started)
+    finally:
+        for w in workers:
+            w.stop(not w.idle)
+    report.elapsed = time.time() - start
+    logger.info(f"{getattr(func, '__name__', func)} {report!r}")
+    return report
@@ -0,0 +1,89 @@
+"""
+复权因子
+
+网易股票日线刷新后执行，只计算新增日线
+"""
+import os
+
+import pandas as pd
+
+from ..adjustment import FACTOR_COLUMNS, adjustment_path, compute_factors
+from ..data import HDFData, default_status
+from ..reader import bulk_daily_history
+from ..utils import make_logger
+from .refresh import WYSRefresher
+
+logger = make_logger('复权因子')
+
+
+def _state_path(fp):
+    return fp.with_name(f"{fp.name}.state")
+
+
+def _load_state(fp):
+    try:
+        return pd.read_pickle(_state_path(fp))
+    except FileNotFoundError:
+        return None
+
+
+def _save_state(fp, state):
+    state_fp = _state_path(fp)
+    tmp = state_fp.with_name(f".{state_fp.name}.{os.getpid()}")
+    state.to_pickle(tmp)
+    os.replace(tmp, state_fp)
+
+
+def refresh_adjustment(codes=None, rebuild=False):
+    """刷新复权因子
+
+    Keyword Arguments:
+        codes {list} -- 股票代码列表，`None`代表本地全部股票 (default: {None})
+        rebuild {bool} -- 是否由全部日线重新计算 (default: {False})
+
+    Returns:
+        int -- 新增因子行数
+    """
+    fp = adjustment_path()
+    hdf = HDFData(fp, 'a')
+    state = None if rebuild else _load_state(fp)
+    if state is None or not fp.exists():
+        # 状态与数据必须一致，任一缺失时重新计算
+        if fp.exists():
+            hdf.engine.remove(fp)
+        state = None
+    if codes is None:
+        root = WYSRefresher().get_data_path('000001').parent
+        codes = sorted(p.stem for p in root.glob('*.h5'))
+    columns = ['日期', '收盘价', '前收盘']
+    # 按上次处理日期分组读取，新代码读取全部日线
+    starts = {} if state is None else state['last_date'].to_dict()
+    groups = {}
+    for code in codes:
+        groups.setdefault(starts.get(code), []).append(code)
+    dfs = [
+        bulk_daily_history(group, start, None, columns=columns)
+        for start, group in groups.items()
+    ]
+    dfs = [df for df in dfs if not df.empty]
+    if not dfs:
+        return 0
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    events, state = compute_factors(df, state)
+    if len(events):
+        record = default_status.copy()
+        record['completed'] = True
+        # 各代码除权日期交错，以(代码, 日期)去重
+        record['index_col'] = None
+        record['completed_time'] = pd.Timestamp.now()
+        kwargs = {
+            'data_columns': FACTOR_COLUMNS[:2],
+            'subset': FACTOR_COLUMNS[:2],
+            'min_itemsize': {
+                '股票代码': 6
+            },
+        }
+        hdf.add(events, record, kwargs)
+    _save_state(fp, state)
+    logger.info(f'新增复权因子{len(events)}行')
+    return len(events)
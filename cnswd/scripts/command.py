@@ -13,12 +13,22 @@ $ stock szxs
 from __future__ import absolute_import, division, print_function
 
 import asyncio
+import os
+import shutil
+import time
 
 import click
 import pandas as pd
 
-from ..setting.config import DB_CONFIG
-from ..utils import kill_firefox, remove_temp_files
+from ..setting.config import CODECS, DB_CONFIG, DEFAULT_CONFIG
+from ..data import HDFData, to_hdf_kwargs
+from ..panel import append_panel, build_panel
+from ..query_utils import Ops, query, query_stmt
+from ..storage import codec_kwargs, get_engine, store_pool
+from ..storage import migrate as migrate_to_parquet
+from ..storage import partition as partition_data
+from ..utils import data_root, kill_firefox, remove_temp_files
+from .adjustment import refresh_adjustment
 from .fs import fs_refresh_all
 from .quote import refresh_live_quote
 from .refresh import (ASRefresher, ClassifyBomRefresher, ClassifyTreeRefresher,
@@ -30,6 +40,7 @@ from .ths_gn import update_gn_list, update_gn_time
 from .trading_calendar import refresh_trading_calendar
 from .wy_cjmx import refresh_wy_cjmx
 from .yahoo import refresh_all as refresh_yahoo_data
+from .tct_minutely import compact_all as compact_minutely
 from .tct_minutely import refresh_minutely_prices
 
 
@@ -117,17 +128,46 @@ def asr(item):
 
 
 @stock.command()
-def wys():
+@click.option('--pool', is_flag=True, help='以多进程刷新(默认在单进程中以协程刷新)')
+def wys(pool):
     """刷新<网易股票日线>数据"""
     r = WYSRefresher()
-    r.refresh_all()
+    if pool:
+        r.refresh_all()
+    else:
+        asyncio.run(r.refresh_all_async())
+    # 新增日线中的除权除息
+    refresh_adjustment()
+    # 已生成面板时追加新交易日
+    append_panel(build=False)
+
+
+@stock.command()
+@click.option('--rebuild', is_flag=True, help='由全部日线重新计算')
+def adjustment(rebuild):
+    """刷新股票复权因子"""
+    refresh_adjustment(rebuild=rebuild)
+
+
+@stock.command()
+@click.option('--rebuild', is_flag=True, help='由全部日线重新生成')
+def panel(rebuild):
+    """生成或追加日线面板(日期 × 代码)"""
+    if rebuild:
+        build_panel()
+    else:
+        append_panel()
 
 
 @stock.command()
-def wyi():
+@click.option('--pool', is_flag=True, help='以多进程刷新(默认在单进程中以协程刷新)')
+def wyi(pool):
     """刷新<网易股指日线>数据"""
     r = WYIRefresher()
-    r.refresh_all()
+    if pool:
+        r.refresh_all()
+    else:
+        asyncio.run(r.refresh_all_async())
 
 
 @stock.command()
@@ -180,9 +220,13 @@ def tctgn():
 
 
 @stock.command()
-def tctm():
+@click.option('--compact', is_flag=True, help='只合并此前各日分钟快照')
+def tctm(compact):
     """刷新腾讯分钟级别交易数据"""
-    refresh_minutely_prices()
+    if compact:
+        compact_minutely()
+    else:
+        refresh_minutely_prices()
 
 
 # endregion
@@ -209,4 +253,236 @@ def clean():
     kill_firefox()
 
 
+@stock.command()
+@click.option('--path', default=None, help='数据子目录，默认为全部数据')
+@click.option('--remove', is_flag=True, help='转换后删除h5文件')
+def migrate(path, remove):
+    """h5数据转换为parquet存储
+
+    转换完成后，修改`DEFAULT_CONFIG['storage']`为`parquet`
+    """
+    root = DEFAULT_CONFIG['data_root'] if path is None else data_root(path)
+    for fp in sorted(root.rglob('*.h5')):
+        try:
+            rows = migrate_to_parquet(fp, remove)
+            click.echo(f"转换{rows}行 -> {fp}")
+        except ValueError:
+            # 非`HDFData`管理的文件，保持原格式
+            click.echo(f"跳过 {fp}")
+        except Exception as e:
+            click.echo(f"转换失败 {fp} {e!r}")
+
+
+@stock.command()
+@click.option('--remove', is_flag=True, help='转换后删除原数据')
+def partition(remove):
+    """大型添加式数据转换为按期间分区存储
+
+    包括公司公告、财经消息、融资融券及财务报告
+    """
+    items = [(DisclosureRefresher(), None), (SinaNewsRefresher(), None),
+             (MarginDataRefresher(), None)]
+    items += [(ASRefresher(), one) for one in DB_CONFIG.keys()]
+    for r, one in items:
+        freq = r.get_partition_freq(one)
+        fp = r.get_data_path(one)
+        if freq is None or not fp.exists():
+            continue
+        kwargs = to_hdf_kwargs.copy()
+        kwargs.pop('ignore_index')
+        kwargs['data_columns'] = r.get_data_columns(one)
+        kwargs['min_itemsize'] = r.get_min_itemsize(one)
+        try:
+            rows = partition_data(fp, r.get_index_col(one), freq, kwargs,
+                                  remove)
+            click.echo(f"分区{rows}行 -> {fp}")
+        except Exception as e:
+            click.echo(f"分区失败 {fp} {e!r}")
+
+
+def _data_files(path):
+    """`HDFData`管理且含数据的文件 (逻辑路径, HDFData)"""
+    root = DEFAULT_CONFIG['data_root'] if path is None else data_root(path)
+    fps = set()
+    for suffix in ('h5', 'parquet', 'parts'):
+        fps.update(p.with_suffix('.h5') for p in root.rglob(f'*.{suffix}'))
+    for fp in sorted(fps):
+        hdf = HDFData(fp, 'a')
+        if hdf.engine.describe(fp)['record'] is None:
+            # 非`HDFData`管理的文件
+            continue
+        if not hdf.has_data:
+            continue
+        yield fp, hdf
+
+
+def _probe_stmt(hdf):
+    """用于测试查询耗时的典型查询条件"""
+    codes = hdf.get_codes()
+    if codes:
+        return query_stmt(('股票代码', Ops.eq, codes[len(codes) // 2]))
+    index_col = hdf.record['index_col']
+    if index_col is None:
+        return []
+    return query_stmt((index_col, Ops.gte, hdf.get_max_index(index_col)))
+
+
+def _probe_latency(fp, stmt, times=3):
+    """查询耗时(毫秒，多次取最小值)"""
+    res = []
+    for _ in range(times):
+        start = time.perf_counter()
+        query(fp, stmt)
+        res.append((time.perf_counter() - start) * 1000)
+    return min(res)
+
+
+@stock.command()
+@click.option('--path', default=None, help='数据子目录，默认为全部数据')
+@click.option('--codec', default=None, help='重新压缩，如`zstd`、`lz4:5`，默认保持不变')
+def compact(path, codec):
+    """整理数据存储碎片
+
+    按(股票代码, 索引列)排序重写并重建索引，报告整理前后的大小及查询耗时
+    """
+    for fp, hdf in _data_files(path):
+        try:
+            stmt = _probe_stmt(hdf)
+            size, latency = hdf.engine.size(fp), _probe_latency(fp, stmt)
+            hdf.compact(codec=codec)
+            new_size = hdf.engine.size(fp)
+            new_latency = _probe_latency(fp, stmt)
+            mb = 1024**2
+            click.echo(f"{fp}\n"
+                       f"  大小 {size/mb:.2f}MB -> {new_size/mb:.2f}MB"
+                       f"  查询 {latency:.1f}ms -> {new_latency:.1f}ms")
+        except Exception as e:
+            click.echo(f"整理失败 {fp} {e!r}")
+
+
+def _indexed_latency(fp, columns, stmt):
+    """在副本上创建索引后的查询耗时(毫秒)，仅支持h5文件"""
+    engine = get_engine(fp)
+    if engine.name != 'hdf':
+        return None
+    tmp = DEFAULT_CONFIG['data_root'] / f'.index.{os.getpid()}.h5'
+    try:
+        shutil.copyfile(fp, tmp)
+        engine.create_index(tmp, columns)
+        return _probe_latency(tmp, stmt)
+    finally:
+        store_pool.release(tmp)
+        if tmp.exists():
+            tmp.unlink()
+
+
+@stock.command()
+@click.option('--path', default=None, help='数据子目录，默认为全部数据')
+@click.option('--check', is_flag=True, help='只检查缺少索引的文件，报告创建索引后的查询耗时')
+def index(path, check):
+    """为数据列创建完整排序索引(CSI)
+
+    刷新时自动维护索引，用于此前刷新的数据
+    """
+    for fp, hdf in _data_files(path):
+        try:
+            missing = hdf.engine.missing_index(fp)
+            if not missing:
+                click.echo(f"{fp} 已索引")
+                continue
+            if not check:
+                created = hdf.ensure_index()
+                click.echo(f"{fp} 创建索引 {created}")
+                continue
+            stmt = _probe_stmt(hdf)
+            latency = _probe_latency(fp, stmt)
+            new_latency = _indexed_latency(fp, missing, stmt)
+            msg = f"{fp}\n  缺少索引 {missing}"
+            if new_latency is not None:
+                msg += (f"  查询 {latency:.1f}ms -> {new_latency:.1f}ms"
+                        f"({latency / new_latency:.1f}倍)")
+            click.echo(msg)
+        except Exception as e:
+            click.echo(f"检查失败 {fp} {e!r}")
+
+
+def _bench_codec(df, layout, codec, fp):
+    """测试单个压缩方式的写入耗时、读取耗时及文件大小"""
+    data_columns, min_itemsize, _ = layout
+    kwargs = codec_kwargs(codec)
+    start = time.perf_counter()
+    with pd.HDFStore(fp,
+                     mode='w',
+                     complevel=kwargs['complevel'] or None,
+                     complib=kwargs['complib']) as store:
+        store.append('data',
+                     df,
+                     data_columns=data_columns,
+                     min_itemsize=min_itemsize or None,
+                     expectedrows=len(df),
+                     index=False)
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    pd.read_hdf(fp, 'data')
+    read = time.perf_counter() - start
+    return write, read, fp.stat().st_size
+
+
+@stock.command()
+@click.option('--path', default=None, help='数据子目录，默认为全部数据')
+@click.option('--codec', multiple=True, help='压缩方式，可多次指定，默认全部')
+@click.option('--sample', default=5, help='测试文件数量(按大小选取)')
+@click.option('--rows', default=200000, help='每个文件最多读取行数')
+def codec(path, codec, sample, rows):
+    """比较各压缩方式的读写速度及文件大小
+
+    以本机最大的若干h5数据文件为样本，结果用于设置`DATASET_CODECS`
+    """
+    root = DEFAULT_CONFIG['data_root'] if path is None else data_root(path)
+    engine = get_engine(name='hdf')
+    fps = sorted(root.rglob('*.h5'), key=lambda p: p.stat().st_size)
+    samples = []
+    for fp in reversed(fps):
+        if len(samples) >= sample:
+            break
+        try:
+            layout = engine.layout(fp)
+            df = engine.select(fp, stop=rows)
+        except Exception:
+            # 非table格式或不含数据
+            continue
+        samples.append((fp, df, layout))
+    if not samples:
+        click.echo(f"{root}中没有可测试的h5文件")
+        return
+    codecs = codec or list(CODECS)
+    tmp = DEFAULT_CONFIG['data_root'] / f'.codec.{os.getpid()}.h5'
+    res = []
+    mb = 1024**2
+    try:
+        for fp, df, layout in samples:
+            raw = df.memory_usage(deep=True).sum() / mb
+            click.echo(f"{fp} {len(df)}行 {raw:.2f}MB")
+            for c in codecs:
+                write, read, size = _bench_codec(df, layout, c, tmp)
+                res.append({
+                    '压缩方式': c,
+                    '原始MB': raw,
+                    '写入秒': write,
+                    '读取秒': read,
+                    '文件MB': size / mb,
+                })
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    df = pd.DataFrame(res).groupby('压缩方式', sort=False).sum()
+    summary = pd.DataFrame({
+        '写入MB/s': df['原始MB'] / df['写入秒'],
+        '读取MB/s': df['原始MB'] / df['读取秒'],
+        '文件MB': df['文件MB'],
+        '压缩比': df['原始MB'] / df['文件MB'],
+    })
+    click.echo(summary.round(2).to_string())
+
+
 # endregion
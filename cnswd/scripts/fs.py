@@ -4,18 +4,20 @@
     按股票代码循环
 """
 
-import math
 from itertools import product
-from multiprocessing import Pool
 
 from cnswd.cninfo import FastSearcher
+from cnswd.concurrency import get_limiter
+from cnswd.scheduler import run_tasks
 from cnswd.scripts.cninfo_cols import CNINFO_COLS
 from cnswd.scripts.refresh import FSRefresher
 from cnswd.setting.constants import MAX_WORKER
-from cnswd.utils import loop_codes
 from cnswd.websource.tencent import get_recent_trading_stocks
 from numpy.random import shuffle
 
+# 工作进程内的浏览器，每个进程只打开一次
+_api = None
+
 
 def refresh_batch(batch):
     """分批刷新快速刷新项目"""
@@ -31,6 +33,32 @@ def refresh_batch(batch):
                 r.refresh_one(fetch_data_func, one, kwargs)
 
 
+def _open_api():
+    global _api
+    _api = FastSearcher()
+
+
+def _close_api():
+    global _api
+    if _api is not None and _api.driver:
+        _api.driver.quit()
+    _api = None
+
+
+def refresh_item(one):
+    """刷新单个快速刷新项目(调度任务)，失败时重置浏览器再试一次，仍失败则引发异常"""
+    r = FSRefresher()
+    try:
+        r.refresh_one(_api.get_data, one, {})
+    except Exception as e:
+        r.last_error = e
+    if r.last_error is not None:
+        _api.reset()
+        r.refresh_one(_api.get_data, one, {})
+    if r.last_error is not None:
+        raise r.last_error
+
+
 def fs_refresh_all():
     """快速搜索数据刷新"""
     levels = CNINFO_COLS.keys()
@@ -38,10 +66,17 @@ def fs_refresh_all():
     # 随机化代码，以便均匀分布任务
     shuffle(codes)
     items = list(product(levels, codes))
-    batch_num = math.ceil(len(items) / MAX_WORKER)
-    batchs = loop_codes(items, batch_num)
-    with Pool(MAX_WORKER) as pool:
-        pool.map_async(refresh_batch, batchs).get()
+    # 各进程的写入由单一写入进程执行
+    # 每个工作进程打开一个浏览器，进程数不超过`MAX_WORKER`
+    report = run_tasks(refresh_item,
+                       items,
+                       processes=MAX_WORKER,
+                       initializer=_open_api,
+                       finalizer=_close_api,
+                       writer=True,
+                       limiter=get_limiter('webapi.cninfo.com.cn'))
+    if report.failed:
+        print(f'以下项目刷新失败 {list(report.failed)}')
 
 
 if __name__ == "__main__":
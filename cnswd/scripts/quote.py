@@ -1,14 +1,16 @@
 import asyncio
 import re
 
-import aiohttp
 import logbook
 import numpy as np
 import pandas as pd
 
-from ..data import HDFData
+from ..bars import refresh_bars
+from ..ratelimit import async_rate_limit
+from ..refdata import stock_codes
 from ..setting.constants import QUOTE_COLS
 from ..utils import data_root, loop_codes
+from ..websource.base import client_session
 from .trading_calendar import is_trading_day
 
 logger = logbook.Logger('实时报价')
@@ -47,8 +49,10 @@ def _add_prefix(stock_code):
 async def fetch(codes):
     url_fmt = 'http://hq.sinajs.cn/list={}'
     url = url_fmt.format(','.join(map(_add_prefix, codes)))
-    async with aiohttp.request('GET', url) as r:
-        data = await r.text()
+    await async_rate_limit(url)
+    async with client_session() as session:
+        async with session.get(url) as r:
+            data = await r.text()
     return data
 
 
@@ -67,12 +71,12 @@ async def to_dataframe(codes):
 
 async def fetch_all(fp, batch_num=800):
     """获取所有股票实时报价原始数据"""
-    t_fp = data_root('trading_calendar.h5')
-    h = HDFData(t_fp, 'a')
-    stock_codes = h.record['codes']
-    b_codes = loop_codes(stock_codes, batch_num)
+    codes = stock_codes().tolist()
+    b_codes = loop_codes(codes, batch_num)
     tasks = [to_dataframe(codes) for codes in b_codes]
-    dfs = await asyncio.gather(*tasks)
+    # 各批次共享会话及连接
+    async with client_session():
+        dfs = await asyncio.gather(*tasks)
     return pd.concat(dfs)
 
 
@@ -88,3 +92,7 @@ async def refresh_live_quote():
         df = df.loc[df['时间'] >= today.normalize(), :]
         df.to_hdf(fp, 'data', append=True)
         logger.info('添加{}行'.format(df.shape[0]))
+        try:
+            refresh_bars(df, 'live')
+        except Exception as e:
+            logger.error(f'生成K线失败 {e!r}')
@@ -48,7 +48,6 @@ Notes:
 
 import asyncio
 import json
-import math
 import os
 import random
 import sys
@@ -56,27 +55,33 @@ import time
 import warnings
 from functools import partial
 from itertools import product
-from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from numpy.random import shuffle
 
+from ..buffer import buffered_writes
+from ..concurrency import get_limiter
 from ..cninfo import (AdvanceSearcher, ClassifyTree, FastSearcher,
                       ThematicStatistics)
 from ..cninfo.utils import get_field_type, get_min_itemsize
 from ..data import HDFData, default_status
+from ..refdata import get_calendar
+from ..scheduler import run_tasks
 from ..setting.config import DB_CONFIG, TS_CONFIG
-from ..setting.constants import MAIN_INDEX, MARKET_START, MAX_WORKER, TZ
-from ..utils import (data_root, ensure_dt_localize, ensure_dtypes, loop_codes,
+from ..setting.constants import MAIN_INDEX, MARKET_START, TZ
+from ..storage import codec_kwargs, dataset_codec
+from ..utils import (data_root, ensure_dt_localize, ensure_dtypes,
                      loop_period_by, make_logger, time_for_next_update)
 from ..websource.disclosures import fetch_one_day
 from ..websource.sina_news import TOPIC_MAPS, Sina247News
 from ..websource.tencent import get_recent_trading_stocks
 from ..websource.treasuries import (EARLIEST_POSSIBLE_DATE, download_last_year,
                                     fetch_treasury_data_from)
-from ..websource.wy import fetch_history
+from ..websource.base import client_session
+from ..websource.wy import fetch_history, fetch_history_async
+from ..writer import current_writer, use_writer, writer_service
 from ..query_utils import query, query_stmt, Ops
 
 warnings.filterwarnings("ignore")
@@ -104,6 +109,11 @@ def _one_parse_helper(arg):
 
 
 class RefresherBase(object):
+    # 数据来源主机，指定时按来源自适应调整并发数
+    source = None
+    # 最近一次单项刷新失败的异常，成功时为`None`
+    last_error = None
+
     def __init__(self, retry_times=3):
         self.retry_times = retry_times
 
@@ -143,6 +153,18 @@ class RefresherBase(object):
         """索引列名称（保持唯一性）"""
         raise NotImplementedError('子类中完成')
 
+    def get_partition_freq(self, one):
+        """按索引列分区存储的频率(`Y`或`M`)，`None`代表不分区"""
+        return None
+
+    def get_codec(self, one):
+        """压缩方式，参阅`CODECS`及`DATASET_CODECS`"""
+        return dataset_codec(self.__class__.__name__.lower())
+
+    def get_codec_kwargs(self, one):
+        """压缩写入参数"""
+        return codec_kwargs(self.get_codec(one))
+
     def _is_index_col_dt_dtype(self, index_col):
         """确保索引列为datetime64[ns]类型"""
         dt_keys = ('日期', '时间')
@@ -182,7 +204,11 @@ class RefresherBase(object):
         """h5数据对象"""
         fp = self.get_data_path(one)
         mode = self.get_mode(one)
-        return HDFData(fp, mode)
+        freq = self.get_partition_freq(one)
+        if freq is None:
+            return HDFData(fp, mode)
+        partition = (self.get_index_col(one), freq)
+        return HDFData(fp, mode, partition=partition)
 
     def get_table_data(self, one):
         """获取表数据
@@ -260,12 +286,25 @@ class RefresherBase(object):
         """定义列字符串最小长度"""
         return {}
 
-    def refresh_one(self, fetch_data_func, one, kwargs):
-        """单项刷新"""
+    def _is_session_done(self, one, start, end, use_last_date):
+        """按交易日刷新的项目，非交易日且已完成上一交易日刷新时无需联网"""
+        if self.get_freq(one).upper() != 'B':
+            return False
+        calendar = get_calendar()
+        if calendar.is_session(end):
+            return False
+        prev = calendar.previous_session(end)
+        # 下次刷新时点所在交易日，或已刷新数据的最后日期
+        start = ensure_dt_localize(start).tz_localize(None).normalize()
+        return start >= prev if use_last_date else start > prev
+
+    def _begin_refresh(self, one, kwargs):
+        """刷新前准备，无需刷新时返回`None`"""
         data_columns = self.get_data_columns(one)
         kwargs.update({'data_columns': data_columns})
         # 由于初始化时一次性写入数据，忽略了min_itemsize问题
         kwargs.update({'min_itemsize': self.get_min_itemsize(one)})
+        kwargs.update(self.get_codec_kwargs(one))
 
         logger = self.logger
         hdf = self.get_hdfdata(one)
@@ -284,53 +323,157 @@ class RefresherBase(object):
             if ensure_dt_localize(start) > end:
                 logger.info(f'{one} 数据已经刷新')
                 return
+            if self._is_session_done(one, start, end, use_last_date):
+                logger.info(f'{one} 非交易日，上一交易日数据已经刷新')
+                return
         # 进入刷新
         # 重置完成状态
         record['completed'] = False
         arg = self.get_fetch_func_arg(one, start, end)
+        return hdf, record, arg, use_last_date
+
+    def _attempted(self, one, i, record, web_data, error, use_last_date):
+        """记录第`i`次提取结果"""
+        if error is None:
+            record['completed'] = True
+            record['memo'] = '-'  # 清除此前可能遗留的备注
+        else:
+            web_data = pd.DataFrame()
+            record['completed'] = False
+            record['memo'] = f"第{i}次尝试中出现异常{error}"
+        record['completed_time'] = pd.Timestamp.now(tz=TZ)
+        record['retry_times'] = i
+        return self._normalize_data(one, web_data, record, use_last_date)
 
+    def _end_refresh(self, hdf, web_data, record, kwargs):
+        """写入数据及记录，返回写入异常"""
+        try:
+            hdf.add(web_data, record, kwargs)
+        except Exception as e:
+            self.logger.error(f"{e!r}")
+            return e
+
+    def refresh_one(self, fetch_data_func, one, kwargs):
+        """单项刷新
+
+        Notes:
+        ------
+            异常不向外引发；多次尝试均提取失败或写入失败时，异常保存在`last_error`
+        """
+        self.last_error = None
+        state = self._begin_refresh(one, kwargs)
+        if state is None:
+            return
+        hdf, record, arg, use_last_date = state
+        error = None
         for i in range(1, self.retry_times + 1):
             if record['completed']:
                 break
+            web_data, error = None, None
             try:
                 # 只捕获网络数据提取部分的异常
                 web_data = fetch_data_func(*_one_parse_helper(arg))
-                record['completed'] = True
-                record['memo'] = '-'  # 清除此前可能遗留的备注
             except Exception as e:
-                web_data = pd.DataFrame()
-                logger.exception(f"第{i}次尝试提取网络数据，{one}出现异常\n")
-                record['completed'] = False
-                record['memo'] = f"第{i}次尝试中出现异常{e}"
+                error = e
+                self.logger.exception(f"第{i}次尝试提取网络数据，{one}出现异常\n")
+            record, web_data = self._attempted(one, i, record, web_data, error,
+                                               use_last_date)
+        self.last_error = self._end_refresh(hdf, web_data, record,
+                                            kwargs) or error
+
+    async def refresh_one_async(self, fetch_data_func, one, kwargs):
+        """单项刷新(协程)
+
+        Notes:
+        ------
+            `fetch_data_func`为协程函数；写入在线程池中执行，应在启用写入服务时使用
+        """
+        state = self._begin_refresh(one, kwargs)
+        if state is None:
+            return
+        hdf, record, arg, use_last_date = state
+        for i in range(1, self.retry_times + 1):
+            if record['completed']:
+                break
+            web_data, error = None, None
+            try:
+                web_data = await fetch_data_func(*_one_parse_helper(arg))
+            except Exception as e:
+                error = e
+                self.logger.info(f"第{i}次尝试提取网络数据，{one}出现异常 {e!r}")
+            record, web_data = self._attempted(one, i, record, web_data, error,
+                                               use_last_date)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._end_refresh, hdf, web_data,
+                                   record, kwargs)
+
+    async def refresh_items_async(self, fetch_data_func, kwargs, items=None):
+        """在本进程以协程刷新项目
+
+        Notes:
+        ------
+            并发数及请求速率由协程提取函数控制；写入由单一写入进程执行
+
+        Arguments:
+            fetch_data_func {coroutine function} -- 协程提取函数
+            kwargs {dict} -- 写入参数
+
+        Keyword Arguments:
+            items {list} -- 项目列表，`None`代表全部 (default: {None})
+
+        Returns:
+            dict -- 写入失败的文件 {文件路径: 异常}
+        """
+        items = self.iterables if items is None else items
+        previous = current_writer()
+        failed = {}
+        with writer_service(failed=failed) as queue:
+            use_writer(queue)
+            try:
+                async with client_session():
+                    await asyncio.gather(*[
+                        self.refresh_one_async(fetch_data_func, one,
+                                               dict(kwargs)) for one in items
+                    ])
             finally:
-                record['completed_time'] = pd.Timestamp.now(tz=TZ)
-                record['retry_times'] = i
-                record, web_data = self._normalize_data(
-                    one, web_data, record, use_last_date)
-        try:
-            hdf.add(web_data, record, kwargs)
-        except Exception as e:
-            logger.error(f"{e!r}")
+                use_writer(previous)
+        if failed:
+            self.logger.error(f'以下文件写入失败 {list(failed)}')
+        return failed
 
     def refresh_batch(self, batch):
         """分批刷新"""
         raise NotImplementedError('子类中完成')
 
-    def _get_batchs(self):
-        batch_num = math.ceil(len(self.iterables) / MAX_WORKER)
-        batchs = loop_codes(self.iterables, batch_num)
-        return batchs
+    def refresh_item(self, one):
+        """刷新单个项目(调度任务)
+
+        Notes:
+        ------
+            刷新失败时引发最后一次异常，由调度进程重试、记入失败列表并调整并发数
+        """
+        self.last_error = None
+        self.refresh_batch([one])
+        if self.last_error is not None:
+            raise self.last_error
 
     def refresh_all(self, item=None):
-        """刷新所有项目"""
-        if item is None:
-            # 形式 [[1],[2,3]]
-            batchs = self._get_batchs()
-        else:
-            # 单个项目
-            batchs = [[item]]
-        with Pool(MAX_WORKER) as pool:
-            pool.map_async(self.refresh_batch, batchs).get()
+        """刷新所有项目
+
+        Notes:
+        ------
+            每个项目为单独任务，由空闲进程动态领取，超时或失败的项目重试(参阅`scheduler.py`)
+        """
+        items = self.iterables if item is None else [item]
+        limiter = None if self.source is None else get_limiter(self.source)
+        # 各进程的写入由单一写入进程执行
+        report = run_tasks(self.refresh_item,
+                           items,
+                           writer=True,
+                           limiter=limiter)
+        if report.failed:
+            self.logger.error(f'以下项目刷新失败 {list(report.failed)}')
+        return report
 
 
 # region 深证信
@@ -442,6 +585,12 @@ class ASRefresher(RefresherBase):
         """索引列名称"""
         return DB_CONFIG[one]['date_field'][0]
 
+    def get_partition_freq(self, one):
+        """财务报告按年度分区"""
+        if one.startswith('7.'):
+            return 'Y'
+        return None
+
     def get_freq(self, one):
         """刷新频率"""
         # 按天刷新
@@ -475,6 +624,7 @@ class ASRefresher(RefresherBase):
         kwargs.update({'data_columns': data_columns})
         # 由于初始化时一次性写入数据，忽略了min_itemsize问题
         kwargs.update({'min_itemsize': self.get_min_itemsize(one)})
+        kwargs.update(self.get_codec_kwargs(one))
 
         logger = self.logger
         record = self.get_record(one)
@@ -496,6 +646,7 @@ class ASRefresher(RefresherBase):
         for i in range(1, self.retry_times + 1):
             if record['completed']:
                 break
+            error = None
             try:
                 if codes is None:
                     # 只捕获网络数据提取部分的异常
@@ -507,6 +658,7 @@ class ASRefresher(RefresherBase):
                 record['completed'] = True
                 record['memo'] = ''  # 清除此前可能遗留的备注
             except Exception as e:
+                error = e
                 time.sleep(0.3)
                 web_data = pd.DataFrame()
                 logger.exception(f"第{i}次尝试提取网络数据，{one}出现异常\n")
@@ -521,6 +673,8 @@ class ASRefresher(RefresherBase):
                 record['retry_times'] = i
                 record, web_data = self._normalize_data(
                     one, web_data, record, use_last_date)
+        if error is not None:
+            self.last_error = error
         return web_data, record, kwargs
 
     def _get_ipo_by_code(self, code):
@@ -619,8 +773,10 @@ class ASRefresher(RefresherBase):
         hdf.add(web_data, record, kwargs)
 
         # 然后完成附加代码
-        for code in new_codes:
-            self._one_by_one(one, code, kwargs)
+        # 逐个代码添加的小块数据合并写入
+        with buffered_writes():
+            for code in new_codes:
+                self._one_by_one(one, code, kwargs)
 
     def refresh_batch(self, batch):
         """分批刷新"""
@@ -638,6 +794,7 @@ class ASRefresher(RefresherBase):
             try:
                 self.refresh_one(one, kwargs, codes)
             except Exception as e:
+                self.last_error = e
                 print(f"{e!r}")
         if self._as and self._as.driver:
             self._as.driver.quit()
@@ -664,7 +821,8 @@ class MarginDataRefresher(RefresherBase):
             end = end - pd.Timedelta(days=1)
         else:
             end = end - pd.Timedelta(days=2)
-        dates = pd.date_range(start, end, freq='B')
+        # 只有交易日才有融资融券数据
+        dates = get_calendar().sessions_in_range(start, end)
         dates = [d.strftime(r'%Y-%m-%d') for d in dates]
         return dates
 
@@ -706,13 +864,22 @@ class MarginDataRefresher(RefresherBase):
         """索引列名称"""
         return TS_CONFIG['8.2']['date_field'][0]
 
+    def get_partition_freq(self, one):
+        """按年度分区"""
+        return 'Y'
+
+    def get_min_itemsize(self, one):
+        """定义列字符串最小长度"""
+        return {
+            '股票简称': 20,
+        }
+
     def refresh_one(self, one, web_data):
         # 列名称长度限定
         kwargs = {
             'data_columns': self.get_data_columns(None),
-            'min_itemsize': {
-                '股票简称': 20,
-            },
+            'min_itemsize': self.get_min_itemsize(None),
+            **self.get_codec_kwargs(None),
         }
         hdf = self.get_hdfdata(one)
         record = self.get_record(one)
@@ -729,7 +896,7 @@ class MarginDataRefresher(RefresherBase):
 
     def refresh_all(self):
         """刷新"""
-        with ThematicStatistics() as api:
+        with ThematicStatistics() as api, buffered_writes():
             # 自最后日期起至昨日
             for d in self.iterables:
                 web_data = api.get_data('8.2', d, d)
@@ -872,6 +1039,8 @@ class ClassifyBomRefresher(RefresherBase):
 # region 网易数据
 class WYSRefresher(RefresherBase):
     """网易股票日线行情刷新器"""
+    source = 'quotes.money.163.com'
+
     @property
     def iterables(self):
         """循环列表"""
@@ -912,21 +1081,31 @@ class WYSRefresher(RefresherBase):
         """查询数据列"""
         return ['股票代码', '日期']
 
-    def refresh_batch(self, batch):
-        """分批刷新"""
-        kwargs = {
+    def _write_kwargs(self):
+        return {
             'data_columns': ['股票代码', '日期'],
             'min_itemsize': {
                 '股票代码': 7,
                 '名称': 20,
             },
         }
+
+    def refresh_batch(self, batch):
+        """分批刷新"""
+        kwargs = self._write_kwargs()
         for one in batch:
             self.refresh_one(fetch_history, one, kwargs)
 
+    async def refresh_all_async(self, items=None):
+        """在本进程以协程刷新(参阅`wy.fetch_history_async`)"""
+        return await self.refresh_items_async(fetch_history_async,
+                                              self._write_kwargs(), items)
+
 
 class WYIRefresher(RefresherBase):
     """网易股指日线行情刷新器"""
+    source = 'quotes.money.163.com'
+
     @property
     def iterables(self):
         """循环列表"""
@@ -967,18 +1146,27 @@ class WYIRefresher(RefresherBase):
         """查询数据列"""
         return ['股票代码', '日期']
 
-    def refresh_batch(self, batch):
-        """分批刷新"""
-        kwargs = {
+    def _write_kwargs(self):
+        return {
             'data_columns': ['股票代码', '日期'],
             'min_itemsize': {
                 '股票代码': 7,
             },
         }
+
+    def refresh_batch(self, batch):
+        """分批刷新"""
+        kwargs = self._write_kwargs()
         fetch_data_func = partial(fetch_history, is_index=True)
         for one in batch:
             self.refresh_one(fetch_data_func, one, kwargs)
 
+    async def refresh_all_async(self, items=None):
+        """在本进程以协程刷新(参阅`wy.fetch_history_async`)"""
+        fetch_data_func = partial(fetch_history_async, is_index=True)
+        return await self.refresh_items_async(fetch_data_func,
+                                              self._write_kwargs(), items)
+
 
 # endregion
 
@@ -1032,6 +1220,18 @@ class DisclosureRefresher(RefresherBase):
         """索引列名称"""
         return '公告时间'
 
+    def get_partition_freq(self, one):
+        """按年度分区"""
+        return 'Y'
+
+    def get_min_itemsize(self, one):
+        """定义列字符串最小长度"""
+        return {
+            '公告标题': 600,
+            '下载网址': 120,
+            '股票简称': 20,
+        }
+
     def get_freq(self, one):
         """刷新频率"""
         return 'H'
@@ -1047,12 +1247,9 @@ class DisclosureRefresher(RefresherBase):
     def refresh_one(self, one, web_data):
         # 标题长度限定
         kwargs = {
-            'min_itemsize': {
-                '公告标题': 600,
-                '下载网址': 120,
-                '股票简称': 20,
-            },
+            'min_itemsize': self.get_min_itemsize(None),
             'data_columns': ['股票代码', '公告时间', '序号'],
+            **self.get_codec_kwargs(None),
         }
         hdf = self.get_hdfdata(one)
         record = self.get_record(one)
@@ -1070,14 +1267,10 @@ class DisclosureRefresher(RefresherBase):
     async def refresh_all(self):
         """刷新"""
         # 自最后日期起，至当日（或明日）至
-        # 初始化时，如果单次时段超过半年，会导致远程主机强迫关闭了一个现有的连接
-        # 休眠一段，再次运行即可。
+        # 并发数随连接状况自动调整，无需逐日休眠(参阅`concurrency.py`)
         for d in self.iterables:
             web_data = await fetch_one_day(d)
             self.refresh_one(d, web_data)
-            delay = random.randint(100, 500) / 100
-            # asyncio.sleep(delay)
-            time.sleep(delay)
 
 
 class SinaNewsRefresher(RefresherBase):
@@ -1092,7 +1285,7 @@ class SinaNewsRefresher(RefresherBase):
 
     def get_table_data(self):
         """分日期存储数据"""
-        hdf = HDFData(self.get_data_path(None), self.get_mode(None))
+        hdf = self.get_hdfdata(None)
         return hdf.data
 
     def get_min_date(self, one):
@@ -1103,6 +1296,14 @@ class SinaNewsRefresher(RefresherBase):
         """索引列名称"""
         return '时间'
 
+    def get_partition_freq(self, one):
+        """按年度分区"""
+        return 'Y'
+
+    def get_min_itemsize(self, one):
+        """定义列字符串最小长度"""
+        return {'概要': 2000}
+
     def get_col_dtypes(self, one):
         """列数据类型"""
         return {
@@ -1129,9 +1330,10 @@ class SinaNewsRefresher(RefresherBase):
         record = {
             'index_col': '时间',
         }
-        kwargs = {'min_itemsize': {'概要': 2000}}
+        kwargs = {'min_itemsize': self.get_min_itemsize(None)}
         kwargs['subset'] = ['序号']
         kwargs.update({'data_columns': self.get_data_columns(None)})
+        kwargs.update(self.get_codec_kwargs(None))
         with Sina247News() as api:
             history = api.history_news(times)
         history = ensure_dtypes(history, **self.get_col_dtypes(None))
@@ -1140,8 +1342,7 @@ class SinaNewsRefresher(RefresherBase):
         now = pd.Timestamp.now(tz=TZ)
         record['completed_time'] = now
         record['next_time'] = time_for_next_update(now, 'H', 30)
-        fp = self.get_data_path(None)
-        hdf = HDFData(fp, self.get_mode(None))
+        hdf = self.get_hdfdata(None)
         hdf.insert(history, record, kwargs)
 
 
@@ -1181,7 +1382,7 @@ class TreasuryRefresher(RefresherBase):
         download_last_year()
         df = fetch_treasury_data_from()
         fp = self.get_data_path()
-        df.to_hdf(fp, 'data', mode='w')
+        df.to_hdf(fp, 'data', mode='w', **self.get_codec_kwargs(None))
 
 
 # endregion
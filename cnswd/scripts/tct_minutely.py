@@ -1,24 +1,161 @@
+"""腾讯分钟交易数据
+
+Notes:
+    1. 交易时段每分钟保存一次全部股票快照 `TCT/{YYYYMMDD}/{ts}.pkl`
+    2. 此后各日快照合并为单个文件 `TCT/{YYYYMMDD}.h5`，按(代码, 时间)排序，
+       代码及时间为带完整排序索引的数据列，查询单个股票只读取所需部分
+    3. 合并后删除当日快照目录；尚未合并的日期仍然读取快照
+"""
+import re
+
 import logbook
 import pandas as pd
 
 from cnswd.utils import data_root
 
+from ..bars import refresh_bars
+from ..storage import codec_kwargs, dataset_codec, get_engine
 from ..websource.tencent import fetch_minutely_prices
-from .trading_calendar import is_trading_day
 
 logger = logbook.Logger('分钟交易数据')
 
+DAY_PATTERN = re.compile(r'^\d{8}$')
+DATA_COLUMNS = ['代码', '时间']
+
+
+def _root():
+    return data_root('TCT')
+
+
+def snapshot_dir(d):
+    """当日快照目录"""
+    return _root() / pd.Timestamp(d).strftime(r'%Y%m%d')
+
+
+def minutely_path(d):
+    """当日合并数据逻辑路径"""
+    return _root() / f"{pd.Timestamp(d).strftime(r'%Y%m%d')}.h5"
+
+
+def _read_snapshot(fp):
+    df = pd.read_pickle(fp)
+    dt = fp.name.split('.')[0]
+    df['时间'] = pd.Timestamp(int(dt), unit='s')
+    df.reset_index(inplace=True)
+    return df
+
+
+def _to_snapshot(df, dt):
+    """网页数据转换为快照(代码不含市场前缀)"""
+    df = df.reset_index()
+    df['时间'] = dt
+    df['代码'] = df['代码'].str[2:]
+    return df
+
+
+def read_snapshots(d, start=None, end=None):
+    """读取当日快照
+
+    Arguments:
+        d {date_like} -- 日期
+
+    Keyword Arguments:
+        start {Timestamp} -- 开始时间 (default: {None})
+        end {Timestamp} -- 结束时间 (default: {None})
+
+    Returns:
+        DataFrame -- 去重后的分钟数据，代码不含市场前缀
+    """
+    dfs = []
+    p = snapshot_dir(d)
+    if p.exists():
+        for fp in sorted(p.glob('*.pkl')):
+            dt = pd.Timestamp(int(fp.name.split('.')[0]), unit='s')
+            if start is not None and dt < start:
+                continue
+            if end is not None and dt > end:
+                continue
+            dfs.append(_read_snapshot(fp))
+    if not dfs:
+        return pd.DataFrame()
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.drop_duplicates(DATA_COLUMNS, keep='last')
+    # 去除市场前缀 "sz000333" -> "000333"
+    df['代码'] = df['代码'].str[2:]
+    return df
+
+
+def compact_minutely(d, remove=True):
+    """合并当日快照
+
+    Arguments:
+        d {date_like} -- 日期
+
+    Keyword Arguments:
+        remove {bool} -- 合并后删除快照目录 (default: {True})
+
+    Returns:
+        int -- 合并行数
+    """
+    df = read_snapshots(d)
+    p = snapshot_dir(d)
+    if df.empty:
+        if remove and p.exists():
+            p.rmdir()
+        return 0
+    df = df.sort_values(DATA_COLUMNS, kind='mergesort')
+    df.reset_index(drop=True, inplace=True)
+    fp = minutely_path(d)
+    engine = get_engine(fp)
+    kwargs = {'data_columns': DATA_COLUMNS}
+    kwargs.update(codec_kwargs(dataset_codec('tct_minutely')))
+    engine.rewrite(fp, df, kwargs)
+    engine.ensure_index(fp, DATA_COLUMNS)
+    if remove:
+        for f in p.glob('*.pkl'):
+            f.unlink()
+        p.rmdir()
+    logger.info(f'合并{len(df)}行 -> {fp}')
+    return len(df)
+
+
+def compact_all(before=None):
+    """合并此前各日快照
+
+    Keyword Arguments:
+        before {date_like} -- 只合并此日期之前的快照，默认为今日 (default: {None})
+    """
+    before = pd.Timestamp('today' if before is None else before).normalize()
+    for p in sorted(_root().iterdir()):
+        if not (p.is_dir() and DAY_PATTERN.match(p.name)):
+            continue
+        d = pd.Timestamp(p.name)
+        if d >= before:
+            continue
+        try:
+            compact_minutely(d)
+        except Exception as e:
+            logger.error(f'合并{p}失败 {e!r}')
+
 
 def refresh_minutely_prices():
     """刷新分钟交易数据"""
+    # `reader`读取快照，延迟导入避免循环引用
+    from .trading_calendar import is_trading_day
     today = pd.Timestamp('today')
-    fp = data_root(f"live_quotes/{today.strftime(r'%Y%m%d')}.h5")
     # 后台计划任务控制运行时间点。此处仅仅判断当天是否为交易日
     if not is_trading_day(today):
         return
     df = fetch_minutely_prices()
     if len(df) > 0:
-        dt = pd.Timestamp.now().floor('min').timestamp()
-        fp = data_root(f"TCT/{today.strftime('%Y%m%d')}/{dt}.pkl")
+        dt = pd.Timestamp.now().floor('min')
+        fp = snapshot_dir(today) / f"{dt.timestamp()}.pkl"
+        fp.parent.mkdir(parents=True, exist_ok=True)
         df.to_pickle(fp)
         logger.info('添加{}行'.format(df.shape[0]))
+        try:
+            refresh_bars(_to_snapshot(df, dt))
+        except Exception as e:
+            logger.error(f'生成K线失败 {e!r}')
+    # 每日首次刷新时合并此前快照
+    compact_all(today)
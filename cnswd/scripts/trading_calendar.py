@@ -15,6 +15,7 @@ from numpy.random import shuffle
 
 from ..data import HDFData
 from ..reader import stock_list
+from ..refdata import export_calendar, export_codes, get_calendar
 from ..setting.constants import MARKET_START, TZ
 from ..utils import data_root, ensure_dt_localize
 from ..websource.tencent import get_recent_trading_stocks
@@ -82,6 +83,9 @@ def add_info(dates):
     h = HDFData(fp, 'w')
     df = pd.DataFrame({'trading_date': dates})
     h.add(df, status)
+    # 导出内存映射文件供读取
+    export_calendar(dates, status['last_date'])
+    export_codes(status['codes'])
 
 
 def handle_today():
@@ -111,7 +115,4 @@ def refresh_trading_calendar():
 def is_trading_day(dt):
     """是否为交易日历"""
     assert isinstance(dt, pd.Timestamp)
-    dt = ensure_dt_localize(dt).tz_localize(None).normalize()
-    fp = data_root('trading_calendar.h5')
-    h = HDFData(fp, 'w')
-    return dt.to_datetime64() in h.data['trading_date'].values
+    return get_calendar().is_session(ensure_dt_localize(dt))
@@ -1,14 +1,15 @@
-import math
-import time
 from functools import lru_cache, partial
 from multiprocessing import Pool
 
 import pandas as pd
 from numpy.random import shuffle
 
-from ..data import HDFData
+from ..concurrency import get_limiter
+from ..refdata import get_calendar
+from ..scheduler import run_tasks
 from ..setting.constants import MAX_WORKER
-from ..utils import data_root, ensure_dtypes, loop_codes, make_logger
+from ..storage import _atomic_write, codec_kwargs, dataset_codec
+from ..utils import data_root, ensure_dtypes, make_logger
 from ..websource.wy import fetch_cjmx
 from .trading_calendar import is_trading_day
 from ..reader import daily_history
@@ -16,14 +17,13 @@ from ..reader import daily_history
 
 logger = make_logger('网易股票成交明细')
 DATE_FMT = r'%Y-%m-%d'
+# 很少读取的归档数据
+CODEC_KWARGS = codec_kwargs(dataset_codec('wy_cjmx'))
 
 
 def _last_5():
     """最近的5个交易日"""
-    fp = data_root('trading_calendar.h5')
-    h = HDFData(fp, 'a')
-    dates = h.data['trading_date'].values[-5:]
-    return dates
+    return get_calendar().sessions_window(pd.Timestamp('today'), 5)
 
 
 def _wy_fix_data(df):
@@ -46,31 +46,19 @@ def data_path(code, date):
     return data_root(f"wy_cjmx/{code}/{date.strftime(r'%Y%m%d')}.h5")
 
 
-def write_cjmx(codes, date):
-    status = {}
+def write_cjmx(code, date):
+    """提取并写入单只股票成交明细(调度任务，失败时引发异常以便重试)"""
+    fp = data_path(code, date)
+    if fp.exists():
+        return 0
     date_str = date.strftime(DATE_FMT)
-    for _ in range(3):
-        for code in codes:
-            fp = data_path(code, date)
-            if fp.exists():
-                status[code] = True
-            if status.get(code, False):
-                continue
-            try:
-                df = fetch_cjmx(code, date_str)
-                status[code] = True
-            except Exception as e:
-                logger.info(f'股票：{code} {date_str} {e!r}')
-                status[code] = False
-                continue
-            df = _wy_fix_data(df)
-            df.to_hdf(fp, 'data', append=False)
-            logger.info(f'股票：{code} {date_str} 共{len(df):>3}行')
-        time.sleep(0.5)
-    failed = [k for k, v in status.items() if not v]
-    if len(failed):
-        print(f'{date_str} 以下股票成交明细提取失败')
-        print(failed)
+    df = fetch_cjmx(code, date_str)
+    df = _wy_fix_data(df)
+    # 超时终止时不留下不完整的文件，否则此后均被跳过
+    _atomic_write(
+        fp, lambda tmp: df.to_hdf(tmp, 'data', append=False, **CODEC_KWARGS))
+    logger.info(f'股票：{code} {date_str} 共{len(df):>3}行')
+    return len(df)
 
 
 def stock_is_trading(code, date):
@@ -104,11 +92,13 @@ def _refresh_wy_cjmx(date):
     codes = get_traded_codes(date)
     shuffle(codes)
     print(f'{date.strftime(DATE_FMT)} 共{len(codes)}只股票交易')
-    batch_num = math.ceil(len(codes) / MAX_WORKER)
-    batchs = loop_codes(codes, batch_num)
     func = partial(write_cjmx, date=date)
-    with Pool(MAX_WORKER) as pool:
-        pool.map(func, batchs)
+    report = run_tasks(func,
+                       codes,
+                       limiter=get_limiter('quotes.money.163.com'))
+    if report.failed:
+        print(f'{date.strftime(DATE_FMT)} 以下股票成交明细提取失败')
+        print(list(report.failed))
 
 
 def refresh_wy_cjmx():
@@ -1,10 +1,9 @@
 import os
-from multiprocessing import Pool
 
 import pandas as pd
 from tenacity import retry, retry_if_exception_type, stop_after_attempt
 
-from ..setting.constants import MAX_WORKER
+from ..scheduler import run_tasks
 from ..utils import data_root, make_logger
 from ..websource.yahoo import (fetch_ebitda, fetch_free_cash_flow,
                                fetch_history, fetch_total_assets)
@@ -65,8 +64,7 @@ def _one_stock(code):
 
 def refresh_all():
     stock_codes = get_recent_trading_stocks()
-    with Pool(MAX_WORKER) as pool:
-        pool.map(_one_stock, stock_codes)
+    return run_tasks(_one_stock, stock_codes)
 
 
 def read_data(code, item, period_type='quarterly'):
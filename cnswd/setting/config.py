@@ -13,6 +13,80 @@ DEFAULT_CONFIG = {
     'data_root': Path.home() / '.cnswd',
     # 驱动程序位置 文件目录使用`/`
     'geckodriver_path': r'C:/tools/geckodriver.exe',
+    # 存储格式 `hdf` 或 `parquet`(需安装pyarrow)
+    'storage': 'hdf',
+    # 默认压缩方式，参阅`CODECS`
+    'codec': 'blosclz',
+    # 查询结果缓存内存上限(MB)，0代表不缓存
+    'cache_memory': 256,
+    # 查询结果溢出至磁盘(`cache`目录)的上限(MB)，0代表不溢出
+    'cache_disk': 0,
+    # 刷新任务单项超时(秒)，超时后终止工作进程，0代表不限
+    'task_timeout': 600,
+    # 刷新任务失败重试次数
+    'task_retries': 2,
+    # 每个主机的连接池大小(每个进程)
+    'http_pool_size': 10,
+    # 连接错误及网关错误的自动重试次数
+    'http_retries': 2,
+    # 协程共享会话的连接数上限
+    'http_async_limit': 200,
+}
+
+# 压缩方式 {名称: (压缩库, 压缩级别)}
+# 可使用`名称:级别`指定级别，如`zstd:5`
+# 运行`stock codec`比较本机数据的读写速度及文件大小
+CODECS = {
+    'none': (None, 0),
+    'blosclz': ('blosc:blosclz', 9),
+    # 读写速度优先，适用于频繁读取的日线数据
+    'lz4': ('blosc:lz4', 5),
+    # 压缩率优先，适用于很少读取的成交明细等归档数据
+    'zstd': ('blosc:zstd', 9),
+}
+
+# 数据集压缩方式 {数据集: 压缩方式}，未列出的使用默认压缩方式
+# 刷新器数据集名称为类名称小写
+DATASET_CODECS = {
+    'wysrefresher': 'lz4',
+    'wyirefresher': 'lz4',
+    'disclosurerefresher': 'zstd',
+    'sinanewsrefresher': 'zstd',
+    'wy_cjmx': 'zstd',
+    'tct_minutely': 'lz4',
+}
+
+# 网站请求限速 {主机后缀: (每秒请求数, 突发请求数)}，所有进程合计
+# 以最长后缀匹配，未列出的主机不限速；每秒请求数为0代表不限速
+RATE_LIMITS = {
+    # 网易行情、成交明细及财务数据
+    '163.com': (10, 10),
+    # 新浪实时报价
+    'sinajs.cn': (5, 5),
+    # 新浪网页
+    'sina.com.cn': (2, 4),
+    # 腾讯行情
+    'gtimg.cn': (10, 10),
+    # 深证信网页接口及数据浏览器
+    'cninfo.com.cn': (4, 8),
+    # 巨潮指数
+    'cnindex.com.cn': (4, 8),
+    # 国家统计局
+    'stats.gov.cn': (2, 4),
+}
+
+# 自适应并发 {主机后缀: (初始并发数, 最大并发数)}，每个进程分别控制
+# 成功时逐步增加，连接重置、超时或HTTP 403/429/503时减半(参阅`concurrency.py`)
+# 工作进程(动态任务调度)
+CONCURRENCY_LIMITS = {
+    '163.com': (4, 16),
+    'cninfo.com.cn': (4, 16),
+}
+# 协程
+ASYNC_CONCURRENCY_LIMITS = {
+    '163.com': (32, 256),
+    'cninfo.com.cn': (4, 16),
+    'sinajs.cn': (2, 8),
 }
 
 LOG_TO_FILE = False        # 是否将日志写入到文件
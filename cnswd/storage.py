@@ -0,0 +1,1194 @@
+"""存储引擎
+
+Notes:
+    1. `HDFData`及`query`通过存储引擎读写数据，路径统一使用`.h5`逻辑路径
+    2. `hdf`     `pd.HDFStore` table格式，数据保存在`data`，记录保存在`record`
+    3. `parquet` 同名目录`{文件名}.parquet`，每次添加写入一个`part-*.parquet`，
+                 记录保存在`_record.pkl`。支持列裁剪及查询条件下推
+    4. 默认使用`DEFAULT_CONFIG['storage']`，该格式文件不存在时按已有文件格式读写
+    5. `partitioned` 同名目录`{文件名}.parts`，按索引列年度或月度分区，
+                 分区目录存在时优先使用。查询时只读取与索引列条件重叠的分区
+    6. 写入参数`complib`、`complevel`指定压缩方式，按数据集配置(参阅`codec_kwargs`)
+    7. `hdf`读取默认每次打开并关闭文件；只读查询(如`reader`)可在`store_pool.pooled()`
+       范围内使用进程内只读句柄池，避免重复打开文件(参阅`StorePool`)
+    8. 只读句柄持有HDF5文件锁，期间任何其他进程都无法写入该文件。写入数据的进程
+       (刷新、写入进程等)不得使用句柄池
+"""
+import atexit
+import copy
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+
+from .setting.config import CODECS, DATASET_CODECS, DEFAULT_CONFIG
+
+# 分块扫描单列时每块行数
+SCAN_CHUNKSIZE = 500000
+# 只读句柄池容量
+POOL_SIZE = 32
+# 只读句柄空闲多长时间(秒)后关闭
+POOL_IDLE_SECONDS = 5
+
+
+def dataset_codec(name):
+    """数据集压缩方式
+
+    Arguments:
+        name {str} -- 数据集名称
+
+    Returns:
+        str -- 压缩方式，参阅`CODECS`
+    """
+    return DATASET_CODECS.get(name, DEFAULT_CONFIG.get('codec', 'blosclz'))
+
+
+def codec_kwargs(codec):
+    """压缩方式转换为写入参数
+
+    Arguments:
+        codec {str} -- 压缩方式，如`zstd`或`zstd:5`
+
+    Raises:
+        ValueError: 不支持的压缩方式
+
+    Returns:
+        dict -- {'complib': 压缩库, 'complevel': 压缩级别}
+    """
+    name, _, level = codec.partition(':')
+    if name not in CODECS:
+        raise ValueError(f'不支持压缩方式{codec}，可选{list(CODECS)}')
+    complib, complevel = CODECS[name]
+    if level:
+        complevel = int(level)
+    if complib is None:
+        complevel = 0
+    return {'complib': complib, 'complevel': complevel}
+
+
+def file_stamp(fp):
+    """文件状态(修改时间, 大小)，文件不存在时为`None`"""
+    try:
+        st = os.stat(fp)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def dir_stamp(p):
+    """目录状态(修改时间, 文件总大小, 文件数量)，目录不存在时为`None`"""
+    try:
+        files = list(os.scandir(p))
+        return (os.stat(p).st_mtime_ns, sum(f.stat().st_size for f in files),
+                len(files))
+    except FileNotFoundError:
+        return None
+
+
+def _dump_pickle(fp, obj):
+    """以替换方式写入pickle文件"""
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            pickle.dump(obj, f)
+
+    _atomic_write(fp, write)
+
+
+def _atomic_write(fp, write_func):
+    """写入临时文件后替换，避免读取到写入中途的文件"""
+    tmp = fp.with_name(f".{fp.name}.{os.getpid()}")
+    try:
+        write_func(tmp)
+        os.replace(tmp, fp)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _with_where_columns(columns, where):
+    """读取列须包括查询条件涉及的列"""
+    if columns is None:
+        return None
+    res = list(columns)
+    for term in where or []:
+        for t in getattr(term, 'terms', [term]):
+            if t.key not in res:
+                res.append(t.key)
+    return res
+
+
+class StorePool(object):
+    """只读`pd.HDFStore`句柄池
+
+    Notes:
+        1. 只在`pooled()`范围内缓存句柄，范围外每次打开并在使用后关闭
+        2. 进程内按路径缓存只读句柄，超出容量时关闭最久未使用的句柄
+        3. 使用前比较文件状态，文件已被写入时重新打开
+        4. 只读句柄持有文件锁，期间其他进程无法写入，写入进程报错而非等待。因此空闲超过
+           `idle`秒的句柄由后台线程关闭；本进程写入前关闭对应句柄。
+           其他进程可能同时写入的场合(刷新、写入进程)不要启用
+        5. PyTables非线程安全，同一进程内的读取依次执行
+    """
+    def __init__(self, maxsize=POOL_SIZE, idle=POOL_IDLE_SECONDS):
+        self.maxsize = maxsize
+        self.idle = idle
+        self._registered = False
+        self._disabled = False
+        self._local = threading.local()
+        self._reset()
+
+    def _reset(self):
+        # {路径: [文件状态, 句柄, 最后使用时间]}
+        self._stores = OrderedDict()
+        self._lock = threading.RLock()
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._stores)
+
+    def _close(self, entry):
+        try:
+            entry[1].close()
+        except Exception:
+            pass
+
+    @property
+    def enabled(self):
+        """当前线程是否缓存句柄"""
+        return not self._disabled and getattr(self._local, 'depth', 0) > 0
+
+    def disable(self):
+        """关闭全部句柄，本进程此后不再缓存(用于写入进程)"""
+        self._disabled = True
+        self.clear()
+
+    @contextmanager
+    def pooled(self):
+        """在此范围内(当前线程)的读取缓存句柄，可嵌套"""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+
+    @contextmanager
+    def open(self, fp):
+        """只读句柄
+
+        Arguments:
+            fp {Path} -- h5文件路径
+        """
+        if not self.enabled:
+            with self._lock:
+                store = pd.HDFStore(fp, mode='r')
+                try:
+                    yield store
+                finally:
+                    store.close()
+            return
+        with self._lock:
+            key = str(fp)
+            stamp = file_stamp(fp)
+            entry = self._stores.pop(key, None)
+            if entry is not None and (entry[0] != stamp
+                                      or not entry[1].is_open):
+                self._close(entry)
+                entry = None
+            if entry is None:
+                entry = [stamp, pd.HDFStore(fp, mode='r'), None]
+                if not self._registered:
+                    # 在PyTables之后注册，退出时先于PyTables关闭
+                    atexit.register(self.clear)
+                    self._registered = True
+            self._stores[key] = entry
+            while len(self._stores) > self.maxsize:
+                self._close(self._stores.popitem(last=False)[1])
+            try:
+                yield entry[1]
+            finally:
+                entry[2] = time.monotonic()
+                self._start_sweeper()
+
+    def release(self, fp):
+        """关闭文件句柄(写入前调用)"""
+        with self._lock:
+            entry = self._stores.pop(str(fp), None)
+            if entry is not None:
+                self._close(entry)
+
+    def clear(self):
+        """关闭全部句柄"""
+        with self._lock:
+            while self._stores:
+                self._close(self._stores.popitem()[1])
+
+    def _start_sweeper(self):
+        if self._sweeper is None and self.idle:
+            self._sweeper = threading.Thread(target=self._sweep,
+                                             name='cnswd-store-pool',
+                                             daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        """定期关闭空闲句柄，全部关闭后退出"""
+        while True:
+            time.sleep(min(self.idle, 1))
+            with self._lock:
+                now = time.monotonic()
+                for key, entry in list(self._stores.items()):
+                    if now - entry[2] >= self.idle:
+                        self._close(self._stores.pop(key))
+                if not self._stores:
+                    self._sweeper = None
+                    return
+
+    def _after_fork(self):
+        """子进程不使用父进程打开的句柄"""
+        stores = self._stores
+        self._reset()
+        for entry in stores.values():
+            self._close(entry)
+
+
+store_pool = StorePool()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=store_pool._after_fork)
+
+
+def close_stores():
+    """关闭进程内全部只读句柄，如需其他进程写入时"""
+    store_pool.clear()
+
+
+class StorageEngine(object):
+    """存储引擎基类"""
+    name = None
+
+    def path(self, fp):
+        """实际存储路径"""
+        raise NotImplementedError('子类中完成')
+
+    def exists(self, fp):
+        """是否存在"""
+        return self.path(fp).exists()
+
+    def stamp(self, fp):
+        """存储状态，用于判断缓存是否有效"""
+        raise NotImplementedError('子类中完成')
+
+    def remove(self, fp):
+        """删除数据及记录"""
+        raise NotImplementedError('子类中完成')
+
+    def select(self, fp, where=None, columns=None, start=None, stop=None):
+        """查询数据
+
+        Arguments:
+            fp {Path} -- 逻辑路径(扩展名.h5)
+
+        Keyword Arguments:
+            where {list} -- `query_stmt`生成的查询条件 (default: {None})
+            columns {list} -- 列名称，`None`代表全部 (default: {None})
+            start {int} -- 开始行 (default: {None})
+            stop {int} -- 结束行 (default: {None})
+
+        Raises:
+            FileNotFoundError: 文件不存在
+            KeyError: 不存在数据
+
+        Returns:
+            DataFrame -- 查询结果
+        """
+        raise NotImplementedError('子类中完成')
+
+    def select_column(self, fp, col, start=None, stop=None):
+        """读取单列"""
+        raise NotImplementedError('子类中完成')
+
+    def iter_column(self, fp, col, chunksize=SCAN_CHUNKSIZE):
+        """分块读取单列"""
+        nrows = self.describe(fp)['nrows']
+        for start in range(0, nrows, chunksize):
+            yield self.select_column(fp, col, start, start + chunksize)
+
+    def iter_select(self, fp, where=None, columns=None,
+                    chunksize=SCAN_CHUNKSIZE):
+        """分块查询，每次只读取`chunksize`行
+
+        Arguments:
+            fp {Path} -- 逻辑路径(扩展名.h5)
+
+        Keyword Arguments:
+            where {list} -- `query_stmt`生成的查询条件 (default: {None})
+            columns {list} -- 列名称，`None`代表全部 (default: {None})
+            chunksize {int} -- 每块行数 (default: {SCAN_CHUNKSIZE})
+
+        Returns:
+            generator -- 满足条件的非空数据块
+        """
+        from .query_utils import filter_frame
+        nrows = self.describe(fp)['nrows']
+        read_columns = _with_where_columns(columns, where)
+        for start in range(0, nrows, chunksize):
+            df = self.select(fp, None, read_columns, start, start + chunksize)
+            if where:
+                df = filter_frame(df, where)
+            if columns is not None:
+                df = df[columns]
+            if len(df):
+                yield df
+
+    def describe(self, fp):
+        """刷新记录、数据行数及列名称"""
+        raise NotImplementedError('子类中完成')
+
+    def append(self, fp, df, kwargs):
+        """添加数据"""
+        raise NotImplementedError('子类中完成')
+
+    def rewrite(self, fp, df, kwargs):
+        """删除现有数据及记录后写入"""
+        raise NotImplementedError('子类中完成')
+
+    def read_record(self, fp):
+        """读取刷新记录"""
+        raise NotImplementedError('子类中完成')
+
+    def write_record(self, fp, record):
+        """写入刷新记录"""
+        raise NotImplementedError('子类中完成')
+
+    def create_index(self, fp, columns):
+        """创建查询索引"""
+        pass
+
+    def missing_index(self, fp, columns=None):
+        """缺少完整排序索引(CSI)的数据列
+
+        Keyword Arguments:
+            columns {list} -- 限定检查的列，`None`代表全部数据列 (default: {None})
+
+        Returns:
+            list -- 列名称
+        """
+        return []
+
+    def ensure_index(self, fp, columns=None):
+        """为缺少完整排序索引的数据列创建索引
+
+        Notes:
+            已有完整排序索引在添加数据时由PyTables自动更新，只需创建一次
+
+        Returns:
+            list -- 新建索引的列
+        """
+        missing = self.missing_index(fp, columns)
+        if missing:
+            self.create_index(fp, missing)
+        return missing
+
+    def size(self, fp):
+        """占用空间(字节)"""
+        p = self.path(fp)
+        if p.is_dir():
+            return sum(f.stat().st_size for f in p.rglob('*') if f.is_file())
+        return p.stat().st_size if p.exists() else 0
+
+    def compact(self, fp, sort_by=None, kwargs=None):
+        """整理存储碎片，按列排序后重写(数据内容及记录不变)
+
+        Arguments:
+            fp {Path} -- 逻辑路径(扩展名.h5)
+
+        Keyword Arguments:
+            sort_by {list} -- 排序列 (default: {None})
+            kwargs {dict} -- 压缩参数`complib`、`complevel`，默认保持不变 (default: {None})
+        """
+        raise NotImplementedError('子类中完成')
+
+
+class HDFEngine(StorageEngine):
+    """`pd.HDFStore`存储"""
+    name = 'hdf'
+
+    def path(self, fp):
+        return fp
+
+    def stamp(self, fp):
+        return file_stamp(fp)
+
+    def remove(self, fp):
+        store_pool.release(fp)
+        if fp.exists():
+            fp.unlink()
+
+    def _check_exists(self, fp):
+        if not fp.exists():
+            raise FileNotFoundError(f"找不到文件：{fp}")
+
+    def select(self, fp, where=None, columns=None, start=None, stop=None):
+        self._check_exists(fp)
+        # 列表条件超出`MAX_SELECTORS`项时读取后筛选，须读取条件涉及的列
+        read_columns = _with_where_columns(columns, where)
+        with store_pool.open(fp) as store:
+            df = store.select('data',
+                              where,
+                              columns=read_columns,
+                              start=start,
+                              stop=stop)
+        if columns is not None and len(read_columns) > len(columns):
+            df = df[list(columns)]
+        return df
+
+    def select_column(self, fp, col, start=None, stop=None):
+        self._check_exists(fp)
+        with store_pool.open(fp) as store:
+            try:
+                # 数据列只读取单列
+                s = store.select_column('data', col, start=start, stop=stop)
+            except (KeyError, ValueError):
+                s = store.select('data', columns=[col], start=start,
+                                 stop=stop)[col]
+        return s.reset_index(drop=True)
+
+    def iter_select(self, fp, where=None, columns=None,
+                    chunksize=SCAN_CHUNKSIZE):
+        # 先以索引确定满足条件的行号，再按行号分块读取；
+        # 每块单独取用句柄，迭代期间不阻塞其他进程写入
+        self._check_exists(fp)
+        stamp = file_stamp(fp)
+        with store_pool.open(fp) as store:
+            if where:
+                coords = store.select_as_coordinates('data', where=where)
+                coords = coords.values
+            else:
+                coords = None
+                nrows = store.get_storer('data').nrows or 0
+        total = nrows if coords is None else len(coords)
+        for start in range(0, total, chunksize):
+            if file_stamp(fp) != stamp:
+                raise RuntimeError(f'迭代期间数据已改变：{fp}')
+            with store_pool.open(fp) as store:
+                if coords is None:
+                    df = store.select('data',
+                                      columns=columns,
+                                      start=start,
+                                      stop=start + chunksize)
+                else:
+                    df = store.select('data',
+                                      where=coords[start:start + chunksize],
+                                      columns=columns)
+            if len(df):
+                yield df
+
+    def describe(self, fp):
+        res = {'record': None, 'nrows': 0, 'columns': []}
+        try:
+            with store_pool.open(fp) as store:
+                try:
+                    res['record'] = store.get('record').to_dict()
+                except Exception:
+                    pass
+                try:
+                    res['nrows'] = store.get_storer('data').nrows or 0
+                    res['columns'] = store.select('data', start=0,
+                                                  stop=0).columns.tolist()
+                except Exception:
+                    pass
+        except Exception:
+            pass
+        return res
+
+    def append(self, fp, df, kwargs):
+        store_pool.release(fp)
+        df.to_hdf(fp, 'data', **kwargs)
+
+    def rewrite(self, fp, df, kwargs):
+        store_pool.release(fp)
+        df.to_hdf(
+            fp,
+            'data',
+            mode='w',  # 删除现有文件
+            append=False,
+            data_columns=kwargs.get('data_columns', True),
+            complevel=kwargs.get('complevel'),
+            complib=kwargs.get('complib'),
+            format='table')
+
+    def read_record(self, fp):
+        with store_pool.open(fp) as store:
+            return store.get('record').to_dict()
+
+    def write_record(self, fp, record):
+        store_pool.release(fp)
+        s = pd.Series(record)
+        # 刷新方式写入记录
+        s.to_hdf(fp, 'record', append=False)
+
+    def create_index(self, fp, columns):
+        store_pool.release(fp)
+        with pd.HDFStore(fp) as store:
+            store.create_table_index('data',
+                                     columns=columns,
+                                     optlevel=9,
+                                     kind='full')
+
+    def missing_index(self, fp, columns=None):
+        with store_pool.open(fp) as store:
+            storer = store.get_storer('data')
+            if not storer.is_table:
+                return []
+            table = storer.table
+            data_columns = storer.data_columns
+            if columns is None:
+                columns = data_columns
+            res = []
+            for col in columns:
+                if col not in data_columns:
+                    continue
+                if not (table.colindexed[col]
+                        and table.colinstances[col].index.is_csi):
+                    res.append(col)
+            return res
+
+    def layout(self, fp):
+        """现有表的数据列、字符串列长度及压缩参数
+
+        Returns:
+            tuple -- (数据列, 字符串列最小长度, `tables.Filters`)
+        """
+        with store_pool.open(fp) as store:
+            return self._layout(store.get_storer('data'))
+
+    def _layout(self, storer):
+        data_columns = list(storer.data_columns)
+        min_itemsize = {}
+        for axis in storer.values_axes:
+            if axis.kind != 'string':
+                continue
+            if axis.name in data_columns:
+                min_itemsize[axis.name] = axis.itemsize
+            else:
+                values = min_itemsize.get('values', 0)
+                min_itemsize['values'] = max(values, axis.itemsize)
+        filters = storer.table.filters
+        return data_columns, min_itemsize, filters
+
+    def compact(self, fp, sort_by=None, kwargs=None):
+        self._check_exists(fp)
+        with store_pool.open(fp) as store:
+            storer = store.get_storer('data')
+            data_columns, min_itemsize, filters = self._layout(storer)
+            df = store.select('data')
+            try:
+                record = store.get('record')
+            except KeyError:
+                record = None
+        if sort_by:
+            df = df.sort_values(sort_by, kind='mergesort')
+        kwargs = kwargs or {}
+        complevel = kwargs.get('complevel', filters.complevel)
+        complib = kwargs.get('complib', filters.complib)
+
+        def write(tmp):
+            with pd.HDFStore(tmp,
+                             mode='w',
+                             complevel=complevel or None,
+                             complib=complib) as out:
+                # 以总行数确定块大小，一次写入
+                out.append('data',
+                           df,
+                           data_columns=data_columns,
+                           min_itemsize=min_itemsize or None,
+                           expectedrows=len(df),
+                           index=False)
+                if data_columns:
+                    out.create_table_index('data',
+                                           columns=data_columns,
+                                           optlevel=9,
+                                           kind='full')
+                if record is not None:
+                    out.put('record', record)
+
+        store_pool.release(fp)
+        _atomic_write(fp, write)
+
+
+class ParquetEngine(StorageEngine):
+    """Parquet列式存储(需安装`pyarrow`)"""
+    name = 'parquet'
+    record_name = '_record.pkl'
+    compression = 'zstd'
+    # h5压缩库对应的parquet压缩方式，parquet不支持blosclz时使用默认
+    codecs = {'blosc:zstd': 'zstd', 'blosc:lz4': 'lz4'}
+
+    @property
+    def pa(self):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('使用parquet存储需要安装pyarrow：pip install pyarrow')
+        return pyarrow
+
+    @property
+    def pq(self):
+        self.pa
+        import pyarrow.parquet
+        return pyarrow.parquet
+
+    def path(self, fp):
+        return fp.with_suffix('.parquet')
+
+    def _parts(self, fp):
+        return sorted(self.path(fp).glob('part-*.parquet'))
+
+    def stamp(self, fp):
+        return dir_stamp(self.path(fp))
+
+    def remove(self, fp):
+        p = self.path(fp)
+        if p.exists():
+            shutil.rmtree(p)
+
+    def _to_filters(self, where):
+        """查询条件转换为pyarrow过滤条件(或条件组按析取范式展开)"""
+        conjunctions = [[]]
+        for term in where or []:
+            if hasattr(term, 'terms'):
+                members = [self._to_filter(t) for t in term.terms]
+                conjunctions = [c + m for c in conjunctions for m in members]
+            else:
+                f = self._to_filter(term)
+                conjunctions = [c + f for c in conjunctions]
+        if conjunctions == [[]]:
+            return None
+        return conjunctions
+
+    @staticmethod
+    def _to_filter(term):
+        if not hasattr(term, 'key'):
+            raise NotImplementedError(f'parquet存储不支持查询条件：{term}')
+        if term.symbol == 'between':
+            lower, upper = term.value
+            return [(term.key, '>=', lower), (term.key, '<=', upper)]
+        return [(term.key, term.symbol, term.value)]
+
+    def select(self, fp, where=None, columns=None, start=None, stop=None):
+        p = self.path(fp)
+        if not p.exists():
+            raise FileNotFoundError(f"找不到文件：{p}")
+        if not self._parts(fp):
+            # 与h5文件不存在`data`节点一致
+            raise KeyError('data')
+        table = self.pq.read_table(p,
+                                   columns=columns,
+                                   filters=self._to_filters(where),
+                                   use_pandas_metadata=True)
+        df = table.to_pandas()
+        if start is not None or stop is not None:
+            df = df.iloc[start:stop]
+        return df
+
+    def select_column(self, fp, col, start=None, stop=None):
+        table = self.pq.read_table(self.path(fp), columns=[col])
+        s = table.column(col).to_pandas()
+        if start is not None or stop is not None:
+            s = s.iloc[start:stop].reset_index(drop=True)
+        return s
+
+    def iter_column(self, fp, col, chunksize=SCAN_CHUNKSIZE):
+        for part in self._parts(fp):
+            f = self.pq.ParquetFile(part)
+            for batch in f.iter_batches(batch_size=chunksize, columns=[col]):
+                yield batch.column(0).to_pandas()
+
+    def iter_select(self, fp, where=None, columns=None,
+                    chunksize=SCAN_CHUNKSIZE):
+        from .query_utils import filter_frame
+        read_columns = _with_where_columns(columns, where)
+        for part in self._parts(fp):
+            f = self.pq.ParquetFile(part)
+            for batch in f.iter_batches(batch_size=chunksize,
+                                        columns=read_columns,
+                                        use_pandas_metadata=True):
+                df = batch.to_pandas()
+                if where:
+                    df = filter_frame(df, where)
+                if columns is not None:
+                    df = df[columns]
+                if len(df):
+                    yield df
+
+    def describe(self, fp):
+        res = {'record': None, 'nrows': 0, 'columns': []}
+        try:
+            res['record'] = self.read_record(fp)
+        except Exception:
+            pass
+        parts = self._parts(fp)
+        if parts:
+            res['nrows'] = sum(
+                self.pq.ParquetFile(part).metadata.num_rows for part in parts)
+            schema = self.pq.read_schema(parts[0])
+            res['columns'] = schema.empty_table().to_pandas().columns.tolist()
+        return res
+
+    def append(self, fp, df, kwargs):
+        p = self.path(fp)
+        p.mkdir(parents=True, exist_ok=True)
+        table = self.pa.Table.from_pandas(df, preserve_index=True)
+        parts = self._parts(fp)
+        if parts:
+            # 各部分结构必须一致
+            schema = self.pq.read_schema(parts[0])
+            if set(schema.names) != set(table.schema.names):
+                raise ValueError(f'添加数据列与现有数据列不一致：{fp}')
+            table = table.select(schema.names).cast(schema)
+            num = int(parts[-1].stem.split('-')[1]) + 1
+        else:
+            num = 0
+        options = self._compression(kwargs)
+        _atomic_write(p / f'part-{num:06d}.parquet',
+                      lambda tmp: self.pq.write_table(table, tmp, **options))
+
+    def _compression(self, kwargs):
+        """写入参数中的压缩方式转换为parquet写入参数"""
+        if 'compression' in kwargs:
+            return {'compression': kwargs['compression']}
+        if 'complib' in kwargs and not kwargs.get('complevel'):
+            return {'compression': 'none'}
+        compression = self.codecs.get(kwargs.get('complib'), self.compression)
+        options = {'compression': compression}
+        if compression == 'zstd' and kwargs.get('complib') == 'blosc:zstd':
+            options['compression_level'] = kwargs['complevel']
+        return options
+
+    def rewrite(self, fp, df, kwargs):
+        self.remove(fp)
+        self.append(fp, df, kwargs)
+
+    def read_record(self, fp):
+        with open(self.path(fp) / self.record_name, 'rb') as f:
+            return pickle.load(f)
+
+    def write_record(self, fp, record):
+        p = self.path(fp)
+        p.mkdir(parents=True, exist_ok=True)
+        _dump_pickle(p / self.record_name, dict(record))
+
+    def compact(self, fp, sort_by=None, kwargs=None):
+        parts = self._parts(fp)
+        if not parts:
+            return
+        df = self.select(fp)
+        if sort_by:
+            df = df.sort_values(sort_by, kind='mergesort')
+        schema = self.pq.read_schema(parts[0])
+        table = self.pa.Table.from_pandas(df, preserve_index=True)
+        table = table.select(schema.names).cast(schema)
+        # 合并为单个部分，写入完成后删除原有部分
+        tmp = self.path(fp) / '.compact.parquet'
+        try:
+            options = self._compression(kwargs or {})
+            self.pq.write_table(table, tmp, **options)
+            for part in parts:
+                part.unlink()
+            os.replace(tmp, parts[0])
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+
+def _partition_keys(s, freq):
+    """索引列值所属期间"""
+    dt = pd.to_datetime(s, errors='coerce')
+    if getattr(dt.dt, 'tz', None) is not None:
+        dt = dt.dt.tz_localize(None)
+    return dt.dt.to_period(freq).astype(str)
+
+
+def _term_bounds(where, index_col):
+    """查询条件中索引列的下限与上限"""
+    lower, upper = None, None
+    for term in where or []:
+        if getattr(term, 'key', None) != index_col:
+            continue
+        if term.symbol in ('in', 'between'):
+            low, high = min(term.value), max(term.value)
+        elif term.symbol in ('>=', '>', '<=', '<', '=='):
+            low = high = term.value
+        else:
+            continue
+        if term.symbol in ('>=', '>', '==', 'in', 'between'):
+            lower = low if lower is None else max(lower, low)
+        if term.symbol in ('<=', '<', '==', 'in', 'between'):
+            upper = high if upper is None else min(upper, high)
+    return lower, upper
+
+
+def _overlaps(info, lower, upper):
+    """分区是否与查询范围重叠(无法比较时视为重叠)"""
+    try:
+        if lower is not None and info['max'] is not None:
+            if info['max'] < lower:
+                return False
+        if upper is not None and info['min'] is not None:
+            if info['min'] > upper:
+                return False
+    except TypeError:
+        pass
+    return True
+
+
+class PartitionedEngine(StorageEngine):
+    """按索引列期间分区存储
+
+    Notes:
+        `_catalog.pkl`记录索引列、分区频率、分区存储引擎及各分区最小值、最大值与行数
+        `_record.pkl`保存刷新记录
+        分区文件由分区存储引擎读写，如`2019.h5`
+    """
+    name = 'partitioned'
+    catalog_name = '_catalog.pkl'
+    record_name = '_record.pkl'
+
+    def __init__(self, index_col=None, freq=None, base=None):
+        """初始化
+
+        Keyword Arguments:
+            index_col {str} -- 分区索引列，新建时必须指定 (default: {None})
+            freq {str} -- 分区频率`Y`或`M`，新建时必须指定 (default: {None})
+            base {str} -- 分区存储引擎名称，默认按配置 (default: {None})
+        """
+        assert freq in (None, 'Y', 'M'), '只支持按年度或月度分区'
+        self._spec = {
+            'index_col': index_col,
+            'freq': freq,
+            'base': base or DEFAULT_CONFIG.get('storage', 'hdf'),
+            'parts': {},
+        }
+
+    @staticmethod
+    def layout_path(fp):
+        """分区目录"""
+        return fp.with_suffix('.parts')
+
+    def path(self, fp):
+        return self.layout_path(fp)
+
+    def stamp(self, fp):
+        return dir_stamp(self.path(fp))
+
+    def remove(self, fp):
+        p = self.path(fp)
+        if p.exists():
+            shutil.rmtree(p)
+
+    def catalog(self, fp):
+        """分区目录信息"""
+        try:
+            with open(self.path(fp) / self.catalog_name, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            assert self._spec['index_col'] and self._spec['freq'], '新建分区必须指定索引列及频率'
+            return copy.deepcopy(self._spec)
+
+    def _base(self, catalog):
+        return ENGINES[catalog['base']]
+
+    def part_path(self, fp, key):
+        """分区逻辑路径"""
+        return self.path(fp) / f"{key}.h5"
+
+    def _parts(self, fp, where=None):
+        """按期间排序的(分区路径, 分区信息)，指定条件时只包括重叠的分区"""
+        catalog = self.catalog(fp)
+        lower, upper = _term_bounds(where, catalog['index_col'])
+        return [(self.part_path(fp, key), info)
+                for key, info in sorted(catalog['parts'].items())
+                if _overlaps(info, lower, upper)]
+
+    def _ranges(self, parts, start, stop):
+        """全表行范围转换为各分区行范围"""
+        offset = 0
+        for part, info in parts:
+            nrows = info['nrows']
+            s = 0 if start is None else max(start - offset, 0)
+            e = nrows if stop is None else min(stop - offset, nrows)
+            if s < e:
+                yield part, s, e
+            offset += nrows
+
+    def select(self, fp, where=None, columns=None, start=None, stop=None):
+        p = self.path(fp)
+        if not p.exists():
+            raise FileNotFoundError(f"找不到文件：{p}")
+        catalog = self.catalog(fp)
+        if not catalog['parts']:
+            # 与h5文件不存在`data`节点一致
+            raise KeyError('data')
+        base = self._base(catalog)
+        if start is None and stop is None:
+            # 只读取与索引列条件重叠的分区
+            parts = [(part, None, None)
+                     for part, _ in self._parts(fp, where)]
+        else:
+            parts = self._ranges(self._parts(fp), start, stop)
+        dfs = [
+            base.select(part, where, columns, s, e) for part, s, e in parts
+        ]
+        if not dfs:
+            # 保持列结构
+            part = self.part_path(fp, sorted(catalog['parts'])[-1])
+            return base.select(part, None, columns, 0, 0)
+        return pd.concat(dfs)
+
+    def select_column(self, fp, col, start=None, stop=None):
+        base = self._base(self.catalog(fp))
+        parts = self._ranges(self._parts(fp), start, stop)
+        ss = [base.select_column(part, col, s, e) for part, s, e in parts]
+        if not ss:
+            return pd.Series([], name=col, dtype=object)
+        return pd.concat(ss, ignore_index=True)
+
+    def iter_column(self, fp, col, chunksize=SCAN_CHUNKSIZE):
+        base = self._base(self.catalog(fp))
+        for part, _ in self._parts(fp):
+            yield from base.iter_column(part, col, chunksize)
+
+    def iter_select(self, fp, where=None, columns=None,
+                    chunksize=SCAN_CHUNKSIZE):
+        base = self._base(self.catalog(fp))
+        # 只读取与索引列条件重叠的分区
+        for part, _ in self._parts(fp, where):
+            yield from base.iter_select(part, where, columns, chunksize)
+
+    def describe(self, fp):
+        res = {'record': None, 'nrows': 0, 'columns': []}
+        try:
+            res['record'] = self.read_record(fp)
+        except Exception:
+            pass
+        try:
+            catalog = self.catalog(fp)
+        except AssertionError:
+            return res
+        parts = self._parts(fp)
+        if parts:
+            res['nrows'] = sum(info['nrows'] for _, info in parts)
+            base = self._base(catalog)
+            res['columns'] = base.describe(parts[0][0])['columns']
+        return res
+
+    def append(self, fp, df, kwargs):
+        catalog = self.catalog(fp)
+        self.path(fp).mkdir(parents=True, exist_ok=True)
+        base = self._base(catalog)
+        index_col = catalog['index_col']
+        keys = _partition_keys(df[index_col], catalog['freq'])
+        # 一般只涉及最新的分区
+        for key, part in df.groupby(keys.values, sort=True):
+            base.append(self.part_path(fp, key), part, kwargs.copy())
+            info = catalog['parts'].get(key, {
+                'min': None,
+                'max': None,
+                'nrows': 0
+            })
+            values = part[index_col].dropna()
+            if not values.empty:
+                mins = [x for x in (info['min'], values.min()) if x is not None]
+                maxs = [x for x in (info['max'], values.max()) if x is not None]
+                info['min'], info['max'] = min(mins), max(maxs)
+            info['nrows'] += len(part)
+            catalog['parts'][key] = info
+        _dump_pickle(self.path(fp) / self.catalog_name, catalog)
+
+    def rewrite(self, fp, df, kwargs):
+        catalog = self.catalog(fp)
+        self.remove(fp)
+        engine = PartitionedEngine(catalog['index_col'], catalog['freq'],
+                                   catalog['base'])
+        engine.append(fp, df, kwargs)
+
+    def read_record(self, fp):
+        with open(self.path(fp) / self.record_name, 'rb') as f:
+            return pickle.load(f)
+
+    def write_record(self, fp, record):
+        p = self.path(fp)
+        p.mkdir(parents=True, exist_ok=True)
+        _dump_pickle(p / self.record_name, dict(record))
+
+    def create_index(self, fp, columns):
+        catalog = self.catalog(fp)
+        base = self._base(catalog)
+        for part, _ in self._parts(fp):
+            base.create_index(part, columns)
+
+    def missing_index(self, fp, columns=None):
+        base = self._base(self.catalog(fp))
+        res = []
+        for part, _ in self._parts(fp):
+            for col in base.missing_index(part, columns):
+                if col not in res:
+                    res.append(col)
+        return res
+
+    def ensure_index(self, fp, columns=None):
+        base = self._base(self.catalog(fp))
+        res = []
+        # 只处理缺少索引的分区
+        for part, _ in self._parts(fp):
+            for col in base.ensure_index(part, columns):
+                if col not in res:
+                    res.append(col)
+        return res
+
+    def compact(self, fp, sort_by=None, kwargs=None):
+        base = self._base(self.catalog(fp))
+        for part, _ in self._parts(fp):
+            base.compact(part, sort_by, kwargs)
+
+
+ENGINES = {
+    HDFEngine.name: HDFEngine(),
+    ParquetEngine.name: ParquetEngine(),
+}
+
+
+def get_engine(fp=None, name=None, partition=None):
+    """存储引擎
+
+    Keyword Arguments:
+        fp {Path} -- 逻辑路径(扩展名.h5)。默认格式不存在时按实际格式 (default: {None})
+        name {str} -- 引擎名称，指定时优先 (default: {None})
+        partition {tuple} -- (索引列, 分区频率)，仅用于新建数据 (default: {None})
+
+    Returns:
+        StorageEngine -- 存储引擎
+    """
+    if fp is not None and PartitionedEngine.layout_path(fp).exists():
+        return PartitionedEngine()
+    if name is not None:
+        engine = ENGINES[name]
+    else:
+        engine = ENGINES[DEFAULT_CONFIG.get('storage', 'hdf')]
+        if fp is not None and not engine.exists(fp):
+            for e in ENGINES.values():
+                if e.exists(fp):
+                    return e
+    if partition is not None and (fp is None or not engine.exists(fp)):
+        return PartitionedEngine(*partition, base=engine.name)
+    return engine
+
+
+def migrate(fp, remove=False):
+    """h5文件转换为parquet存储
+
+    Arguments:
+        fp {Path} -- h5文件路径
+
+    Keyword Arguments:
+        remove {bool} -- 转换后是否删除h5文件 (default: {False})
+
+    Raises:
+        ValueError: 非`HDFData`管理的h5文件(不含刷新记录)
+
+    Returns:
+        int -- 转换的数据行数
+    """
+    src = ENGINES['hdf']
+    dst = ENGINES['parquet']
+    info = src.describe(fp)
+    if info['record'] is None:
+        raise ValueError(f'{fp}不含刷新记录')
+    dst.remove(fp)
+    nrows = 0
+    if info['nrows']:
+        df = src.select(fp)
+        dst.append(fp, df, {})
+        nrows = len(df)
+    dst.write_record(fp, info['record'])
+    if remove:
+        src.remove(fp)
+    return nrows
+
+
+def _fit_min_itemsize(df, kwargs):
+    """按数据实际长度扩展字符串列最小长度(h5 table格式)"""
+    kwargs = kwargs.copy()
+    min_itemsize = dict(kwargs.get('min_itemsize') or {})
+    data_columns = kwargs.get('data_columns') or []
+    if data_columns is True:
+        data_columns = df.columns.tolist()
+    values = min_itemsize.get('values', 0)
+    for col in df.select_dtypes(include=['object']).columns:
+        size = df[col].astype(str).str.encode('utf-8').str.len().max()
+        size = 0 if pd.isnull(size) else int(size)
+        if col in data_columns or col in min_itemsize:
+            min_itemsize[col] = max(min_itemsize.get(col, 0), size)
+        else:
+            values = max(values, size)
+    if values:
+        min_itemsize['values'] = values
+    kwargs['min_itemsize'] = min_itemsize
+    return kwargs
+
+
+def partition(fp, index_col, freq, kwargs, remove=False):
+    """现有数据转换为分区存储
+
+    Arguments:
+        fp {Path} -- 逻辑路径(扩展名.h5)
+        index_col {str} -- 分区索引列(必须为数据列)
+        freq {str} -- 分区频率`Y`或`M`
+        kwargs {dict} -- 写入参数，如`data_columns`、`min_itemsize`
+
+    Keyword Arguments:
+        remove {bool} -- 转换后是否删除原数据 (default: {False})
+
+    Raises:
+        ValueError: 不含刷新记录或转换后行数不一致
+
+    Returns:
+        int -- 转换的数据行数
+    """
+    from .query_utils import Ops, Term
+    src = get_engine(fp)
+    if isinstance(src, PartitionedEngine):
+        return 0
+    info = src.describe(fp)
+    if info['record'] is None:
+        raise ValueError(f'{fp}不含刷新记录')
+    dst = PartitionedEngine(index_col, freq, src.name)
+    dst.remove(fp)
+    nrows = 0
+    if info['nrows']:
+        keys = _partition_keys(src.select_column(fp, index_col), freq)
+        # 逐个期间读取，避免一次性读取全部数据
+        for key in sorted(keys.unique()):
+            if key == 'NaT':
+                continue
+            p = pd.Period(key, freq)
+            where = [
+                Term(index_col, Ops.gte, p.start_time),
+                Term(index_col, Ops.lse, p.end_time),
+            ]
+            df = src.select(fp, where)
+            if src.name == 'hdf':
+                dst.append(fp, df, _fit_min_itemsize(df, kwargs))
+            else:
+                dst.append(fp, df, kwargs)
+            nrows += len(df)
+    if nrows != info['nrows']:
+        dst.remove(fp)
+        raise ValueError(f'{fp}共{info["nrows"]}行，分区后为{nrows}行')
+    dst.write_record(fp, info['record'])
+    if remove:
+        src.remove(fp)
+    return nrows
@@ -10,9 +10,9 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 from pandas.api.types import is_number
-from pandas.tseries.offsets import (BDay, Day, Hour, Minute, MonthBegin,
-                                    MonthEnd, QuarterBegin, QuarterEnd, Week,
-                                    YearBegin, YearEnd)
+from pandas.tseries.offsets import (Day, Hour, Minute, MonthBegin, MonthEnd,
+                                    QuarterBegin, QuarterEnd, Week, YearBegin,
+                                    YearEnd)
 
 from ..setting.constants import MARKET_START, TZ
 
@@ -60,6 +60,7 @@ def time_for_next_update(last_time, freq='D', num=9, is_end=False):
             上一时点`normalize`后移动`num`周期，不考虑开始及结束问题
         二、 freq in D、B
             `num`代表小时
+            B代表交易日(参阅`refdata.TradingCalendar`)
             对于历史时间，上一时点`normalize`后一律移动到下一个周期，且将小时调整到指定的num
             如上一时点其日期为当前日期，且在其`normalize`及调整小时后的值晚于上一时点，则取调整后的值
         三、 freq > D 开始及结束才有效
@@ -90,17 +91,16 @@ def time_for_next_update(last_time, freq='D', num=9, is_end=False):
             offset = Day()
             return offset.apply(last_time.floor(freq)).replace(hour=num)
     if freq == 'B':
-        offset = BDay()
-        # 工作日
-        if last_time.weekday() in range(0, 5):
+        # 交易日，延迟导入避免循环引用
+        from ..refdata import get_calendar
+        calendar = get_calendar()
+        if calendar.is_session(last_time):
             # √ 此处要考虑小时数
             limit = last_time.normalize().replace(hour=num)
             if last_time < limit:
                 return limit
-            else:
-                return offset.apply(last_time.normalize()).replace(hour=num)
-        else:
-            return offset.apply(last_time.normalize()).replace(hour=num)
+        next_session = calendar.next_session(last_time)
+        return next_session.tz_localize(last_time.tz).replace(hour=num)
     if freq == 'W':
         nw = last_time.normalize() + pd.Timedelta(weeks=1)
         if is_end:
@@ -203,17 +203,8 @@ def get_last_refresh_time(fp):
 
 def is_trading_time():
     """判断当前是否为交易时段"""
-    now = pd.Timestamp('now')
-    if now.weekday() in (5, 6):
-        return False
-    current_time = now.time()
-    am_start = pd.Timestamp('9:30').time()
-    am_end = pd.Timestamp('11:30').time()
-    pm_start = pd.Timestamp('13:00').time()
-    pm_end = pd.Timestamp('15:00').time()
-    is_am = am_start <= current_time <= am_end
-    is_pm = pm_start <= current_time <= pm_end
-    return is_am or is_pm
+    from ..refdata import get_calendar
+    return get_calendar().is_open_on_minute(pd.Timestamp('now'))
 
 
 def ensure_dt_localize(dt):
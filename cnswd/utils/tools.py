@@ -128,3 +128,19 @@ def get_server_name(url):
         string -- 返回主机地址
     """
     return urlparse(url)[1]
+
+
+def match_host(url, suffixes):
+    """网址主机所匹配的最长后缀
+
+    Arguments:
+        url {string} -- 网址或主机名称
+        suffixes {iterable} -- 主机后缀，如`163.com`
+
+    Returns:
+        string -- 匹配的后缀，无匹配时返回`None`
+    """
+    host = get_server_name(url) if '://' in url else url
+    host = host.split(':')[0].lower()
+    matched = [k for k in suffixes if host == k or host.endswith(f'.{k}')]
+    return max(matched, key=len) if matched else None
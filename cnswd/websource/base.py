@@ -1,74 +1,110 @@
-import requests
+"""网络请求
+
+Notes:
+    1. 同步请求使用进程内按主机共享的`requests.Session`，保持连接，避免每次请求
+       重新建立连接及解析域名
+    2. 会话挂载连接池及重试适配器，连接池大小及重试次数参阅配置`http_pool_size`、
+       `http_retries`；会话属于进程，子进程首次请求时新建
+    3. 协程使用`client_session`，同一事件循环共享`aiohttp.ClientSession`，
+       连接数上限参阅配置`http_async_limit`
+"""
+import asyncio
+import os
 import time
-from functools import wraps
-import numpy as np
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
 from logbook import Logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .._exceptions import ConnectFailed
+from ..ratelimit import rate_limit
+from ..setting.config import DEFAULT_CONFIG
 from ..utils.tools import get_server_name
 
 # 可能会遇到服务器定期重启，导致网络中断。休眠时长应大于重启完成时间
 MAX_SLEEP = 2
-logger = Logger('休眠')
-
-
-class DownloadRecord(object):
-	called = {}
-	start_time = {}
-	run_time = {}
-
-
-def friendly_download(times=20, duration=None, max_sleep=1, show=False):
-	"""
-	下载函数装饰器
-
-	Parameters
-    ----------
-	times： int
-		每`times`次调用休眠一次
-	duration：int
-		运行`duration`（秒）休眠一次
-	max_sleep：int
-		允许最长休眠时间（秒）
-
-	"""
-	assert times or duration, '运行次数与时长限制参数不得全部为空'
-
-	def decorator(func):
-
-		key = func.__name__
-
-		def sleep():
-			t = np.random.randint(1, max_sleep * 100) / 100
-			if show:
-				logger.info('每调用函数"{}"{}次，休眠{}秒'.format(key, times, t))
-			time.sleep(t)
-
-		@wraps(func)
-		def wrapper(*args, **kwargs):
-
-			called = DownloadRecord.called.get(key, 0)
-			run_time = DownloadRecord.run_time.get(key, 0)
-			start_time = DownloadRecord.start_time.get(key, time.time())
-
-			if times and ((called + 1) % times == 0):
-				sleep()
-			if duration and (int(run_time + 1) % duration == 0):
-				sleep()
-
-			DownloadRecord.called.update({key: called + 1})
-			DownloadRecord.run_time.update({key: time.time() - start_time})
-			DownloadRecord.start_time.update({key: time.time()})
-			return func(*args, **kwargs)
-		return wrapper
-	return decorator
+logger = Logger('网络请求')
+
+# 进程内会话 {(进程, 协议+主机): Session}
+_sessions = {}
+# 事件循环共享会话 {事件循环: [ClientSession, 引用数]}
+_client_sessions = {}
+
+
+def _pool_size():
+    return DEFAULT_CONFIG.get('http_pool_size', 10)
+
+
+def get_session(url):
+    """网址所在主机的会话(进程内共享，保持连接)
+
+    Arguments:
+        url {str} -- 网址
+
+    Returns:
+        requests.Session -- 会话
+    """
+    parts = urlparse(url)
+    prefix = f'{parts.scheme}://{parts.netloc}'
+    # 子进程不得使用父进程的连接
+    key = (os.getpid(), prefix)
+    session = _sessions.get(key)
+    if session is None:
+        # 只对连接错误及网关错误重试，403/429/503由调用方限速及调整并发
+        retry = Retry(total=DEFAULT_CONFIG.get('http_retries', 2),
+                      read=0,
+                      backoff_factor=0.5,
+                      status_forcelist=(500, 502, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=_pool_size(),
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount(f'{prefix}/', adapter)
+        _sessions[key] = session
+    return session
+
+
+@asynccontextmanager
+async def client_session():
+    """当前事件循环共享的`aiohttp.ClientSession`，最外层退出时关闭
+
+    Usage:
+    >>> async with client_session() as session:
+    >>>     async with session.get(url) as r:
+    >>>         text = await r.text()
+    """
+    loop = asyncio.get_running_loop()
+    item = _client_sessions.get(loop)
+    if item is None:
+        # 并发数由调用方控制(参阅`concurrency.py`)，连接数上限只作保护
+        connector = aiohttp.TCPConnector(
+            limit=DEFAULT_CONFIG.get('http_async_limit', 200),
+            ttl_dns_cache=300)
+        item = _client_sessions[loop] = [
+            aiohttp.ClientSession(connector=connector), 0
+        ]
+    item[1] += 1
+    try:
+        yield item[0]
+    finally:
+        item[1] -= 1
+        if item[1] == 0:
+            del _client_sessions[loop]
+            await item[0].close()
 
 
 def _get(url, params, timeout):
     """超时不能设置太短，否则经常出错"""
     for i in range(3):
+        # 按主机限速，所有进程合计
+        rate_limit(url)
         try:
-            r = requests.get(url, params=params, timeout=timeout)
+            r = get_session(url).get(url, params=params, timeout=timeout)
             if r.status_code == 200:
                 return r
         except requests.exceptions.ConnectionError:
@@ -84,8 +120,9 @@ def _get(url, params, timeout):
 
 def _post(url, params, timeout):
     for i in range(3):
+        rate_limit(url)
         try:
-            r = requests.post(url, params=params, timeout=timeout)
+            r = get_session(url).post(url, params=params, timeout=timeout)
             if r.status_code == 200:
                 return r
         except requests.exceptions.ConnectionError:
@@ -11,13 +11,14 @@
 import asyncio
 import math
 import time
-import random
-import aiohttp
 import pandas as pd
 import requests
 from aiohttp.client_exceptions import ContentTypeError
 
+from cnswd.concurrency import OVERLOAD_STATUS, get_limiter, is_overload
+from cnswd.ratelimit import async_rate_limit
 from cnswd.utils import data_root, make_logger, safety_exists_pkl
+from cnswd.websource.base import client_session
 
 # sem = asyncio.Semaphore(10)
 logger = make_logger('巨潮公司公告')
@@ -103,7 +104,7 @@ def _to_dataframe(data):
     return pd.concat(dfs, sort=True)
 
 
-async def _fetch_disclosure_async(sem, session, plate, category, date_str,
+async def _fetch_disclosure_async(limiter, session, plate, category, date_str,
                                   page):
     assert plate in PLATES.keys(), f'可接受范围{PLATES}'
     assert category in CATEGORIES.keys(), f'可接受分类范围：{CATEGORIES}'
@@ -118,24 +119,32 @@ async def _fetch_disclosure_async(sem, session, plate, category, date_str,
         pageNum=page,
         pageSize=30,
     )
-    delay = random.randint(20, 60) / 100
-    await asyncio.sleep(delay)
-    async with sem:
-        # 如果太频繁访问，容易导致关闭连接
-        async with session.post(URL, data=kwargs, headers=HEADERS) as r:
-            msg = f"{market} {date_str} 第{page}页 响应状态：{r.status}"
-            logger.info(msg)
-            # await asyncio.sleep(1)
-            try:
-                return await r.json()
-            except ContentTypeError:
-                return {}
-
-
-async def _fetch_one_day(sem, session, plate, date_str):
+    for i in range(1, 4):
+        try:
+            # 如果太频繁访问，容易导致关闭连接；出现时减少并发数后重试
+            # 按主机限速，所有进程合计；先取得令牌再占用并发槽位
+            await async_rate_limit(URL)
+            async with limiter.slot():
+                async with session.post(URL, data=kwargs,
+                                        headers=HEADERS) as r:
+                    msg = f"{market} {date_str} 第{page}页 响应状态：{r.status}"
+                    logger.info(msg)
+                    if r.status in OVERLOAD_STATUS:
+                        r.raise_for_status()
+                    try:
+                        return await r.json()
+                    except ContentTypeError:
+                        return {}
+        except Exception as e:
+            if i == 3 or not is_overload(e):
+                raise
+            logger.info(f"{market} {date_str} 第{page}页 第{i}次尝试 {e!r}")
+
+
+async def _fetch_one_day(limiter, session, plate, date_str):
     """获取深交所或上交所指定日期所有公司公告"""
-    data = await _fetch_disclosure_async(sem, session, plate, '全部', date_str,
-                                         1)
+    data = await _fetch_disclosure_async(limiter, session, plate, '全部',
+                                         date_str, 1)
     page_num = _get_total_record_num(data)
     if page_num == 0:
         return pd.DataFrame()
@@ -143,7 +152,7 @@ async def _fetch_one_day(sem, session, plate, date_str):
     tasks = []
     for i in range(page_num):
         tasks.append(
-            _fetch_disclosure_async(sem, session, plate, '全部', date_str,
+            _fetch_disclosure_async(limiter, session, plate, '全部', date_str,
                                     i + 1))
     # Schedule calls *concurrently*:
     data = await asyncio.gather(*tasks)
@@ -154,10 +163,11 @@ async def fetch_one_day(date):
     """获取指定日期公司所有公告"""
     date = pd.Timestamp(date)
     date_str = date.strftime(r'%Y-%m-%d')
-    sem = asyncio.BoundedSemaphore(8)
-    async with aiohttp.ClientSession() as session:
+    # 并发数随连接状况自动调整
+    limiter = get_limiter(URL, coroutine=True)
+    async with client_session() as session:
         tasks = [
-            _fetch_one_day(sem, session, plate, date_str)
+            _fetch_one_day(limiter, session, plate, date_str)
             for plate in PLATES.keys()
         ]
         dfs = await asyncio.gather(*tasks)
@@ -35,7 +35,8 @@ import requests
 from bs4 import BeautifulSoup
 
 from cnswd.utils import data_root
-from cnswd.websource.base import friendly_download, get_page_response
+from cnswd.ratelimit import rate_limit
+from cnswd.websource.base import get_page_response, get_session
 from cnswd.websource.exceptions import ConnectFailed, NoDataBefore, NoWebData, ThreeTryFailed
 
 EARLIEST_DATE = pd.Timestamp('2004-6-30')
@@ -165,11 +166,11 @@ def _get_url(stock_code, lm):
     return url_base.format(lm, _get_market(stock_code), stock_code)
 
 
-@friendly_download(30)
 def fetch_company_brief_info(stock_code):
     """公司简要信息"""
     url = _get_url(stock_code, 'brief')
-    r = requests.get(url)
+    rate_limit(url)
+    r = get_session(url).get(url)
     r.encoding = 'gb18030'
     df = pd.read_html(r.text, flavor='lxml')[1]
     return df
@@ -193,7 +194,6 @@ def fetch_index_info():
     urls = [url_fmt.format(x[0], x[1]) for x in prod_]
     dfs = []
 
-    @friendly_download(30, max_sleep=1)
     def _process(url):
         # 部分网页并不存在
         try:
@@ -336,7 +336,6 @@ def fetch_industry(date_str, department):
         raise ValueError(msg_fmt.format(date_str))
 
 
-@friendly_download(30)
 def _industry_stocks(industry_id, date_str):
     url = "http://www.cnindex.com.cn/stockPEs.do"
     if len(industry_id) == 1:
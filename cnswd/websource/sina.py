@@ -20,7 +20,8 @@ import logbook
 from cnswd.constants import QUOTE_COLS
 from cnswd.utils import ensure_list
 from cnswd.data_proxy import DataProxy
-from cnswd.websource.base import friendly_download, get_page_response
+from cnswd.ratelimit import rate_limit
+from cnswd.websource.base import get_page_response, get_session
 from cnswd.websource.exceptions import NoWebData, FrequentAccess
 
 QUOTE_PATTERN = re.compile('"(.*)"')
@@ -31,11 +32,11 @@ DATA_BASE_URL = 'http://vip.stock.finance.sina.com.cn/q/go.php/'
 logger = logbook.Logger('新浪网')
 
 
-@friendly_download(10, 10, 10)
 def fetch_company_info(stock_code):
     """获取公司基础信息"""
     url_fmt = 'http://vip.stock.finance.sina.com.cn/corp/go.php/vCI_CorpInfo/stockid/{}.phtml'
     url = url_fmt.format(stock_code)
+    rate_limit(url)
     df = pd.read_html(url, attrs={'id': 'comInfo1'})[0]
     return df
 
@@ -127,7 +128,6 @@ def fetch_globalnews():
     return stamps, titles, categories, data_mid
 
 
-@friendly_download(10, 10, 2)
 def fetch_cjmx(stock_code, date_):
     """
     下载指定股票代码所在日期成交明细
@@ -167,7 +167,8 @@ def fetch_cjmx(stock_code, date_):
     # 单日交易数据不可能超过1000页
     for i in range(1, 1000):
         params['page'] = i
-        r = requests.get(url, params=params)
+        rate_limit(url)
+        r = get_session(url).get(url, params=params)
         r.encoding = 'gb18030'
         df = pd.read_html(r.text, attrs={'id': 'datatbl'}, na_values=['--'])[0]
         if '没有交易数据' in df.iat[0, 0]:
@@ -181,12 +182,12 @@ def fetch_cjmx(stock_code, date_):
     return res
 
 
-@friendly_download(10, 10, 1)
 def _common_fun(url, pages, skiprows=1, verbose=False):
     """处理新浪数据中心网页数据通用函数"""
     dfs = []
 
     def sina_read_fun(x):
+        rate_limit(x)
         return pd.read_html(
             x,
             skiprows=skiprows,
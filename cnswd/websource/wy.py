@@ -4,7 +4,7 @@
 数据类别：
     指数代码名称           get_index_base
     主要指数列表           get_main_index
-    股票指数交易数据       fetch_history
+    股票指数交易数据       fetch_history, fetch_history_async
     股票指数OHLCV数据      fetch_ohlcv
     财务指标               fetch_financial_indicator
     财务报表               fetch_financial_report 
@@ -17,9 +17,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from urllib.error import HTTPError
+import asyncio
+import aiohttp
 from bs4 import BeautifulSoup
-import requests
 import pandas as pd
 import re
 from functools import partial, lru_cache
@@ -27,7 +27,9 @@ from io import StringIO, BytesIO
 
 from ..utils import sanitize_dates
 
-from .base import get_page_response, friendly_download
+from ..concurrency import get_limiter
+from ..ratelimit import async_rate_limit, rate_limit
+from .base import client_session, get_page_response, get_session
 from .._exceptions import NoWebData
 
 
@@ -42,6 +44,8 @@ _WY_STOCK_HISTORY_USE_COLS = list(set(range(15)).difference([1]))
 _CJMX_COLS = ('时间', '价格', '涨跌额', '成交量', '成交额', '方向')
 
 _WY_MARGIN_DATA_USE_COLS = [1, 4, 5, 6, 7, 8, 9, 10, 11]
+# 协程提取历史交易数据的超时
+HISTORY_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_connect=6)
 _WY_MARGIN_DATA_COL_NAMES = ['股票代码', '融资余额', '融资买入额', '融资偿还额',
                              '融券余量', '融券卖出量', '融券偿还量', '融券余量金额', '融券余额']
 
@@ -113,21 +117,17 @@ def _query_code(code, is_index):
     return code
 
 
-@friendly_download(30)
-def fetch_history(code, start, end=None, is_index=False):
-    """获取股票或者指数的历史交易数据（不复权）
-    备注：
-        提供的数据延迟一日
-
-    记录：
-        `2018-12-12 16：00`时下载 002622 历史数据，数据截至日为2018-12-10 延迟2日
-    """
+def _history_url(code, start, end, is_index):
     start, end = sanitize_dates(start, end)
     url_fmt = 'http://quotes.money.163.com/service/chddata.html?code={}&start={}&end={}'
     code = _query_code(code, is_index)
     start_str = start.strftime('%Y%m%d')
     end_str = end.strftime('%Y%m%d')
-    url = url_fmt.format(code, start_str, end_str) + '#01b07'
+    return url_fmt.format(code, start_str, end_str) + '#01b07'
+
+
+def _parse_history(content):
+    """解析历史交易数据(cp936编码的csv)"""
     na_values = ['None', '--', 'none']
     kwds = {
         'index_col': 0,
@@ -135,9 +135,43 @@ def fetch_history(code, start, end=None, is_index=False):
         'parse_dates': True,
         'na_values': na_values,
     }
+    return pd.read_csv(BytesIO(content), **kwds)
+
+
+def fetch_history(code, start, end=None, is_index=False):
+    """获取股票或者指数的历史交易数据（不复权）
+    备注：
+        提供的数据延迟一日
+
+    记录：
+        `2018-12-12 16：00`时下载 002622 历史数据，数据截至日为2018-12-10 延迟2日
+    """
+    url = _history_url(code, start, end, is_index)
     page_response = get_page_response(url, 'get')
-    df = pd.read_csv(BytesIO(page_response.content), **kwds)
-    return df
+    return _parse_history(page_response.content)
+
+
+async def fetch_history_async(code, start, end=None, is_index=False):
+    """协程版`fetch_history`
+
+    Notes:
+    ------
+        按主机限速并自适应调整并发数，共享连接；解码及解析在线程池中执行，不阻塞事件循环
+
+    Usage:
+    >>> async with client_session():
+    >>>     dfs = await asyncio.gather(*[fetch_history_async(c, start) for c in codes])
+    """
+    url = _history_url(code, start, end, is_index)
+    # 先取得令牌再占用并发槽位，等待令牌的时间不计入请求耗时
+    await async_rate_limit(url)
+    async with get_limiter(url, coroutine=True).slot():
+        async with client_session() as session:
+            async with session.get(url, timeout=HISTORY_TIMEOUT) as r:
+                r.raise_for_status()
+                content = await r.read()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _parse_history, content)
 
 
 def fetch_ohlcv(code, start, end, is_index=False):
@@ -157,12 +191,12 @@ def fetch_last_history():
     url += "page=0&query=STYPE:EQA&fields=SYMBOL,NAME,PRICE,PERCENT,OPEN,YESTCLOSE,"
     url += "HIGH,LOW,VOLUME,TURNOVER,PE,MCAP,TCAP&sort=PERCENT&"
     url += "order=desc&count=5000&type=query"
-    r = requests.get(url)
+    rate_limit(url)
+    r = get_session(url).get(url)
     df = pd.DataFrame.from_records(r.json()['list'])
     return df
 
 
-@friendly_download(10, None, 1)
 def fetch_cjmx(code, tdate):
     """
     提取股票历史交易明细
@@ -179,10 +213,12 @@ def fetch_cjmx(code, tdate):
     url = url_fmt.format_map({'qyear': qyear, 'qdate': qdate, 'qcode': qcode})
     na_values = ['None', '--', 'none']
     kwds = {'na_values': na_values}
-    try:
-        df = pd.read_excel(url, **kwds)
-    except HTTPError:
+    rate_limit(url)
+    r = get_session(url).get(url, timeout=(6, 10))
+    if r.status_code == 404:
         raise NoWebData('不存在网页数据。股票：{}，日期：{}'.format(code, tdate.date()))
+    r.raise_for_status()
+    df = pd.read_excel(BytesIO(r.content), **kwds)
     df.columns = _CJMX_COLS
     df.insert(0, '日期', tdate)
     df.insert(0, '股票代码', code)
@@ -215,7 +251,6 @@ def _parse_report_data(url):
     return pd.read_csv(StringIO(response.text), na_values=na_values).iloc[:, :-1]
 
 
-@friendly_download()
 def fetch_financial_indicator(code, report_type, part):
     """
     财务指标
@@ -238,12 +273,12 @@ def fetch_financial_indicator(code, report_type, part):
     assert report_type in ('report', 'year', 'season')
     assert part in ('zhzb', 'ylnl', 'chnl', 'cznl', 'yynl')
     url = _cwzb_url(code, report_type, part)
+    rate_limit(url)
     data = pd.read_csv(
         url, na_values=['--', ' --', '-- '], encoding='gb2312').iloc[:, :-1]
     return data
 
 
-@friendly_download()
 def fetch_financial_report(code, report_type, report_item):
     """
     财务报表
@@ -264,6 +299,7 @@ def fetch_financial_report(code, report_type, report_item):
     assert report_type in ('report', 'year')
     assert report_item in ('lrb', 'zcfzb', 'xjllb')
     url = _report_url(code, report_type, report_item)
+    rate_limit(url)
     data = pd.read_csv(
         url, na_values=['--', ' --', '-- '], encoding='gb18030').iloc[:, :-1]
     return data
@@ -343,7 +379,6 @@ def fetch_report_periods(stock_code, query):
     return result
 
 
-@friendly_download()
 def fetch_top10_stockholder(stock_code, query_date, type_='c'):
     """
     给定股票代码、期末日期、数据类型，返回股东数据
@@ -414,11 +449,11 @@ def fetch_top10_stockholder(stock_code, query_date, type_='c'):
     # df = pd.read_html(url, encoding='utf-8', header=0, skiprows=range(1))[0]
     attrs = {'class': 'table_bg001 border_box limit_sale'}
     # 必须使用html5lib解析
+    rate_limit(url)
     df = pd.read_html(url, encoding='utf-8', attrs=attrs, flavor='html5lib')[0]
     return df
 
 
-@friendly_download()
 def fetch_jjcg(stock_code, query_date):
     """
     给定股票代码、期末日期，返回基金持股数据
@@ -0,0 +1,161 @@
+"""单一写入进程
+
+Notes:
+    1. h5文件不支持多进程同时写入。启用写入服务后，进程池中的`HDFData.add`、
+       `insert`及`insert_by`调用经队列转发至专用写入进程依次执行
+    2. 写入进程使用`buffered_writes`按文件合并写入，队列空闲时写入全部缓存
+    3. 队列设有容量上限，写入落后时提取进程等待
+       使用`Manager`队列，提交即送达，进程池结束时不会丢失尚在缓冲中的任务
+    4. 写入异常不影响其他任务；失败的任务退出时填入`failed`，
+       已写入缓冲区的数据在写入文件失败时，自上次写入后提交的任务均视为失败
+    5. 调度进程以`set_task`标记当前项目，写入失败按项目报告，未标记时按文件路径报告
+    6. 写入进程不使用只读句柄池，读取后即关闭文件(参阅`storage.StorePool`)
+
+用法
+>>> with writer_service() as queue:
+>>>     with Pool(MAX_WORKER, initializer=use_writer, initargs=(queue,)) as pool:
+>>>         pool.map_async(refresh_batch, batchs).get()
+"""
+import pickle
+from contextlib import contextmanager
+from multiprocessing import Manager, Process
+from queue import Empty
+
+from .buffer import MAX_ROWS, MAX_SECONDS, buffered_writes
+from .setting.constants import MAX_WORKER
+from .storage import close_stores, store_pool
+from .utils import make_logger
+
+# 空闲多长时间(秒)后写入全部缓存
+IDLE_SECONDS = 1
+
+_queue = None
+# 本进程当前执行的项目
+_task = None
+
+
+def current_writer():
+    """本进程使用的写入队列，未启用时为`None`"""
+    return _queue
+
+
+def use_writer(queue):
+    """进程池初始化函数，本进程的写入转发至写入进程
+
+    Arguments:
+        queue {Queue} -- `writer_service`返回的队列
+    """
+    global _queue
+    _queue = queue
+
+
+def set_task(item):
+    """标记本进程当前执行的项目，此后提交的写入失败时按项目报告
+
+    Arguments:
+        item {object} -- 项目，`None`代表取消标记
+    """
+    global _task
+    _task = item
+
+
+def submit(spec, method, args):
+    """提交写入任务
+
+    Arguments:
+        spec {tuple} -- `HDFData`构造参数
+        method {str} -- 方法名称
+        args {tuple} -- 方法参数
+    """
+    # 立即序列化，避免调用方随后修改记录等可变参数
+    _queue.put(
+        pickle.dumps((spec, method, args, _task), pickle.HIGHEST_PROTOCOL))
+
+
+def _serve(queue, failed, max_rows, max_seconds):
+    """写入进程主循环"""
+    from .data import HDFData
+    # 写入进程不保留只读句柄，避免持有文件锁妨碍其他进程
+    store_pool.disable()
+    logger = make_logger('writer')
+    # 尚未写入文件的任务 {文件路径: {项目或文件路径}}
+    unwritten = {}
+
+    def fail(key, error, tags=None):
+        logger.error(f"{key} {error!r}")
+        for tag in unwritten.pop(key, {key}) if tags is None else tags:
+            failed[tag] = f'{error!r}'
+
+    def flush(buf):
+        for key in list(unwritten):
+            try:
+                buf.flush(key)
+            except Exception as e:
+                fail(key, e)
+            else:
+                unwritten.pop(key, None)
+
+    with buffered_writes(max_rows, max_seconds) as buf:
+        while True:
+            try:
+                task = queue.get(timeout=IDLE_SECONDS)
+            except Empty:
+                flush(buf)
+                continue
+            if task is None:
+                break
+            spec, method, args, tag = pickle.loads(task)
+            key = str(spec[0])
+            tag = key if tag is None else tag
+            unwritten.setdefault(key, set()).add(tag)
+            try:
+                getattr(HDFData(*spec), method)(*args)
+            except Exception as e:
+                if buf.pending(key) is None:
+                    # 缓存数据写入失败，此前提交的任务一并失败
+                    fail(key, e)
+                else:
+                    unwritten[key].discard(tag)
+                    fail(key, e, [tag])
+                continue
+            if buf.pending(key) is None:
+                unwritten.pop(key, None)
+        flush(buf)
+
+
+@contextmanager
+def writer_service(maxsize=MAX_WORKER * 4,
+                   max_rows=MAX_ROWS,
+                   max_seconds=MAX_SECONDS,
+                   failed=None):
+    """启动写入进程，退出时等待全部任务写入完成
+
+    Keyword Arguments:
+        maxsize {int} -- 队列容量上限 (default: {MAX_WORKER * 4})
+        max_rows {int} -- 单个文件缓存行数上限 (default: {MAX_ROWS})
+        max_seconds {int} -- 单个文件缓存时长上限(秒) (default: {MAX_SECONDS})
+        failed {dict} -- 退出时填入写入失败的任务 {项目或文件路径: 异常} (default: {None})
+
+    Returns:
+        Queue -- 写入队列，作为`use_writer`的参数
+    """
+    # 启动前关闭本进程已缓存的只读句柄，避免写入进程无法打开文件
+    close_stores()
+    with Manager() as manager:
+        queue = manager.Queue(maxsize)
+        errors = manager.dict()
+        p = Process(target=_serve,
+                    args=(queue, errors, max_rows, max_seconds),
+                    name='cnswd-writer',
+                    daemon=True)
+        p.start()
+        try:
+            yield queue
+        finally:
+            if p.is_alive():
+                queue.put(None)
+            p.join()
+            if p.exitcode:
+                errors['writer'] = f'写入进程退出 exitcode={p.exitcode}'
+            if failed is not None:
+                failed.update(errors.copy())
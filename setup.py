@@ -19,6 +19,9 @@ setup(
     install_requires=requires +
     ['python_version>="3.7"'],
     tests_require=["pytest", "parameterized"],
+    extras_require={
+        'parquet': ['pyarrow>=1.0.0'],
+    },
     include_package_data=True,
     entry_points={
         'console_scripts': [
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from cnswd.adjustment import adjust_prices, compute_factors
+
+
+def _daily():
+    """两只股票日线，000001于第3日10送10，第5日每股派息0.5元"""
+    dates = pd.date_range('2020-01-01', periods=6)
+    close = np.array([10., 11., 5.4, 5.6, 5.2, 5.3])
+    pre_close = np.append(10., close[:-1])
+    pre_close[2] = 5.5
+    pre_close[4] = 5.1
+    df1 = pd.DataFrame({
+        '股票代码': '000001',
+        '日期': dates,
+        '收盘价': close,
+        '前收盘': pre_close,
+    })
+    # 第2日停牌，收盘价为0
+    df2 = pd.DataFrame({
+        '股票代码': '600000',
+        '日期': dates,
+        '收盘价': [8., 0., 8.2, 8.1, 8.3, 8.4],
+        '前收盘': [8., 8., 8., 8.2, 8.1, 8.3],
+    })
+    return pd.concat([df2, df1], ignore_index=True)
+
+
+def test_compute_factors():
+    """测试复权因子及增量计算"""
+    df = _daily()
+    events, state = compute_factors(df)
+    actual = events[events['股票代码'] == '000001']['复权因子'].values
+    np.testing.assert_allclose(actual, [1., 2., 2. * 5.6 / 5.1])
+    assert events['股票代码'].value_counts()['600000'] == 1
+    assert state.loc['000001', 'last_close'] == 5.3
+    # 分两次计算结果一致
+    first = df['日期'] <= '2020-01-03'
+    events1, state1 = compute_factors(df[first])
+    events2, state2 = compute_factors(df, state1)
+    actual = pd.concat([events1, events2]).sort_values(['股票代码', '日期'])
+    assert_frame_equal(actual.reset_index(drop=True), events)
+    assert_frame_equal(state2, state, check_dtype=False)
+    # 没有新增日线
+    events3, state3 = compute_factors(df, state2)
+    assert events3.empty
+
+
+def test_adjust_prices():
+    """测试前复权及后复权"""
+    df = _daily()
+    events, _ = compute_factors(df)
+    df = df[df['股票代码'] == '000001']
+    hfq = adjust_prices(df, events, 'hfq')
+    qfq = adjust_prices(df, events, 'qfq')
+    # 复权后除权日前后价格连续
+    returns = (hfq['收盘价'] / hfq['收盘价'].shift()).values[1:]
+    expected = (df['收盘价'] / df['前收盘']).values[1:]
+    np.testing.assert_allclose(returns, expected)
+    # 前复权最新价格不变
+    assert qfq['收盘价'].iloc[-1] == df['收盘价'].iloc[-1]
+    np.testing.assert_allclose(qfq['收盘价'] / hfq['收盘价'],
+                               1 / events['复权因子'].max())
+    # 原数据不变
+    assert df['收盘价'].iloc[0] == 10.
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from cnswd.bars import BarBuilder, bar_labels, build_bars
+from cnswd.data import HDFData
+from cnswd.utils import data_root
+
+
+def _snapshots():
+    """两只股票两天的分钟快照(累计成交量、成交额及当日最高、最低)"""
+    rng = np.random.RandomState(0)
+    dfs = []
+    for d in ('2020-01-06', '2020-01-07'):
+        times = pd.date_range(f'{d} 09:30', f'{d} 11:30', freq='min').append(
+            pd.date_range(f'{d} 13:01', f'{d} 15:00', freq='min'))
+        for code in ('000001', '600000'):
+            price = 10 + rng.randn(len(times)).cumsum() * 0.01
+            volume = rng.randint(0, 100, len(times)).cumsum()
+            dfs.append(
+                pd.DataFrame({
+                    '代码': code,
+                    '时间': times,
+                    '最新价': price,
+                    '最高': np.maximum.accumulate(price),
+                    '最低': np.minimum.accumulate(price),
+                    '成交量': volume,
+                    '成交额': volume * 10.,
+                }))
+    return pd.concat(dfs, ignore_index=True)
+
+
+def _expected(df, n):
+    """逐组计算的K线"""
+    df = df.sort_values(['代码', '时间']).copy()
+    df['label'] = bar_labels(df['时间'], n).values
+    df['日期'] = df['时间'].dt.normalize()
+    g = df.groupby(['代码', '日期'])
+    df['增量'] = df['成交量'] - g['成交量'].shift().fillna(0)
+    res = df.groupby(['代码', 'label']).agg(
+        开盘=('最新价', 'first'),
+        最高=('最新价', 'max'),
+        最低=('最新价', 'min'),
+        收盘=('最新价', 'last'),
+        成交量=('增量', 'sum'),
+    )
+    return res.reset_index().rename(columns={'代码': '股票代码', 'label': '时间'})
+
+
+def test_bar_labels():
+    """测试K线按交易时段划分"""
+    times = pd.to_datetime([
+        '2020-01-06 09:25', '2020-01-06 09:31', '2020-01-06 10:30',
+        '2020-01-06 10:31', '2020-01-06 11:30', '2020-01-06 13:01',
+        '2020-01-06 15:00', '2020-01-06 15:02'
+    ])
+    actual = bar_labels(times, 60).dt.strftime('%H:%M').tolist()
+    assert actual == [
+        '10:30', '10:30', '10:30', '11:30', '11:30', '14:00', '15:00', '15:00'
+    ]
+    actual = bar_labels(times, 1).dt.strftime('%H:%M').tolist()
+    assert actual[:3] == ['09:31', '09:31', '10:30']
+
+
+@pytest.mark.parametrize('n', [1, 5, 60])
+def test_build_bars(n):
+    """测试向量化生成K线与逐组计算一致"""
+    df = _snapshots()
+    actual = build_bars(df, n)
+    expected = _expected(df, n)
+    assert len(actual) == len(expected)
+    assert_frame_equal(
+        actual[['股票代码', '时间', '开盘', '收盘', '成交量']],
+        expected[['股票代码', '时间', '开盘', '收盘', '成交量']],
+        check_dtype=False)
+    # 当日最高、最低修正区间最高、最低
+    assert (actual['最高'] >= expected['最高']).all()
+    assert (actual['最低'] <= expected['最低']).all()
+    assert actual['成交额'].sum() == df.groupby(
+        ['代码', df['时间'].dt.normalize()])['成交额'].max().sum()
+
+
+def test_bar_builder():
+    """测试增量生成K线与一次生成一致"""
+    fp = data_root('TEST/bars/5min.h5')
+    state_fp = fp.with_name(f'{fp.name}.state')
+    # 确保干净测试环境
+    for p in (fp, state_fp):
+        if p.exists():
+            p.unlink()
+    df = _snapshots()
+    expected = build_bars(df, 5)
+    # 每次到达3分钟快照，K线跨越两次更新；每次由状态文件恢复(同刷新任务)
+    for _, snapshot in df.groupby(df['时间'].dt.floor('3min')):
+        BarBuilder(5, fp=fp).update(snapshot)
+    assert BarBuilder(5, fp=fp).update(df.iloc[:0]).empty
+    actual = HDFData(fp, 'a').data
+    actual = actual.sort_values(['股票代码', '时间']).reset_index(drop=True)
+    assert_frame_equal(actual, expected, check_dtype=False)
+    HDFData(fp, 'a').engine.remove(fp)
+    state_fp.unlink()
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from cnswd import concurrency
+from cnswd.concurrency import AdaptiveLimiter, get_limiter, is_overload
+from cnswd.scheduler import run_tasks
+
+
+class _Response(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+def _reset(x):
+    if x % 2:
+        raise ConnectionResetError(x)
+    return x
+
+
+def _sleep(x):
+    time.sleep(0.2)
+    return x
+
+
+def test_is_overload():
+    """测试过载错误分类"""
+    assert is_overload(ConnectionResetError())
+    assert is_overload(asyncio.TimeoutError())
+    assert is_overload(_Response(503))
+    assert not is_overload(_Response(404))
+    assert not is_overload(ValueError('000403'))
+    assert is_overload("ConnectionResetError(10054, '远程主机强迫关闭了一个现有的连接。')")
+    assert is_overload("HTTPError('403 Client Error: Forbidden')")
+    assert not is_overload("KeyError('日期')")
+
+
+def test_aimd():
+    """测试加性增及乘性减"""
+    limiter = AdaptiveLimiter('TEST', initial=4, maximum=6)
+    for _ in range(5):
+        limiter.on_success(0.1)
+    assert limiter.capacity == 5
+    # 耗时异常时不增加
+    limiter.on_success(10)
+    assert limiter.capacity == 5
+    started = time.time()
+    assert limiter.on_error(ConnectionResetError(), started)
+    assert limiter.capacity == 2
+    # 同一批请求的连续失败只减少一次
+    limiter.on_error(ConnectionResetError(), started)
+    assert limiter.capacity == 2
+    assert not limiter.on_error(ValueError(), time.time())
+    limiter.on_error(TimeoutError(), time.time())
+    limiter.on_error(TimeoutError(), time.time())
+    assert limiter.capacity == 1
+    for _ in range(100):
+        limiter.on_success(0.1)
+    assert limiter.capacity == 6
+
+
+def test_get_limiter(monkeypatch):
+    """测试同一来源的工作进程与协程分别控制"""
+    monkeypatch.setattr(concurrency, '_limiters', {})
+    limiter = get_limiter('http://quotes.money.163.com/service/chddata.html')
+    assert limiter is get_limiter('quotes.money.163.com')
+    async_limiter = get_limiter('quotes.money.163.com', coroutine=True)
+    assert async_limiter is not limiter
+    assert async_limiter.maximum > limiter.maximum
+    # 未配置的来源
+    assert get_limiter('example.com').maximum == concurrency.DEFAULT_LIMITS[1]
+
+
+def test_slot():
+    """测试协程并发数不超过限制"""
+    limiter = AdaptiveLimiter('TEST', initial=3, maximum=3)
+    peak = []
+
+    async def one(fail):
+        async with limiter.slot():
+            peak.append(limiter.active)
+            await asyncio.sleep(0.01)
+            if fail:
+                raise ConnectionResetError()
+
+    async def main(fail):
+        return await asyncio.gather(*[one(fail) for _ in range(10)],
+                                    return_exceptions=True)
+
+    res = asyncio.run(main(True))
+    assert all(isinstance(e, ConnectionResetError) for e in res)
+    assert max(peak) == 3
+    assert limiter.capacity == 1
+    # 新的事件循环
+    peak.clear()
+    asyncio.run(main(False))
+    assert peak[:2] == [1, 1]
+    assert limiter.active == 0
+    assert limiter.capacity == 3
+
+
+def test_scheduler_limiter():
+    """测试调度按并发控制执行任务"""
+    limiter = AdaptiveLimiter('TEST', initial=1, maximum=1)
+    start = time.time()
+    report = run_tasks(_sleep, range(4), timeout=0, limiter=limiter)
+    assert time.time() - start >= 0.8
+    assert sorted(report.results) == [0, 1, 2, 3]
+    limiter = AdaptiveLimiter('TEST', initial=4, maximum=4)
+    report = run_tasks(_reset, range(8), timeout=0, retries=0, limiter=limiter)
+    assert sorted(report.failed) == [1, 3, 5, 7]
+    assert limiter.capacity < 4
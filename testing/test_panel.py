@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from cnswd import panel
+from cnswd.reader import bulk_daily_history
+from cnswd.scripts.refresh import WYSRefresher
+from cnswd.storage import store_pool
+from cnswd.utils import data_root
+
+
+def _write(root, code, dates, i):
+    fp = root / f'{code}.h5'
+    store_pool.release(fp)
+    df = pd.DataFrame({
+        '日期': dates,
+        '股票代码': f"'{code}",
+        '收盘价': np.arange(len(dates)) + i + 0.5,
+        '成交量': np.arange(len(dates)) * 100 + i,
+        '成交金额': np.arange(len(dates)) * 1e9 + i,
+    })
+    df.to_hdf(fp, 'data', format='table', append=True,
+              data_columns=['日期', '股票代码'])
+
+
+def _expected(field):
+    df = bulk_daily_history(None, field=field, processes=1)
+    df.columns.name = '股票代码'
+    return df
+
+
+def test_panel(monkeypatch):
+    """测试生成、追加及读取日线面板"""
+    root = data_root('TEST/wy_panel')
+    panel_root = data_root('TEST/panel')
+    # 确保干净测试环境
+    for p in list(root.glob('*.h5')) + list(panel_root.iterdir()):
+        p.unlink()
+    monkeypatch.setattr(WYSRefresher, 'get_data_path',
+                        lambda self, one: root / f'{one}.h5')
+    monkeypatch.setattr(panel, 'panel_dir', lambda: panel_root)
+    monkeypatch.setattr(panel, '_cache', {})
+    dates = pd.date_range('2019-01-01', periods=5)
+    _write(root, '000001', dates, 0)
+    # 迟一日上市
+    _write(root, '600000', dates[1:], 10)
+    panel.build_panel()
+    close = panel.read_panel('收盘价')
+    assert close.shape == (5, 2)
+    assert close.dtypes.unique().tolist() == [np.dtype('float32')]
+    assert np.isnan(close.loc['2019-01-01', '600000'])
+    assert_frame_equal(close, _expected('收盘价'), check_dtype=False)
+    # 不复制数据
+    arr = panel.panel_array('收盘价')
+    assert np.shares_memory(close.values, arr)
+    assert not arr.flags.writeable
+    # 追加新交易日及新增代码
+    new_dates = pd.date_range('2019-01-06', periods=2)
+    _write(root, '000001', new_dates, 5)
+    _write(root, '000002', dates.append(new_dates), 20)
+    panel.append_panel()
+    for field in panel.PANEL_FIELDS:
+        actual = panel.read_panel(field)
+        assert actual.shape == (7, 3)
+        expected = _expected(field)
+        if field == '成交量':
+            expected = expected.fillna(0)
+        assert_frame_equal(actual, expected[actual.columns], check_dtype=False)
+    # 中断后重新追加结果不变
+    panel.append_panel()
+    assert panel.read_panel('成交量').shape == (7, 3)
+    actual = panel.read_panel('成交金额', '2019-01-02', '2019-01-03',
+                              ['600000', '000002'])
+    assert actual.index.tolist() == list(dates[1:3])
+    assert actual.columns.tolist() == ['600000', '000002']
+    assert actual.iloc[0, 0] == 10.
+    for p in list(root.glob('*.h5')) + list(panel_root.iterdir()):
+        store_pool.release(p)
+        p.unlink()
@@ -0,0 +1,61 @@
+import time
+from multiprocessing import Pool
+
+import pytest
+
+from cnswd import ratelimit
+from cnswd.ratelimit import TokenBucket, _host_key, rate_limit
+
+
+def _bucket(name, rate, burst):
+    b = TokenBucket(name, rate, burst)
+    # 确保干净测试环境
+    if b.path.exists():
+        b.path.unlink()
+    return b
+
+
+def _acquire(args):
+    name, rate, burst, n = args
+    b = TokenBucket(name, rate, burst)
+    for _ in range(n):
+        b.acquire()
+    return time.time()
+
+
+def test_token_bucket():
+    """测试突发请求不等待，超出后按速率等待"""
+    b = _bucket('TEST_single', 10, 3)
+    assert [b.reserve() for _ in range(3)] == [0., 0., 0.]
+    assert b.reserve() == pytest.approx(0.1, abs=0.02)
+    assert b.reserve() == pytest.approx(0.2, abs=0.02)
+    b.path.unlink()
+
+
+def test_shared_across_processes():
+    """测试多进程合计速率"""
+    name, rate, burst = 'TEST_shared', 20, 1
+    b = _bucket(name, rate, burst)
+    start = time.time()
+    with Pool(4) as pool:
+        ends = pool.map(_acquire, [(name, rate, burst, 5)] * 4)
+    # 20次请求，除首个令牌外按每秒20次
+    assert max(ends) - start >= 19 / rate - 0.05
+    b.path.unlink()
+
+
+def test_host_key(monkeypatch):
+    """测试按主机后缀匹配配置"""
+    monkeypatch.setattr(ratelimit, 'RATE_LIMITS', {
+        'sina.com.cn': (1, 1),
+        'finance.sina.com.cn': (2, 1),
+        'example.com': (0, 1),
+    })
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+    assert _host_key('http://finance.sina.com.cn/a') == 'finance.sina.com.cn'
+    assert _host_key('http://live.sina.com.cn:80/a') == 'sina.com.cn'
+    assert _host_key('http://hq.sinajs.cn/list=a') is None
+    assert _host_key('sina.com.cn') == 'sina.com.cn'
+    # 速率为0或未配置时不限速
+    assert rate_limit('http://example.com/a') == 0.
+    assert rate_limit('http://hq.sinajs.cn') == 0.
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_array_equal
+
+from cnswd import refdata
+from cnswd.setting.constants import TZ
+from cnswd.utils import data_root
+from cnswd.utils.dt_utils import time_for_next_update
+
+
+def test_refdata(monkeypatch):
+    """测试参考数据导出及内存映射读取"""
+    monkeypatch.setattr(refdata, 'ref_path',
+                        lambda name: data_root(f'TEST/refdata/{name}.npy'))
+    monkeypatch.setattr(refdata, '_cache', {})
+    dates = pd.to_datetime(['2019-01-03', '2019-01-02', '2019-01-04'])
+    refdata.export_calendar(dates)
+    refdata.export_codes(['600000', '000001'])
+    actual = refdata.trading_dates()
+    assert_array_equal(actual, dates.sort_values().values)
+    assert isinstance(actual, np.ndarray)
+    assert not actual.flags.writeable
+    # 进程内使用同一映射
+    assert refdata.trading_dates() is actual
+    assert refdata.stock_codes().tolist() == ['000001', '600000']
+    assert refdata.is_trading_date(np.datetime64('2019-01-03'))
+    assert not refdata.is_trading_date(np.datetime64('2019-01-05'))
+    assert not refdata.is_trading_date(np.datetime64('2019-01-01'))
+    # 文件更新后重新映射
+    refdata.export_calendar(dates[:1])
+    assert len(refdata.trading_dates()) == 1
+
+
+def _calendar():
+    # 2020年春节休市 01-24 ~ 01-31，日历刷新至 02-04
+    dates = pd.bdate_range('2020-01-13', '2020-02-04')
+    dates = dates[(dates < '2020-01-24') | (dates > '2020-01-31')]
+    return refdata.TradingCalendar(dates, '2020-02-04')
+
+
+def test_trading_calendar():
+    """测试交易日历推算"""
+    calendar = _calendar()
+    ts = pd.Timestamp
+    assert calendar.is_session('2020-01-23')
+    assert not calendar.is_session('2020-01-24')
+    assert not calendar.is_session('2020-02-01')
+    # 带时区信息时以北京时间计算
+    assert calendar.is_session(ts('2020-01-22 17:00', tz='UTC'))
+    assert calendar.next_session('2020-01-23') == ts('2020-02-03')
+    assert calendar.next_session('2020-01-25') == ts('2020-02-03')
+    assert calendar.previous_session('2020-02-03') == ts('2020-01-23')
+    assert calendar.previous_session('2020-01-27') == ts('2020-01-23')
+    with pytest.raises(ValueError):
+        calendar.previous_session('2020-01-13')
+    actual = calendar.sessions_in_range('2020-01-22', '2020-02-04')
+    assert actual.strftime('%m-%d').tolist() == [
+        '01-22', '01-23', '02-03', '02-04'
+    ]
+    assert calendar.sessions_window('2020-02-02', 3).equals(
+        pd.DatetimeIndex(['2020-01-21', '2020-01-22', '2020-01-23']))
+    minutes = calendar.minutes_for_session('2020-02-03')
+    assert len(minutes) == 240
+    assert minutes[0] == ts('2020-02-03 09:31')
+    assert minutes[-1] == ts('2020-02-03 15:00')
+    with pytest.raises(ValueError):
+        calendar.minutes_for_session('2020-01-24')
+    assert calendar.is_open_on_minute(ts('2020-02-03 11:30'))
+    assert not calendar.is_open_on_minute(ts('2020-02-03 12:00'))
+    assert not calendar.is_open_on_minute(ts('2020-01-24 10:00'))
+
+
+def test_trading_calendar_future():
+    """测试日历覆盖期间之后视工作日为交易日"""
+    calendar = _calendar()
+    ts = pd.Timestamp
+    assert calendar.is_session('2020-02-05')
+    assert not calendar.is_session('2020-02-08')
+    assert calendar.next_session('2020-02-04') == ts('2020-02-05')
+    assert calendar.next_session('2020-02-07') == ts('2020-02-10')
+    assert calendar.previous_session('2020-02-06') == ts('2020-02-05')
+    assert calendar.previous_session('2020-02-05') == ts('2020-02-04')
+    actual = calendar.sessions_in_range('2020-01-31', '2020-02-10')
+    assert actual.strftime('%m-%d').tolist() == [
+        '02-03', '02-04', '02-05', '02-06', '02-07', '02-10'
+    ]
+    assert calendar.sessions_window('2020-02-06', 3).strftime(
+        '%m-%d').tolist() == ['02-04', '02-05', '02-06']
+    # 尚未刷新交易日历
+    empty = refdata.TradingCalendar([])
+    assert empty.is_session('2020-01-24')
+    assert empty.next_session('2020-01-24') == ts('2020-01-27')
+    assert len(empty.sessions_window('2020-01-24', 5)) == 5
+
+
+def test_calendar_export(monkeypatch):
+    """测试导出日历覆盖期间，以及按交易日推算下次刷新时间"""
+    monkeypatch.setattr(refdata, 'ref_path',
+                        lambda name: data_root(f'TEST/calendar/{name}.npy'))
+    monkeypatch.setattr(refdata, '_cache', {})
+    refdata.export_calendar(_calendar().sessions, '2020-02-04')
+    calendar = refdata.get_calendar()
+    assert calendar.end_date == pd.Timestamp('2020-02-04')
+    assert not calendar.is_session('2020-01-31')
+    ts = pd.Timestamp
+    actual = time_for_next_update(ts('2020-01-23 18:00', tz=TZ), 'B', 17)
+    assert actual == ts('2020-02-03 17:00', tz=TZ)
+    actual = time_for_next_update(ts('2020-01-28 10:00', tz=TZ), 'B', 17)
+    assert actual == ts('2020-02-03 17:00', tz=TZ)
+    actual = time_for_next_update(ts('2020-02-03 10:00', tz=TZ), 'B', 17)
+    assert actual == ts('2020-02-03 17:00', tz=TZ)
@@ -0,0 +1,92 @@
+import os
+import time
+
+from cnswd.scheduler import run_tasks
+
+
+def _square(x):
+    return x * x
+
+
+def _fail_odd(x):
+    if x % 2:
+        raise ValueError(x)
+    return x
+
+
+def _slow(x):
+    if x == 0:
+        time.sleep(60)
+    return x
+
+
+def _exit(x):
+    if x == 0:
+        os._exit(1)
+    return x
+
+
+def _flaky(path):
+    # 首次执行失败，重试成功
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        raise RuntimeError('首次失败')
+    return 'ok'
+
+
+_value = None
+
+
+def _init(value):
+    global _value
+    _value = value
+
+
+def _get_value(x):
+    return (_value, x)
+
+
+def test_run_tasks():
+    """测试动态分派结果"""
+    report = run_tasks(_square, range(20), processes=4, timeout=0, retries=0)
+    assert report.results == {i: i * i for i in range(20)}
+    assert report.failed == {}
+    # 空任务
+    assert run_tasks(_square, []).results == {}
+
+
+def test_failed_isolated():
+    """测试失败任务不影响其他任务"""
+    report = run_tasks(_fail_odd, range(6), processes=2, timeout=0, retries=1)
+    assert sorted(report.results) == [0, 2, 4]
+    assert sorted(report.failed) == [1, 3, 5]
+    assert 'ValueError' in report.failed[1]
+    assert report.retried == 3
+
+
+def test_retry(tmp_path):
+    """测试失败任务重试"""
+    items = [str(tmp_path / f'{i}') for i in range(3)]
+    report = run_tasks(_flaky, items, processes=2, timeout=0, retries=1)
+    assert report.results == {p: 'ok' for p in items}
+    assert report.retried == 3
+
+
+def test_timeout_and_exit():
+    """测试超时及进程退出时替换工作进程"""
+    start = time.time()
+    report = run_tasks(_slow, range(4), processes=2, timeout=1, retries=0)
+    assert time.time() - start < 30
+    assert list(report.failed) == [0]
+    assert 'TimeoutError' in report.failed[0]
+    assert sorted(report.results) == [1, 2, 3]
+    report = run_tasks(_exit, range(4), processes=2, timeout=0, retries=1)
+    assert list(report.failed) == [0]
+    assert sorted(report.results) == [1, 2, 3]
+
+
+def test_initializer():
+    """测试工作进程初始化"""
+    report = run_tasks(_get_value, range(3), processes=2, initializer=_init,
+                       initargs=('a', ))
+    assert report.results == {i: ('a', i) for i in range(3)}
@@ -0,0 +1,43 @@
+import asyncio
+import os
+from multiprocessing import Pool
+
+from cnswd.websource import base
+from cnswd.websource.base import client_session, get_session
+
+
+def _is_inherited(args):
+    url, ppid = args
+    return get_session(url) is base._sessions[(ppid, 'http://quotes.money.163.com')]
+
+
+def test_get_session():
+    """测试按主机共享会话"""
+    s1 = get_session('http://quotes.money.163.com/service/a.html')
+    s2 = get_session('http://quotes.money.163.com/cjmx/b.xls')
+    s3 = get_session('http://hq.sinajs.cn/list=sh600000')
+    assert s1 is s2
+    assert s1 is not s3
+    adapter = s1.get_adapter('http://quotes.money.163.com/x')
+    assert adapter.max_retries.total == 2
+    # 子进程新建会话
+    with Pool(1) as pool:
+        res = pool.map(_is_inherited,
+                       [('http://quotes.money.163.com/a', os.getpid())])
+    assert res == [False]
+    assert get_session('http://quotes.money.163.com/a') is s1
+
+
+def test_client_session():
+    """测试事件循环内共享会话，最外层退出时关闭"""
+    async def main():
+        async with client_session() as outer:
+            async with client_session() as inner:
+                assert inner is outer
+            assert not outer.closed
+        return outer
+
+    session = asyncio.run(main())
+    assert session.closed
+    # 新的事件循环使用新的会话
+    assert asyncio.run(main()) is not session